@@ -0,0 +1,163 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+from typing import Optional
+
+ARTIFACTS_DIR = "/artifacts"
+# a directory shared by every launcher, holding compiled projects keyed by the
+# hash of their sources and foundry config
+ARTIFACT_STORE = os.getenv("ARTIFACT_STORE")
+
+
+# build outputs and broadcast logs don't affect what gets deployed
+PROJECT_HASH_IGNORED = {".git", "broadcast", "cache", "out"}
+
+
+def hash_project(project_location: str) -> str:
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(project_location):
+        dirs[:] = sorted(d for d in dirs if d not in PROJECT_HASH_IGNORED)
+
+        for file in sorted(files):
+            path = os.path.join(root, file)
+
+            digest.update(os.path.relpath(path, project_location).encode("utf8"))
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+
+    return digest.hexdigest()
+
+
+def get_stored_artifacts(project_hash: str) -> Optional[str]:
+    if ARTIFACT_STORE is None:
+        return None
+
+    # entries only ever appear through store_artifacts renaming a fully
+    # written staging directory into place, so an entry that exists is
+    # complete, the files themselves aren't checked again
+    stored = os.path.join(ARTIFACT_STORE, project_hash)
+    if not os.path.isdir(stored):
+        return None
+
+    return stored
+
+
+def compile_project(project_location: str, out_dir: str):
+    proc = subprocess.run(
+        args=[
+            "/opt/foundry/bin/forge",
+            "build",
+            "--out",
+            os.path.join(out_dir, "out"),
+            "--cache-path",
+            os.path.join(out_dir, "cache"),
+        ],
+        env={
+            "PATH": "/opt/huff/bin:/opt/foundry/bin:/usr/bin:" + os.getenv("PATH", "/fake"),
+        },
+        cwd=project_location,
+        text=True,
+        encoding="utf8",
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if proc.returncode != 0:
+        print(proc.stdout)
+        print(proc.stderr)
+        raise Exception("forge failed to compile")
+
+
+def store_artifacts(project_hash: str, artifacts_dir: str):
+    # written next to the final location and renamed into place, so readers
+    # never see a partially copied entry, even if this launcher dies halfway
+    staging = os.path.join(ARTIFACT_STORE, f".{project_hash}-{uuid.uuid4().hex}")
+    for name in ["out", "cache"]:
+        shutil.copytree(
+            os.path.join(artifacts_dir, name), os.path.join(staging, name)
+        )
+    with open(os.path.join(staging, "manifest.json"), "w") as f:
+        json.dump({"hash": project_hash, "created_at": time.time()}, f)
+
+    try:
+        os.rename(staging, os.path.join(ARTIFACT_STORE, project_hash))
+    except OSError:
+        # someone else stored the same project first
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def prepare_artifacts(
+    project_location: str,
+    artifacts_dir: str = ARTIFACTS_DIR,
+    project_hash: Optional[str] = None,
+) -> str:
+    start = time.time()
+
+    # hashing reads the whole project including its libraries, callers that
+    # already have the hash pass it in
+    if project_hash is None:
+        project_hash = hash_project(project_location)
+
+    # launchers serving several connections, or running side by side in one
+    # container, share the artifacts directory, so only one of them prepares
+    # it at a time and the rest find it ready once they get the lock
+    os.makedirs(artifacts_dir, exist_ok=True)
+    with open(os.path.join(artifacts_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        source = load_artifacts(project_location, artifacts_dir, project_hash)
+
+    print(
+        f"artifacts {source} in {time.time() - start:.2f}s ({project_hash[:12]})",
+        file=sys.stderr,
+    )
+
+    return project_hash
+
+
+def load_artifacts(project_location: str, artifacts_dir: str, project_hash: str) -> str:
+    # the marker records which project the local artifacts were built from
+    marker = os.path.join(artifacts_dir, ".hash")
+    local_hash = None
+    if os.path.exists(marker):
+        with open(marker, "r") as f:
+            local_hash = f.read()
+
+    if local_hash == project_hash:
+        source = "already prepared"
+    else:
+        stored = get_stored_artifacts(project_hash)
+        if stored is not None:
+            for name in ["out", "cache"]:
+                shutil.copytree(
+                    os.path.join(stored, name),
+                    os.path.join(artifacts_dir, name),
+                    dirs_exist_ok=True,
+                )
+            source = "loaded from artifact store"
+        else:
+            print(
+                f"artifact store miss for {project_hash}, compiling {project_location}",
+                file=sys.stderr,
+            )
+            compile_project(project_location, artifacts_dir)
+            if ARTIFACT_STORE is not None:
+                store_artifacts(project_hash, artifacts_dir)
+            source = "compiled"
+
+    with open(marker, "w") as f:
+        f.write(project_hash)
+
+    return source
+
+
+if __name__ == "__main__":
+    # run while building the challenge image to fill the artifact store ahead
+    # of time, e.g. python -m ctf_launchers.artifacts challenge/project
+    for project_location in sys.argv[1:]:
+        prepare_artifacts(project_location)
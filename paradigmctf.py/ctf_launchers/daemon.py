@@ -1,13 +1,17 @@
 import abc
+import asyncio
+import json
+import logging
 import os
-import time
-from typing import Dict, List
+from typing import Any, Awaitable, Callable, Dict, List, Set, Tuple
 
 import requests
+import websockets
 from ctf_server.types import UserData
 
 ORCHESTRATOR = os.getenv("ORCHESTRATOR_HOST", "http://orchestrator:7283")
 INSTANCE_ID = os.getenv("INSTANCE_ID")
+WATCH_TIMEOUT = 30
 
 
 class Daemon(abc.ABC):
@@ -16,8 +20,14 @@ class Daemon(abc.ABC):
 
     def start(self):
         while True:
+            # blocks server-side until the instance has every required property
             instance_body = requests.get(
-                f"{ORCHESTRATOR}/instances/{INSTANCE_ID}"
+                f"{ORCHESTRATOR}/instances/{INSTANCE_ID}/watch",
+                params={
+                    "wait_for": self.__required_properties,
+                    "timeout": WATCH_TIMEOUT,
+                },
+                timeout=WATCH_TIMEOUT + 10,
             ).json()
             if instance_body["ok"] == False:
                 raise Exception("oops")
@@ -26,7 +36,6 @@ class Daemon(abc.ABC):
             if any(
                 [v not in user_data["metadata"] for v in self.__required_properties]
             ):
-                time.sleep(1)
                 continue
 
             break
@@ -45,3 +54,178 @@ class Daemon(abc.ABC):
     @abc.abstractmethod
     def _run(self, user_data: UserData):
         pass
+
+
+BlockHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+LogHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class AsyncDaemon(Daemon):
+    def __init__(self, required_properties: List[str] = [], anvil_id: str = "main"):
+        super().__init__(required_properties)
+
+        self.__anvil_id = anvil_id
+        self.__block_handlers: List[BlockHandler] = []
+        self.__log_handlers: List[Tuple[Dict[str, Any], LogHandler]] = []
+
+        self.__ws: websockets.WebSocketClientProtocol = None
+        self.__next_id = 0
+        self.__batch: List[Dict[str, Any]] = []
+        self.__pending: Dict[int, asyncio.Future] = {}
+        self.__subscribing: Dict[int, List[BlockHandler]] = {}
+        self.__subscriptions: Dict[str, List[BlockHandler]] = {}
+        self.__tasks: Set[asyncio.Task] = set()
+
+    def on_block(self, handler: BlockHandler):
+        self.__block_handlers.append(handler)
+
+    def on_logs(self, filter: Dict[str, Any], handler: LogHandler):
+        self.__log_handlers.append((filter, handler))
+
+    async def call(self, method: str, params: List[Any] = []) -> Any:
+        return await self.__request(method, params)
+
+    def __request(
+        self, method: str, params: List[Any], handlers: List[BlockHandler] = None
+    ) -> asyncio.Future:
+        # every request made before control returns to the event loop goes out
+        # in the same json-rpc batch, so handlers reacting to one block share a
+        # single round-trip
+        if len(self.__batch) == 0:
+            asyncio.get_running_loop().call_soon(self.__flush)
+
+        self.__next_id += 1
+        result = asyncio.get_running_loop().create_future()
+        self.__pending[self.__next_id] = result
+        if handlers is not None:
+            self.__subscribing[self.__next_id] = handlers
+        self.__batch.append(
+            {
+                "jsonrpc": "2.0",
+                "id": self.__next_id,
+                "method": method,
+                "params": params,
+            }
+        )
+
+        return result
+
+    def _run(self, user_data: UserData):
+        asyncio.run(self.__serve(user_data))
+
+    @abc.abstractmethod
+    async def _setup(self, user_data: UserData):
+        pass
+
+    async def __serve(self, user_data: UserData):
+        await self._setup(user_data)
+
+        anvil_instance = user_data["anvil_instances"][self.__anvil_id]
+        url = f"ws://{anvil_instance['ip']}:{anvil_instance['port']}"
+
+        while True:
+            reader = None
+            try:
+                async with websockets.connect(url, max_size=None) as ws:
+                    self.__ws = ws
+                    reader = asyncio.create_task(self.__read())
+                    await self.__subscribe()
+                    await reader
+            except (OSError, websockets.ConnectionClosed) as e:
+                logging.warning("lost connection to %s, reconnecting", url, exc_info=e)
+            finally:
+                if reader is not None:
+                    reader.cancel()
+                self.__ws = None
+                self.__batch = []
+                self.__fail_pending(ConnectionError("connection to anvil lost"))
+
+            await asyncio.sleep(1)
+
+    async def __subscribe(self):
+        self.__subscribing = {}
+        self.__subscriptions = {}
+
+        subscriptions = []
+        if len(self.__block_handlers) > 0:
+            subscriptions.append(
+                (
+                    ["newHeads"],
+                    self.__request("eth_subscribe", ["newHeads"], self.__block_handlers),
+                )
+            )
+        for filter, handler in self.__log_handlers:
+            subscriptions.append(
+                (
+                    ["logs", filter],
+                    self.__request("eth_subscribe", ["logs", filter], [handler]),
+                )
+            )
+
+        results = await asyncio.gather(
+            *[result for _, result in subscriptions], return_exceptions=True
+        )
+        for (params, _), result in zip(subscriptions, results):
+            # lost connections are retried, anything else is a subscription
+            # anvil will never accept, so the daemon stops instead of retrying
+            # it forever
+            if isinstance(result, (OSError, websockets.ConnectionClosed)):
+                raise result
+            if isinstance(result, Exception):
+                raise Exception("anvil rejected subscription", params, result)
+
+    def __flush(self):
+        batch, self.__batch = self.__batch, []
+        if self.__ws is None:
+            self.__fail_pending(ConnectionError("not connected to anvil"))
+            return
+
+        self.__spawn(self.__ws.send(json.dumps(batch)))
+
+    async def __read(self):
+        try:
+            await self.__read_messages()
+        finally:
+            # nothing is going to answer them anymore
+            self.__fail_pending(ConnectionError("connection to anvil lost"))
+
+    async def __read_messages(self):
+        async for message in self.__ws:
+            body = json.loads(message)
+            for response in body if isinstance(body, list) else [body]:
+                if response.get("method") == "eth_subscription":
+                    handlers = self.__subscriptions.get(response["params"]["subscription"], [])
+                    for handler in handlers:
+                        self.__spawn(handler(response["params"]["result"]))
+                    continue
+
+                # registered straight away, notifications can follow the
+                # subscription response in the very next frame
+                handlers = self.__subscribing.pop(response.get("id"), None)
+                if handlers is not None and "result" in response:
+                    self.__subscriptions[response["result"]] = handlers
+
+                result = self.__pending.pop(response.get("id"), None)
+                if result is None or result.done():
+                    continue
+
+                if "error" in response:
+                    result.set_exception(Exception("rpc exception", response["error"]))
+                else:
+                    result.set_result(response["result"])
+
+    def __fail_pending(self, error: Exception):
+        pending, self.__pending = self.__pending, {}
+        for result in pending.values():
+            if not result.done():
+                result.set_exception(error)
+
+    def __spawn(self, coro: Awaitable[None]):
+        task = asyncio.create_task(coro)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__on_task_done)
+
+    def __on_task_done(self, task: asyncio.Task):
+        self.__tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("daemon task failed", exc_info=task.exception())
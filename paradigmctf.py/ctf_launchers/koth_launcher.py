@@ -1,32 +1,39 @@
-from typing import List
+from typing import Dict, List, Optional
 
-import requests
-from ctf_launchers.launcher import CHALLENGE, ORCHESTRATOR_HOST, Action, Launcher
+from ctf_launchers.launcher import (
+    CHALLENGE,
+    ORCHESTRATOR_HOST,
+    Action,
+    Launcher,
+    get_orchestrator_session,
+)
 from ctf_launchers.score_submitter import ScoreSubmitter, get_score_submitter
-from ctf_launchers.team_provider import TeamProvider, get_team_provider
+from ctf_launchers.team_provider import TeamProvider
 from ctf_server.types import UserData, get_privileged_web3
-from eth_abi import abi
 
 
 class KothChallengeLauncher(Launcher):
     def __init__(
         self,
         project_location: str = "challenge/project",
-        provider: TeamProvider = get_team_provider(),
-        submitter: ScoreSubmitter = get_score_submitter(),
+        provider: Optional[TeamProvider] = None,
+        submitter: Optional[ScoreSubmitter] = None,
         want_metadata: List[str] = [],
     ):
         super().__init__(
+            'ethereum',
             project_location,
             provider,
             actions=[Action(name="submit score", handler=self.submit_score)],
         )
 
-        self.__score_submitter = submitter
+        self.__score_submitter = (
+            submitter if submitter is not None else get_score_submitter()
+        )
         self.__want_metadata = want_metadata
 
     def submit_score(self) -> int:
-        instance_body = requests.get(
+        instance_body = get_orchestrator_session().get(
             f"{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}"
         ).json()
         if not instance_body["ok"]:
@@ -35,9 +42,16 @@ class KothChallengeLauncher(Launcher):
 
         user_data = instance_body['data']
 
-        score = self.get_score(
-            user_data, user_data['metadata']["challenge_address"]
-        )
+        # the orchestrator keeps scoring every instance, unless the challenge
+        # brings its own scoring
+        score = None
+        if type(self).get_score is KothChallengeLauncher.get_score:
+            score = self.__get_scored()
+
+        if score is None:
+            score = self.get_score(
+                user_data, user_data['metadata']["challenge_address"]
+            )
 
         print("submitting score", score)
         data = {}
@@ -48,7 +62,21 @@ class KothChallengeLauncher(Launcher):
 
         return 0
 
-    def get_score(self, user_data: UserData, addr: str) -> bool:
+    def get_instance_metadata(self) -> Dict[str, str]:
+        return {"koth": CHALLENGE, "team": self.team}
+
+    def __get_scored(self) -> Optional[int]:
+        body = get_orchestrator_session().get(
+            f"{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}/score"
+        ).json()
+        if not body["ok"]:
+            return None
+
+        return body["data"]["score"]
+
+    def get_score(self, user_data: UserData, addr: str) -> int:
+        from eth_abi import abi
+
         web3 = get_privileged_web3(user_data, "main")
 
         (result,) = abi.decode(
@@ -1,30 +1,80 @@
 import abc
+import hashlib
 import os
+import sys
+import time
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Callable, Dict, List
-import requests
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
 import json
 
-import requests
-from ctf_launchers.team_provider import TeamProvider
+from ctf_launchers.team_provider import TeamProvider, get_team_provider
+from ctf_launchers.artifacts import hash_project, prepare_artifacts
 from ctf_launchers.utils import deploy, deploy_cairo, deploy_nitro, http_url_to_ws
+from ctf_server.providers import get_provider_registry
 from ctf_server.types import (
+    DEFAULT_ACCOUNTS,
+    DEFAULT_BALANCE,
     CreateInstanceRequest,
     DaemonInstanceArgs,
     LaunchAnvilInstanceArgs,
+    Snapshot,
     UserData,
+    get_account,
     get_player_account,
     get_privileged_web3,
 )
-from eth_account.hdaccount import generate_mnemonic
+from foundry.anvil import anvil_dumpState, anvil_setBalance
+
+if TYPE_CHECKING:
+    import requests
 
 CHALLENGE = os.getenv("CHALLENGE", "challenge")
 ORCHESTRATOR_HOST = os.getenv("ORCHESTRATOR_HOST", "http://orchestrator:7283")
 PUBLIC_HOST = os.getenv("PUBLIC_HOST", "http://127.0.0.1:8545")
 
 ETH_RPC_URL = os.getenv("ETH_RPC_URL")
+# connections kept open to the orchestrator, shared by every launcher served by
+# this process
+ORCHESTRATOR_POOL_SIZE = int(os.getenv("ORCHESTRATOR_POOL_SIZE", "32"))
 TIMEOUT = int(os.getenv("TIMEOUT", "720"))
+QUEUE_POLL_INTERVAL = 1
+
+# challenges whose deployment doesn't depend on the player can be deployed
+# once with a canonical mnemonic and then loaded into every instance, with the
+# instance's own accounts funded on top. the mnemonic has to stay secret, the
+# system account derived from it is the same in every instance, so snapshots
+# are off without one
+SNAPSHOT_MNEMONIC = os.getenv("SNAPSHOT_MNEMONIC")
+SNAPSHOT_STATE = (
+    os.getenv("SNAPSHOT_STATE", "false") == "true" and SNAPSHOT_MNEMONIC is not None
+)
+
+_orchestrator_session = None
+_orchestrator_session_lock = Lock()
+
+# shared by every launch in the process, compilations queue on the artifacts
+# lock anyway, the extra workers only let the project hashing overlap
+compile_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="compile")
+
+
+def get_orchestrator_session() -> "requests.Session":
+    global _orchestrator_session
+
+    with _orchestrator_session_lock:
+        if _orchestrator_session is None:
+            import requests
+
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=ORCHESTRATOR_POOL_SIZE
+            )
+            _orchestrator_session = requests.Session()
+            _orchestrator_session.mount("http://", adapter)
+            _orchestrator_session.mount("https://", adapter)
+
+        return _orchestrator_session
 
 
 @dataclass
@@ -35,24 +85,29 @@ class Action:
 
 class Launcher(abc.ABC):
     def __init__(
-        self, type: str, project_location: str, provider: TeamProvider, actions: List[Action] = []
+        self, type: str, project_location: str, provider: Optional[TeamProvider], actions: List[Action] = []
     ):
         self.type = type
         self.project_location = project_location
-        self.__team_provider = provider
+        self.__project_hash: Optional[str] = None
+        self.__team_provider = provider if provider is not None else get_team_provider()
 
         self._actions = [
             Action(name="launch new instance", handler=self.launch_instance),
             Action(name="kill instance", handler=self.kill_instance),
         ] + actions
 
+        # last, so that the challenge actions keep their numbers
+        if type == "ethereum":
+            self._actions.append(
+                Action(name="reset instance", handler=self.reset_instance)
+            )
+
     def run(self):
         self.team = self.__team_provider.get_team()
         if not self.team:
             exit(1)
 
-        self.mnemonic = generate_mnemonic(12, lang="english")
-
         for i, action in enumerate(self._actions):
             print(f"{i+1} - {action.name}")
 
@@ -62,6 +117,11 @@ class Launcher(abc.ABC):
             print("can you not")
             exit(1)
 
+        # eth_account is slow to import, so only once an action was picked
+        from eth_account.hdaccount import generate_mnemonic
+
+        self.mnemonic = generate_mnemonic(12, lang="english")
+
         try:
             exit(handler.handler())
         except Exception as e:
@@ -90,11 +150,14 @@ class Launcher(abc.ABC):
             **kwargs,
         )
 
+    def get_instance_metadata(self) -> Dict[str, str]:
+        return {}
+
     def get_instance_id(self) -> str:
         return f"chal-{CHALLENGE}-{self.team}".lower()
 
     def update_metadata(self, new_metadata: Dict[str, str]):
-        resp = requests.post(
+        resp = get_orchestrator_session().post(
             f"{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}/metadata",
             json=new_metadata,
         )
@@ -103,22 +166,106 @@ class Launcher(abc.ABC):
             print(body["message"])
             return 1
 
-    def launch_instance(self) -> int:
-        print("creating private blockchain...")
-        body = requests.post(
-            f"{ORCHESTRATOR_HOST}/instances",
-            json=CreateInstanceRequest(
-                type=self.type,
-                instance_id=self.get_instance_id(),
-                timeout=TIMEOUT,
-                anvil_instances=self.get_anvil_instances(),
-                daemon_instances=self.get_daemon_instances(),
-            ),
+    def get_solve_status(self) -> Optional[bool]:
+        body = get_orchestrator_session().post(
+            f"{ORCHESTRATOR_HOST}/solves",
+            json={"instance_ids": [self.get_instance_id()]},
         ).json()
-        if body["ok"] == False:
+        if not body["ok"]:
+            return None
+
+        status = body["data"].get(self.get_instance_id())
+        if status is None:
+            return None
+
+        return status["solved"]
+
+    def get_snapshot_key(self, anvil_instances: Dict[str, LaunchAnvilInstanceArgs]) -> str:
+        # a rotated mnemonic or differently configured chains must not pick up
+        # state deployed for the old ones. the instance's own mnemonic is left
+        # out, its accounts are funded on top of the state
+        chains = {
+            anvil_id: {k: v for k, v in args.items() if k not in ["mnemonic", "snapshot"]}
+            for anvil_id, args in anvil_instances.items()
+        }
+
+        digest = hashlib.sha256()
+        digest.update(SNAPSHOT_MNEMONIC.encode("utf8"))
+        digest.update(json.dumps(chains, sort_keys=True).encode("utf8"))
+        return f"{CHALLENGE}-{self.get_project_hash()}-{digest.hexdigest()[:16]}"
+
+    def get_deployment_args_hash(self, user_data: UserData) -> str:
+        # only known once the instance exists, so it's checked against the
+        # snapshot afterwards rather than being part of its key
+        return hashlib.sha256(
+            json.dumps(self.get_deployment_args(user_data), sort_keys=True).encode("utf8")
+        ).hexdigest()
+
+    def get_project_hash(self) -> str:
+        # hashing reads the whole project including lib/, so it happens once
+        # per launch and is shared by the snapshot key, compilation and deploy
+        if self.__project_hash is None:
+            self.__project_hash = hash_project(self.project_location)
+
+        return self.__project_hash
+
+    def get_snapshot(self, key: str) -> Optional[Dict]:
+        body = get_orchestrator_session().get(
+            f"{ORCHESTRATOR_HOST}/snapshots/{key}"
+        ).json()
+        if not body["ok"]:
+            return None
+
+        return body["data"]
+
+    def put_snapshot(self, key: str, state: str, metadata: Dict[str, str]):
+        body = get_orchestrator_session().put(
+            f"{ORCHESTRATOR_HOST}/snapshots/{key}",
+            json=Snapshot(state=state, metadata=metadata),
+        ).json()
+        if not body["ok"]:
             raise Exception(body["message"])
 
-        user_data = body["data"]
+    def launch_instance(self) -> int:
+        print("creating private blockchain...")
+
+        self.__project_hash = None
+
+        use_snapshot = SNAPSHOT_STATE and self.type == "ethereum"
+
+        snapshot = None
+        anvil_instances = self.get_anvil_instances()
+        if use_snapshot:
+            snapshot_key = self.get_snapshot_key(anvil_instances)
+            snapshot = self.get_snapshot(snapshot_key)
+            if snapshot is not None:
+                anvil_instances["main"]["snapshot"] = snapshot_key
+
+        # the project compiles while the orchestrator boots and funds the
+        # chain, leaving only the broadcast once it's ready
+        compilation = None
+        if self.type == "ethereum" and snapshot is None:
+            compilation = compile_executor.submit(self.__prepare_artifacts)
+
+        user_data = self.__create_instance(anvil_instances)
+
+        if snapshot is not None and snapshot["metadata"].get(
+            "deployment_args"
+        ) != self.get_deployment_args_hash(user_data):
+            # deployed with other arguments, start over without it and replace
+            # it with a fresh deployment
+            print("challenge snapshot is outdated, redeploying...")
+            get_orchestrator_session().delete(
+                f"{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}"
+            )
+
+            snapshot = None
+            del anvil_instances["main"]["snapshot"]
+            compilation = compile_executor.submit(self.__prepare_artifacts)
+            user_data = self.__create_instance(anvil_instances)
+
+        if compilation is not None:
+            self.__wait_for_compilation(compilation)
 
         print("deploying challenge...")
 
@@ -132,14 +279,40 @@ class Launcher(abc.ABC):
         elif self.type == "nitro":
             challenge_addr = self.deploy_nitro(user_data, self.mnemonic)
             priv_key = get_player_account(self.mnemonic).key.hex()
+        elif snapshot is not None:
+            challenge_addr = snapshot["metadata"]["challenge_address"]
+            priv_key = get_player_account(self.mnemonic).key.hex()
+        elif use_snapshot:
+            self.__fund_snapshot_accounts(user_data, anvil_instances["main"])
+            challenge_addr = self.deploy(user_data, SNAPSHOT_MNEMONIC)
+            priv_key = get_player_account(self.mnemonic).key.hex()
+
+            self.put_snapshot(
+                snapshot_key,
+                anvil_dumpState(get_privileged_web3(user_data, "main")),
+                {
+                    "challenge_address": challenge_addr,
+                    "deployment_args": self.get_deployment_args_hash(user_data),
+                },
+            )
         else:
             challenge_addr = self.deploy(user_data, self.mnemonic)
             priv_key = get_player_account(self.mnemonic).key.hex()
 
         self.update_metadata(
-            {"mnemonic": self.mnemonic, "challenge_address": challenge_addr}
+            {
+                "mnemonic": self.mnemonic,
+                "challenge_address": challenge_addr,
+                "type": self.type,
+                "challenge": CHALLENGE,
+            }
+            | self.get_instance_metadata()
         )
 
+        # lets the player go back to this point later without relaunching
+        if self.type == "ethereum":
+            self.checkpoint_instance()
+
         PUBLIC_WEBSOCKET_HOST = http_url_to_ws(PUBLIC_HOST)
 
         print()
@@ -160,20 +333,97 @@ class Launcher(abc.ABC):
         print(f"challenge contract: {challenge_addr}")
         return 0
 
+    def __create_instance(
+        self, anvil_instances: Dict[str, LaunchAnvilInstanceArgs]
+    ) -> UserData:
+        request = CreateInstanceRequest(
+            type=self.type,
+            instance_id=self.get_instance_id(),
+            timeout=TIMEOUT,
+            anvil_instances=anvil_instances,
+            daemon_instances=self.get_daemon_instances(),
+            team=self.team,
+            challenge=CHALLENGE,
+        )
+
+        while True:
+            body = get_orchestrator_session().post(
+                f"{ORCHESTRATOR_HOST}/instances", json=request
+            ).json()
+            if not body.get("queued", False):
+                break
+
+            # the orchestrator is at capacity, keep our place in the queue
+            queue = body["data"]
+            message = f"waiting for capacity, position {queue['position']} of {queue['depth']}"
+            if queue["estimated_wait"] is not None:
+                message += f" (about {round(queue['estimated_wait'])}s)"
+            print(message)
+
+            time.sleep(QUEUE_POLL_INTERVAL)
+
+        if body["ok"] == False:
+            raise Exception(body["message"])
+
+        return body["data"]
+
+    def __fund_snapshot_accounts(self, user_data: UserData, args: LaunchAnvilInstanceArgs):
+        # the canonical deployment runs from the snapshot mnemonic's accounts,
+        # the orchestrator only funded the instance's own
+        web3 = get_privileged_web3(user_data, "main")
+        for i in range(args.get("accounts") or DEFAULT_ACCOUNTS):
+            anvil_setBalance(
+                web3,
+                get_account(SNAPSHOT_MNEMONIC, i).address,
+                hex(int((args.get("balance") or DEFAULT_BALANCE) * 10**18)),
+            )
+
+    def __prepare_artifacts(self):
+        # the launch only reads the hash again after waiting for this, so the
+        # two threads never race on it
+        prepare_artifacts(self.project_location, project_hash=self.get_project_hash())
+
+    def __wait_for_compilation(self, compilation: Future):
+        try:
+            compilation.result()
+        except Exception as e:
+            # not fatal here, deploying compiles again and reports the error
+            print("failed to compile challenge ahead of time:", e, file=sys.stderr)
+
     def kill_instance(self) -> int:
-        resp = requests.delete(
+        resp = get_orchestrator_session().delete(
             f"{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}")
         body = resp.json()
 
+        get_provider_registry().evict(self.get_instance_id())
+
         print(body["message"])
         return 1
 
+    def checkpoint_instance(self):
+        body = get_orchestrator_session().post(
+            f"{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}/checkpoint"
+        ).json()
+        if not body["ok"]:
+            # not fatal, the instance just can't be reset
+            print("failed to checkpoint instance:", body["message"], file=sys.stderr)
+
+    def reset_instance(self) -> int:
+        print("resetting instance...")
+
+        body = get_orchestrator_session().post(
+            f"{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}/reset"
+        ).json()
+
+        print(body["message"])
+        return 0 if body["ok"] else 1
+
     def deploy(self, user_data: UserData, mnemonic: str) -> str:
         web3 = get_privileged_web3(user_data, "main")
 
         return deploy(
             web3, self.project_location, mnemonic, env=self.get_deployment_args(
-                user_data)
+                user_data), project_hash=self.get_project_hash()
         )
 
     def deploy_cairo(self, user_data: UserData, credentials: list) -> str:
@@ -193,6 +443,8 @@ class Launcher(abc.ABC):
         return {}
 
     def get_credentials(self, url: str) -> list:
+        import requests
+
         x = requests.get(url + '/predeployed_accounts')
         data = json.loads(x.text)
 
@@ -0,0 +1,359 @@
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import time
+import uuid
+from dataclasses import dataclass
+from threading import Lock
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+if TYPE_CHECKING:
+    import requests
+
+# on the volume of the kctf-challenge image, shared by every launcher in the
+# pod and the worker, which has to outlive restarts for queued scores to
+SCORE_SPOOL_PATH = os.getenv("SCORE_SPOOL_PATH", "/paradigm/scores/score-spool.db")
+SCORE_BATCH_SIZE = int(os.getenv("SCORE_BATCH_SIZE", "32"))
+SCORE_LEASE = float(os.getenv("SCORE_LEASE", "60"))
+SCORE_MAX_ATTEMPTS = int(os.getenv("SCORE_MAX_ATTEMPTS", "30"))
+SCORE_BACKOFF_MIN = 1
+SCORE_BACKOFF_MAX = 300
+SCORE_POLL_INTERVAL = 1
+# (connect, read) timeouts
+SCORE_SUBMIT_TIMEOUT = (3, 10)
+# the player waits on the first attempt, anything slower is left to the worker
+SCORE_ACK_TIMEOUT = (1, 2)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions
+(
+    id VARCHAR PRIMARY KEY,
+    host VARCHAR NOT NULL,
+    team_id VARCHAR NOT NULL,
+    challenge_id VARCHAR,
+    data VARCHAR NOT NULL,
+    score VARCHAR NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    claimed_until REAL NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    last_error VARCHAR
+);
+
+CREATE INDEX IF NOT EXISTS submissions_next_attempt_at ON submissions (next_attempt_at);
+
+CREATE TABLE IF NOT EXISTS stats
+(
+    name VARCHAR PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+
+class PermanentSubmitError(Exception):
+    pass
+
+
+class BatchesUnsupportedError(Exception):
+    pass
+
+
+@dataclass
+class Submission:
+    id: str
+    host: str
+    team_id: str
+    challenge_id: Optional[str]
+    data: Any
+    score: int
+    created_at: float
+    attempts: int
+
+
+class ScoreSpool:
+    def __init__(self, path: str = SCORE_SPOOL_PATH):
+        self.__lock = Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.__conn = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self.__conn.execute("PRAGMA journal_mode = WAL")
+        # submissions are acknowledged to players once written, so they have to
+        # survive a crash
+        self.__conn.execute("PRAGMA synchronous = FULL")
+        self.__conn.executescript(SCHEMA)
+
+    def enqueue(
+        self, host: str, team_id: str, challenge_id: Optional[str], data: Any, score: int
+    ) -> str:
+        # doubles as the idempotency key, so retries of a submission which did
+        # reach the platform aren't counted twice
+        id = uuid.uuid4().hex
+        now = time.time()
+
+        with self.__lock:
+            self.__conn.execute(
+                """INSERT INTO submissions(id, host, team_id, challenge_id, data, score, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (id, host, team_id, challenge_id, json.dumps(data), str(score), now, now),
+            )
+
+        return id
+
+    def claim(self, limit: int, lease: float) -> List[Submission]:
+        now = time.time()
+
+        with self.__lock:
+            rows = self.__conn.execute(
+                """UPDATE submissions SET claimed_until = ? WHERE id IN (SELECT id FROM submissions WHERE failed = 0 AND next_attempt_at <= ? AND claimed_until <= ? ORDER BY next_attempt_at LIMIT ?) RETURNING id, host, team_id, challenge_id, data, score, created_at, attempts""",
+                (now + lease, now, now, limit),
+            ).fetchall()
+
+        return [self.__load_submission(row) for row in rows]
+
+    def claim_one(self, id: str, lease: float) -> Optional[Submission]:
+        now = time.time()
+
+        with self.__lock:
+            row = self.__conn.execute(
+                """UPDATE submissions SET claimed_until = ? WHERE id = ? AND failed = 0 AND claimed_until <= ? RETURNING id, host, team_id, challenge_id, data, score, created_at, attempts""",
+                (now + lease, id, now),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return self.__load_submission(row)
+
+    def ack(self, submission: Submission):
+        with self.__lock:
+            self.__conn.execute("""DELETE FROM submissions WHERE id = ?""", (submission.id,))
+
+        self.__record("submitted", 1)
+        self.__record("submit_latency_seconds_sum", time.time() - submission.created_at)
+
+    def retry(self, submission: Submission, error: str, permanent: bool = False):
+        attempts = submission.attempts + 1
+        failed = permanent or attempts >= SCORE_MAX_ATTEMPTS
+
+        # exponential backoff with full jitter
+        delay = random.uniform(
+            SCORE_BACKOFF_MIN, min(SCORE_BACKOFF_MIN * 2**attempts, SCORE_BACKOFF_MAX)
+        )
+
+        with self.__lock:
+            self.__conn.execute(
+                """UPDATE submissions SET attempts = ?, next_attempt_at = ?, claimed_until = 0, failed = ?, last_error = ? WHERE id = ?""",
+                (attempts, time.time() + delay, int(failed), error, submission.id),
+            )
+
+        self.__record("failed" if failed else "retried", 1)
+
+    def stats(self) -> Dict[str, float]:
+        with self.__lock:
+            stats = dict(self.__conn.execute("""SELECT name, value FROM stats"""))
+            pending, failed = self.__conn.execute(
+                """SELECT COUNT(*) - COALESCE(SUM(failed), 0), COALESCE(SUM(failed), 0) FROM submissions"""
+            ).fetchone()
+
+        stats["queue_depth"] = pending
+        stats["failed_depth"] = failed
+        if stats.get("submitted", 0) > 0:
+            stats["submit_latency_seconds_avg"] = (
+                stats["submit_latency_seconds_sum"] / stats["submitted"]
+            )
+        return stats
+
+    def __load_submission(self, row) -> Submission:
+        id, host, team_id, challenge_id, data, score, created_at, attempts = row
+        return Submission(
+            id=id,
+            host=host,
+            team_id=team_id,
+            challenge_id=challenge_id,
+            data=json.loads(data),
+            score=int(score),
+            created_at=created_at,
+            attempts=attempts,
+        )
+
+    def __record(self, name: str, value: float):
+        with self.__lock:
+            self.__conn.execute(
+                """INSERT INTO stats(name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value""",
+                (name, value),
+            )
+
+
+class ScoreWorker:
+    def __init__(self, spool: ScoreSpool):
+        self.__spool = spool
+        self.__session = None
+        # platforms without the batch endpoint get one request per submission
+        self.__batches_supported = True
+
+    def run(self):
+        while True:
+            try:
+                if self.drain() == 0:
+                    time.sleep(SCORE_POLL_INTERVAL)
+            except Exception as e:
+                logging.error("failed to drain score spool", exc_info=e)
+                time.sleep(SCORE_POLL_INTERVAL)
+
+    def drain(self) -> int:
+        batch = self.__spool.claim(SCORE_BATCH_SIZE, SCORE_LEASE)
+
+        # launchers of different environments can share a spool
+        by_host: Dict[str, List[Submission]] = {}
+        for submission in batch:
+            by_host.setdefault(submission.host, []).append(submission)
+
+        for host, submissions in by_host.items():
+            if self.__batches_supported:
+                self.submit_batch(host, submissions)
+            else:
+                for submission in submissions:
+                    self.submit(submission)
+
+        return len(batch)
+
+    def submit_batch(self, host: str, submissions: List[Submission]):
+        try:
+            results = self.__submit_batch(host, submissions)
+        except BatchesUnsupportedError:
+            self.__batches_supported = False
+            for submission in submissions:
+                self.submit(submission)
+            return
+        except PermanentSubmitError as e:
+            logging.error("score batch was rejected: %s", e)
+            for submission in submissions:
+                self.__spool.retry(submission, str(e), permanent=True)
+            return
+        except Exception as e:
+            logging.warning("failed to submit score batch: %s", e)
+            for submission in submissions:
+                self.__spool.retry(submission, str(e))
+            return
+
+        for submission in submissions:
+            result = results.get(submission.id)
+            if result is None:
+                self.__spool.retry(submission, "missing from batch response")
+            elif not result["ok"]:
+                logging.error("score %s was rejected: %s", submission.id, result["message"])
+                self.__spool.retry(submission, result["message"], permanent=True)
+            else:
+                self.__spool.ack(submission)
+
+    def submit(self, submission: Submission, timeout=SCORE_SUBMIT_TIMEOUT) -> bool:
+        try:
+            self.__submit(submission, timeout)
+        except PermanentSubmitError as e:
+            logging.error("score %s was rejected: %s", submission.id, e)
+            self.__spool.retry(submission, str(e), permanent=True)
+            return False
+        except Exception as e:
+            logging.warning("failed to submit score %s: %s", submission.id, e)
+            self.__spool.retry(submission, str(e))
+            return False
+
+        self.__spool.ack(submission)
+        return True
+
+    def __submit(self, submission: Submission, timeout):
+        resp = self.__post(
+            f"{submission.host}/api/internal/submit",
+            self.__format_submission(submission),
+            timeout,
+            {"Idempotency-Key": submission.id},
+        )
+        self.__check_status(resp)
+
+        body = resp.json()
+        if not body["ok"]:
+            raise Exception("failed to submit score", body["message"])
+
+    def __submit_batch(self, host: str, submissions: List[Submission]) -> Dict[str, Dict]:
+        # every entry carries its own idempotency key, the platform answers
+        # with a result per id
+        resp = self.__post(
+            f"{host}/api/internal/submit-batch",
+            {
+                "submissions": [
+                    {"id": submission.id} | self.__format_submission(submission)
+                    for submission in submissions
+                ]
+            },
+            SCORE_SUBMIT_TIMEOUT,
+        )
+        if resp.status_code == 404:
+            raise BatchesUnsupportedError()
+        self.__check_status(resp)
+
+        body = resp.json()
+        if not body["ok"]:
+            raise Exception("failed to submit score batch", body["message"])
+
+        return body["data"]
+
+    def __post(
+        self, url: str, body: Dict, timeout, headers: Dict[str, str] = {}
+    ) -> "requests.Response":
+        if self.__session is None:
+            import requests
+
+            self.__session = requests.Session()
+
+        return self.__session.post(
+            url,
+            headers={
+                "Authorization": f"Bearer {os.getenv('SECRET')}",
+                "Content-Type": "application/json",
+            }
+            | headers,
+            json=body,
+            timeout=timeout,
+        )
+
+    def __check_status(self, resp: "requests.Response"):
+        # anything but a rate limit on the client side won't go away by retrying
+        if 400 <= resp.status_code < 500 and resp.status_code != 429:
+            raise PermanentSubmitError(f"http {resp.status_code}: {resp.text}")
+        resp.raise_for_status()
+
+    def __format_submission(self, submission: Submission) -> Dict:
+        return {
+            "teamId": submission.team_id,
+            "challengeId": submission.challenge_id,
+            "data": submission.data,
+            "score": submission.score,
+        }
+
+
+_spool = None
+_spool_lock = Lock()
+
+
+def get_score_spool() -> ScoreSpool:
+    global _spool
+
+    with _spool_lock:
+        if _spool is None:
+            _spool = ScoreSpool()
+
+        return _spool
+
+
+if __name__ == "__main__":
+    # python -m ctf_launchers.score_queue [stats]
+    if sys.argv[1:] == ["stats"]:
+        print(json.dumps(get_score_spool().stats()))
+    else:
+        logging.root.setLevel(logging.INFO)
+        ScoreWorker(get_score_spool()).run()
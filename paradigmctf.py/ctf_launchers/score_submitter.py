@@ -2,7 +2,12 @@ import abc
 import os
 from typing import Any
 
-import requests
+from ctf_launchers.score_queue import (
+    SCORE_ACK_TIMEOUT,
+    SCORE_LEASE,
+    ScoreWorker,
+    get_score_spool,
+)
 
 
 class ScoreSubmitter(abc.ABC):
@@ -16,27 +21,19 @@ class RemoteScoreSubmitter(ScoreSubmitter):
         self.__host = host
 
     def submit_score(self, team_id: str, data: Any, score: int):
-        secret = os.getenv("SECRET")
-        challenge_id = os.getenv("CHALLENGE_ID")
-
-        resp = requests.post(
-            f"{self.__host}/api/internal/submit",
-            headers={
-                "Authorization": f"Bearer {secret}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "teamId": team_id,
-                "challengeId": challenge_id,
-                "data": data,
-                "score": score,
-            },
-        ).json()
-
-        if not resp["ok"]:
-            raise Exception("failed to submit score", resp["message"])
-
-        print(f"score successfully submitted (id={resp['id']})")
+        # spooled first, so a slow or unavailable platform doesn't lose
+        # scores. this submission gets one quick attempt while the player
+        # waits, retries and everything else queued are kctf_score_worker's
+        spool = get_score_spool()
+        id = spool.enqueue(self.__host, team_id, os.getenv("CHALLENGE_ID"), data, score)
+
+        submission = spool.claim_one(id, SCORE_LEASE)
+        if submission is not None and ScoreWorker(spool).submit(
+            submission, SCORE_ACK_TIMEOUT
+        ):
+            print("score successfully submitted")
+        else:
+            print(f"score successfully queued, it will be submitted shortly (id={id})")
 
 
 class LocalScoreSubmitter(ScoreSubmitter):
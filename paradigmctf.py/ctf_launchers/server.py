@@ -0,0 +1,139 @@
+import asyncio
+import contextvars
+import importlib
+import io
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TextIO
+
+from ctf_launchers.launcher import Launcher
+
+LAUNCHER_SERVER = os.getenv("LAUNCHER_SERVER", "false") == "true"
+LAUNCHER_HOST = os.getenv("LAUNCHER_HOST", "0.0.0.0")
+LAUNCHER_PORT = int(os.getenv("LAUNCHER_PORT", "1337"))
+# connections beyond this wait for a free worker before seeing the menu
+LAUNCHER_MAX_CONNECTIONS = int(os.getenv("LAUNCHER_MAX_CONNECTIONS", "64"))
+LAUNCHER_INPUT_TIMEOUT = float(os.getenv("LAUNCHER_INPUT_TIMEOUT", "120"))
+
+
+class Connection:
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        self.__loop = loop
+        self.__reader = reader
+        self.__writer = writer
+
+    def write(self, data: str):
+        self.__loop.call_soon_threadsafe(self.__writer.write, data.encode("utf8"))
+
+    def readline(self) -> str:
+        line = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self.__reader.readline(), LAUNCHER_INPUT_TIMEOUT),
+            self.__loop,
+        ).result()
+
+        return line.decode("utf8", errors="replace")
+
+
+_connection: contextvars.ContextVar[Optional[Connection]] = contextvars.ContextVar(
+    "connection", default=None
+)
+
+
+# stands in for sys.stdin and sys.stdout, so that the print() and input() calls
+# made by launchers reach whichever connection the calling thread is serving
+class ConnectionStream(io.TextIOBase):
+    def __init__(self, fallback: TextIO):
+        self.__fallback = fallback
+
+    def write(self, data: str) -> int:
+        connection = _connection.get()
+        if connection is None:
+            return self.__fallback.write(data)
+
+        connection.write(data)
+        return len(data)
+
+    def readline(self, size: int = -1) -> str:
+        connection = _connection.get()
+        if connection is None:
+            return self.__fallback.readline(size)
+
+        return connection.readline()
+
+    def flush(self):
+        if _connection.get() is None:
+            self.__fallback.flush()
+
+    def close(self):
+        # the exit() launchers call on their way out closes sys.stdin, which is
+        # shared by every connection
+        pass
+
+
+class LauncherServer:
+    def __init__(
+        self,
+        factory: Callable[[], Launcher],
+        max_connections: int = LAUNCHER_MAX_CONNECTIONS,
+    ):
+        self.__factory = factory
+        self.__executor = ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="launcher"
+        )
+
+    async def serve(self, host: str = LAUNCHER_HOST, port: int = LAUNCHER_PORT):
+        sys.stdin = ConnectionStream(sys.stdin)
+        sys.stdout = ConnectionStream(sys.stdout)
+
+        server = await asyncio.start_server(self.__handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def __handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        loop = asyncio.get_running_loop()
+
+        context = contextvars.copy_context()
+        context.run(_connection.set, Connection(loop, reader, writer))
+
+        try:
+            await loop.run_in_executor(self.__executor, context.run, self.__run)
+        except Exception as e:
+            logging.error("launcher connection failed", exc_info=e)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def __run(self):
+        # every connection gets its own launcher, exactly like a fresh process
+        # would, the launcher's exit() only ends this connection
+        try:
+            self.__factory().run()
+        except SystemExit:
+            pass
+
+
+def run_launcher(factory: Callable[[], Launcher]):
+    if not LAUNCHER_SERVER:
+        factory().run()
+        return
+
+    logging.root.setLevel(logging.INFO)
+    asyncio.run(LauncherServer(factory).serve())
+
+
+if __name__ == "__main__":
+    # python -m ctf_launchers.server challenge:Challenge
+    module_name, factory_name = sys.argv[1].split(":", 1)
+    run_launcher(getattr(importlib.import_module(module_name), factory_name))
@@ -1,8 +1,9 @@
 import os
 import json
-import requests
-from ctf_launchers.launcher import Action, Launcher, ORCHESTRATOR_HOST, CHALLENGE
-from ctf_launchers.team_provider import TeamProvider, get_team_provider
+from typing import Optional
+
+from ctf_launchers.launcher import Action, Launcher, ORCHESTRATOR_HOST, CHALLENGE, get_orchestrator_session
+from ctf_launchers.team_provider import TeamProvider
 from ctf_server.types import UserData, get_privileged_web3
 
 FLAG = os.getenv("FLAG", "PCTF{flag}")
@@ -12,7 +13,7 @@ class StarknetPwnChallengeLauncher(Launcher):
     def __init__(
         self,
         project_location: str = "challenge/project",
-        provider: TeamProvider = get_team_provider(),
+        provider: Optional[TeamProvider] = None,
     ):
         super().__init__(
             'starknet',
@@ -24,17 +25,27 @@ class StarknetPwnChallengeLauncher(Launcher):
         )
 
     def get_flag(self) -> int:
-        instance_body = requests.get(
-            f"{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}").json()
-        if not instance_body['ok']:
-            print(instance_body['message'])
-            return 1
+        # the orchestrator checks and caches solves, unless the challenge
+        # brings its own check
+        solved = None
+        if type(self).is_solved is StarknetPwnChallengeLauncher.is_solved:
+            solved = self.get_solve_status()
+
+        if solved is None:
+            instance_body = get_orchestrator_session().get(
+                f"{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}"
+            ).json()
+            if not instance_body['ok']:
+                print(instance_body['message'])
+                return 1
 
-        user_data = instance_body['data']
+            user_data = instance_body['data']
 
-        if not self.is_solved(
-            user_data, user_data['metadata']["challenge_address"]
-        ):
+            solved = self.is_solved(
+                user_data, user_data['metadata']["challenge_address"]
+            )
+
+        if not solved:
             print("are you sure you solved it?")
             return 1
 
@@ -42,6 +53,8 @@ class StarknetPwnChallengeLauncher(Launcher):
         return 0
 
     def is_solved(self, user_data: UserData, addr: str) -> bool:
+        import requests
+
         web3 = get_privileged_web3(user_data, "main")
 
         x = requests.post(web3.provider.endpoint_uri + "/rpc", json={
@@ -2,18 +2,48 @@ import abc
 import os
 import base64
 from dataclasses import dataclass
-from typing import Optional
+from threading import Lock
+from typing import TYPE_CHECKING, Optional
+
+from ctf_launchers.ticket_cache import get_ticket_cache
+
+if TYPE_CHECKING:
+    import requests
+
+TICKET_CHECK_URL = os.getenv(
+    "TICKET_CHECK_URL", "https://ctf.openzeppelin.com/api/v1/challenges/check-ticket/"
+)
+# (connect, read) timeouts, the platform being slow mustn't hang every launcher
+TICKET_CHECK_TIMEOUT = (3, 5)
 
-import requests
-from cryptography.fernet import Fernet
 
 def encrypt(message: bytes, key: bytes) -> bytes:
+    from cryptography.fernet import Fernet
+
     return Fernet(key).encrypt(message)
 
 def decrypt(token: bytes, key: bytes) -> bytes:
+    from cryptography.fernet import Fernet
+
     return Fernet(key).decrypt(token)
 
 
+_platform_session = None
+_platform_session_lock = Lock()
+
+
+def get_platform_session() -> "requests.Session":
+    global _platform_session
+
+    with _platform_session_lock:
+        if _platform_session is None:
+            import requests
+
+            _platform_session = requests.Session()
+
+        return _platform_session
+
+
 class TeamProvider(abc.ABC):
     @abc.abstractmethod
     def get_team(self) -> Optional[str]:
@@ -50,10 +80,7 @@ class TicketTeamProvider(TeamProvider):
         chall = decoded[0]
         id = decoded[1]
 
-        ticket_info = requests.get(
-            "https://ctf.openzeppelin.com/api/v1/challenges/check-ticket/" + id,
-        ).json()
-        if not ticket_info["data"] or not ticket_info["success"]:
+        if not self.__is_valid_team(id):
             return None
 
         return TicketTeamProvider.Ticket(
@@ -61,6 +88,34 @@ class TicketTeamProvider(TeamProvider):
             team_id=id,
         )
 
+    def __is_valid_team(self, id: str) -> bool:
+        cache = get_ticket_cache()
+
+        valid = cache.get(id)
+        if valid is not None:
+            cache.record("hits")
+            return valid
+
+        cache.record("misses")
+
+        try:
+            ticket_info = get_platform_session().get(
+                TICKET_CHECK_URL + id, timeout=TICKET_CHECK_TIMEOUT
+            ).json()
+        except Exception:
+            # fall back to an expired answer rather than locking everyone out
+            # while the platform is down
+            valid = cache.get(id, stale=True)
+            if valid is None:
+                raise
+
+            cache.record("stale_hits")
+            return valid
+
+        valid = bool(ticket_info["data"] and ticket_info["success"])
+        cache.put(id, valid)
+        return valid
+
 
 class StaticTeamProvider(TeamProvider):
     def __init__(self, team_id, ticket):
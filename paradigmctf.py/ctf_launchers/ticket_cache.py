@@ -0,0 +1,102 @@
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+from typing import Dict, Optional
+
+# kept under /tmp so that every launcher process on the host shares it
+TICKET_CACHE_PATH = os.getenv("TICKET_CACHE_PATH", "/tmp/ticket-cache.db")
+TICKET_CACHE_TTL = float(os.getenv("TICKET_CACHE_TTL", "600"))
+TICKET_CACHE_NEGATIVE_TTL = float(os.getenv("TICKET_CACHE_NEGATIVE_TTL", "15"))
+# valid tickets are still accepted for this long when the platform is down
+TICKET_CACHE_STALE_TTL = float(os.getenv("TICKET_CACHE_STALE_TTL", "3600"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets
+(
+    ticket_id VARCHAR PRIMARY KEY,
+    valid INTEGER NOT NULL,
+    checked_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stats
+(
+    name VARCHAR PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class TicketCache:
+    def __init__(self, path: str = TICKET_CACHE_PATH):
+        self.__lock = Lock()
+        self.__conn = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self.__conn.execute("PRAGMA journal_mode = WAL")
+        self.__conn.execute("PRAGMA synchronous = NORMAL")
+        self.__conn.executescript(SCHEMA)
+
+    def get(self, ticket_id: str, stale: bool = False) -> Optional[bool]:
+        with self.__lock:
+            row = self.__conn.execute(
+                """SELECT valid, checked_at FROM tickets WHERE ticket_id = ?""",
+                (ticket_id,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        valid, checked_at = bool(row[0]), row[1]
+        if stale:
+            ttl = TICKET_CACHE_STALE_TTL if valid else 0
+        else:
+            ttl = TICKET_CACHE_TTL if valid else TICKET_CACHE_NEGATIVE_TTL
+
+        if checked_at + ttl < time.time():
+            return None
+
+        return valid
+
+    def put(self, ticket_id: str, valid: bool):
+        with self.__lock:
+            self.__conn.execute(
+                """INSERT INTO tickets(ticket_id, valid, checked_at) VALUES (?, ?, ?) ON CONFLICT (ticket_id) DO UPDATE SET valid = excluded.valid, checked_at = excluded.checked_at""",
+                (ticket_id, int(valid), time.time()),
+            )
+
+    def record(self, name: str):
+        with self.__lock:
+            self.__conn.execute(
+                """INSERT INTO stats(name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1""",
+                (name,),
+            )
+
+    def stats(self) -> Dict[str, float]:
+        with self.__lock:
+            stats = dict(self.__conn.execute("""SELECT name, value FROM stats"""))
+
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        stats["hit_ratio"] = stats.get("hits", 0) / lookups if lookups > 0 else 0
+        return stats
+
+
+_ticket_cache = None
+_ticket_cache_lock = Lock()
+
+
+def get_ticket_cache() -> TicketCache:
+    global _ticket_cache
+
+    with _ticket_cache_lock:
+        if _ticket_cache is None:
+            _ticket_cache = TicketCache()
+
+        return _ticket_cache
+
+
+if __name__ == "__main__":
+    # the counters are shared by every launcher using the cache, so this
+    # reports the hit ratio of the whole host
+    print(json.dumps(get_ticket_cache().stats()))
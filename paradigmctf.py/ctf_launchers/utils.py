@@ -1,13 +1,17 @@
+from __future__ import annotations
+
 import json
 import os
 import re
 import subprocess
-from typing import Dict
-
-from web3 import Web3
+from typing import TYPE_CHECKING, Dict, Optional
 
+from ctf_launchers.artifacts import ARTIFACTS_DIR, prepare_artifacts
 from foundry.anvil import anvil_autoImpersonateAccount, anvil_setCode
 
+if TYPE_CHECKING:
+    from web3 import Web3
+
 
 def deploy(
     web3: Web3,
@@ -15,7 +19,11 @@ def deploy(
     mnemonic: str,
     deploy_script: str = "script/Deploy.s.sol:Deploy",
     env: Dict = {},
+    project_hash: Optional[str] = None,
 ) -> str:
+    # compiled separately so the broadcast below finds a warm cache
+    prepare_artifacts(project_location, project_hash=project_hash)
+
     anvil_autoImpersonateAccount(web3, True)
 
     rfd, wfd = os.pipe2(os.O_NONBLOCK)
@@ -27,9 +35,9 @@ def deploy(
             "--rpc-url",
             web3.provider.endpoint_uri,
             "--out",
-            "/artifacts/out",
+            f"{ARTIFACTS_DIR}/out",
             "--cache-path",
-            "/artifacts/cache",
+            f"{ARTIFACTS_DIR}/cache",
             "--broadcast",
             "--unlocked",
             "--sender",
@@ -251,7 +259,7 @@ def anvil_setCodeFromFile(
 ):
     file, contract = target.split(":")
 
-    with open(f"/artifacts/out/{file}/{contract}.json", "r") as f:
+    with open(f"{ARTIFACTS_DIR}/out/{file}/{contract}.json", "r") as f:
         cache = json.load(f)
 
         bytecode = cache["deployedBytecode"]["object"]
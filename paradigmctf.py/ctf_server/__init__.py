@@ -1,2 +1,14 @@
-from ctf_server.anvil_proxy import app as anvil_proxy
-from ctf_server.orchestrator import app as orchestrator
\ No newline at end of file
+# the apps are only imported when uvicorn asks for them, so that importing
+# ctf_server.types from a launcher doesn't pull in the whole server
+def __getattr__(name: str):
+    if name == "anvil_proxy":
+        from ctf_server.anvil_proxy import app
+    elif name == "orchestrator":
+        from ctf_server.orchestrator import app
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    # importing the submodule bound its name to the module, replace it with the
+    # app as the eager import used to
+    globals()[name] = app
+    return app
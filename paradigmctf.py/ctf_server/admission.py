@@ -0,0 +1,235 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from ctf_server.metrics import metrics
+from ctf_server.types import QueuePosition, UserData
+
+# the caps and the queue are kept in memory, so they only hold while a single
+# orchestrator replica serves launches. running more replicas multiplies the
+# caps and gives each replica its own queue
+#
+# 0 disables the corresponding cap
+ADMISSION_MAX_INSTANCES = int(os.getenv("ADMISSION_MAX_INSTANCES", "0"))
+ADMISSION_MAX_INSTANCES_PER_CHALLENGE = int(
+    os.getenv("ADMISSION_MAX_INSTANCES_PER_CHALLENGE", "0")
+)
+# per-challenge overrides, formatted as "challenge=limit,challenge=limit"
+ADMISSION_CHALLENGE_LIMITS = os.getenv("ADMISSION_CHALLENGE_LIMITS", "")
+
+# launchers re-post while queued, entries which aren't polled for this long
+# are assumed to be abandoned
+ADMISSION_QUEUE_TTL = float(os.getenv("ADMISSION_QUEUE_TTL", "60"))
+# how long an admitted launch keeps its slot before someone launches it
+ADMISSION_GRANT_TTL = float(os.getenv("ADMISSION_GRANT_TTL", "60"))
+ADMISSION_EWMA_ALPHA = 0.2
+
+
+class QueueConflict(Exception):
+    pass
+
+
+@dataclass
+class QueueEntry:
+    instance_id: str
+    team: str
+    challenge: Optional[str]
+    enqueued_at: float
+    last_seen: float
+    admitted: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+def parse_challenge_limits(limits: str) -> Dict[str, int]:
+    parsed = {}
+    for limit in limits.split(","):
+        if limit.strip() == "":
+            continue
+
+        challenge, value = limit.split("=", 1)
+        parsed[challenge.strip()] = int(value)
+
+    return parsed
+
+
+# caps how many instances this orchestrator runs at once, and hands out freed
+# capacity to queued launches in arrival order, one pending launch per team
+class AdmissionController:
+    def __init__(
+        self,
+        max_instances: int = ADMISSION_MAX_INSTANCES,
+        max_instances_per_challenge: int = ADMISSION_MAX_INSTANCES_PER_CHALLENGE,
+        challenge_limits: Dict[str, int] = parse_challenge_limits(
+            ADMISSION_CHALLENGE_LIMITS
+        ),
+    ):
+        self.__max_instances = max_instances
+        self.__max_instances_per_challenge = max_instances_per_challenge
+        self.__challenge_limits = challenge_limits
+
+        self.__queue: OrderedDict[str, QueueEntry] = OrderedDict()
+        self.__queued_teams: Dict[str, str] = {}
+
+        # every instance holding a slot, whether it's running, launching or
+        # admitted and waiting for its launcher to come back
+        self.__running: Dict[str, Optional[str]] = {}
+        self.__running_per_challenge: Dict[str, int] = {}
+        self.__grants: Dict[str, float] = {}
+
+        self.__last_release: Optional[float] = None
+        self.__release_interval: Optional[float] = None
+
+    def seed(self, instances: List[UserData]):
+        for instance in instances:
+            # launchers record which challenge they deployed once the instance
+            # is up, so older or half-launched instances may not have one yet
+            challenge = instance["metadata"].get("challenge")
+
+            self.__running[instance["instance_id"]] = challenge
+            if challenge is not None:
+                self.__running_per_challenge[challenge] = (
+                    self.__running_per_challenge.get(challenge, 0) + 1
+                )
+
+        self.__update_metrics()
+
+    async def acquire(
+        self, instance_id: str, team: str, challenge: Optional[str], timeout: float
+    ) -> Optional[QueuePosition]:
+        now = time.time()
+        self.__sweep(now)
+
+        if instance_id in self.__running:
+            # either admitted while the launcher was away, or a duplicate of a
+            # launch which already holds its slot
+            self.__grants.pop(instance_id, None)
+            return None
+
+        entry = self.__queue.get(instance_id)
+        if entry is None:
+            queued_instance_id = self.__queued_teams.get(team)
+            if queued_instance_id is not None:
+                raise QueueConflict(queued_instance_id)
+
+            entry = QueueEntry(
+                instance_id=instance_id,
+                team=team,
+                challenge=challenge,
+                enqueued_at=now,
+                last_seen=now,
+            )
+            self.__queue[instance_id] = entry
+            self.__queued_teams[team] = instance_id
+
+            self.__admit()
+
+        try:
+            await asyncio.wait_for(entry.admitted.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        entry.last_seen = time.time()
+
+        if entry.admitted.is_set():
+            self.__grants.pop(instance_id, None)
+            return None
+
+        return self.__get_position(entry)
+
+    def release(self, instance_id: str):
+        if instance_id not in self.__running:
+            return
+
+        challenge = self.__running.pop(instance_id)
+        self.__grants.pop(instance_id, None)
+        if challenge is not None:
+            self.__running_per_challenge[challenge] -= 1
+
+        now = time.time()
+        if self.__last_release is not None:
+            interval = now - self.__last_release
+            if self.__release_interval is None:
+                self.__release_interval = interval
+            else:
+                self.__release_interval = (
+                    ADMISSION_EWMA_ALPHA * interval
+                    + (1 - ADMISSION_EWMA_ALPHA) * self.__release_interval
+                )
+        self.__last_release = now
+
+        self.__admit()
+
+    def __admit(self):
+        for entry in list(self.__queue.values()):
+            if not self.__has_capacity(entry.challenge):
+                # a full challenge mustn't hold up launches of the others, but
+                # nothing gets in once the global cap is reached
+                if self.__is_full():
+                    break
+                continue
+
+            del self.__queue[entry.instance_id]
+            del self.__queued_teams[entry.team]
+
+            self.__running[entry.instance_id] = entry.challenge
+            if entry.challenge is not None:
+                self.__running_per_challenge[entry.challenge] = (
+                    self.__running_per_challenge.get(entry.challenge, 0) + 1
+                )
+            self.__grants[entry.instance_id] = time.time() + ADMISSION_GRANT_TTL
+
+            metrics.observe(
+                "admission_wait_seconds", time.time() - entry.enqueued_at
+            )
+            entry.admitted.set()
+
+        self.__update_metrics()
+
+    def __sweep(self, now: float):
+        for entry in list(self.__queue.values()):
+            if entry.last_seen + ADMISSION_QUEUE_TTL < now:
+                del self.__queue[entry.instance_id]
+                del self.__queued_teams[entry.team]
+                metrics.inc("admission_abandoned")
+
+        for instance_id, deadline in list(self.__grants.items()):
+            if deadline < now:
+                self.release(instance_id)
+
+        self.__update_metrics()
+
+    def __is_full(self) -> bool:
+        return (
+            self.__max_instances > 0 and len(self.__running) >= self.__max_instances
+        )
+
+    def __has_capacity(self, challenge: Optional[str]) -> bool:
+        if self.__is_full():
+            return False
+
+        if challenge is None:
+            return True
+
+        limit = self.__challenge_limits.get(
+            challenge, self.__max_instances_per_challenge
+        )
+        return limit <= 0 or self.__running_per_challenge.get(challenge, 0) < limit
+
+    def __get_position(self, entry: QueueEntry) -> QueuePosition:
+        position = list(self.__queue.keys()).index(entry.instance_id) + 1
+
+        estimated_wait = None
+        if self.__release_interval is not None:
+            estimated_wait = position * self.__release_interval
+
+        return QueuePosition(
+            position=position,
+            depth=len(self.__queue),
+            estimated_wait=estimated_wait,
+        )
+
+    def __update_metrics(self):
+        metrics.set("admission_queue_depth", len(self.__queue))
+        metrics.set("admission_running", len(self.__running))
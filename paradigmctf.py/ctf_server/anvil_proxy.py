@@ -1,5 +1,7 @@
 import json
 import logging
+import os
+import time
 from ast import Dict, List
 from contextlib import asynccontextmanager
 from typing import Any, Optional
@@ -11,6 +13,12 @@ import websockets
 
 from .utils import load_database
 
+ORCHESTRATOR_HOST = os.getenv("ORCHESTRATOR_HOST", "http://orchestrator:7283")
+# how often an instance's activity is written back, the hibernation only needs
+# to know roughly when it was last used
+ACTIVITY_INTERVAL = float(os.getenv("ACTIVITY_INTERVAL", "15"))
+ACTIVITY_MAX_TRACKED = 10000
+RESUME_TIMEOUT = float(os.getenv("RESUME_TIMEOUT", "120"))
 
 ALLOWED_NAMESPACES = ["web3", "eth", "net", "starknet"]
 DISALLOWED_METHODS = [
@@ -26,10 +34,15 @@ DISALLOWED_METHODS = [
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global session, database
+    global session, database, last_activity, pending_resumes
     session = aiohttp.ClientSession()
     database = load_database()
 
+    # external id -> when its activity was last written
+    last_activity = {}
+    # external id -> resume in flight
+    pending_resumes = {}
+
     yield
 
     await session.close()
@@ -76,14 +89,70 @@ def validate_request(request: Any) -> Optional[Dict]:
     return None
 
 
+async def record_activity(external_id: str):
+    now = time.time()
+    if now - last_activity.get(external_id, 0) < ACTIVITY_INTERVAL:
+        return
+
+    if len(last_activity) >= ACTIVITY_MAX_TRACKED:
+        for stale in [k for k, v in last_activity.items() if now - v >= ACTIVITY_INTERVAL]:
+            del last_activity[stale]
+
+    last_activity[external_id] = now
+    try:
+        await asyncio.to_thread(database.record_activity, external_id)
+    except Exception as e:
+        logging.warning("failed to record activity of %s", external_id, exc_info=e)
+
+
+async def resume_instance(external_id: str) -> Optional[Any]:
+    async with session.post(
+        f"{ORCHESTRATOR_HOST}/routes/{external_id}/resume",
+        timeout=aiohttp.ClientTimeout(total=RESUME_TIMEOUT),
+    ) as resp:
+        body = await resp.json()
+
+    if not body["ok"]:
+        raise Exception("failed to resume instance", body["message"])
+
+    return body["data"]
+
+
+async def get_routes(external_id: str) -> Optional[Any]:
+    routes = await asyncio.to_thread(database.get_routes, external_id)
+    if routes is None:
+        return None
+
+    await record_activity(external_id)
+
+    # hibernated instances have no routes, the request is held until the
+    # orchestrator brought the chains back, together with every other request
+    # arriving in the meantime
+    if len(routes) == 0:
+        resume = pending_resumes.get(external_id)
+        if resume is None:
+            resume = asyncio.ensure_future(resume_instance(external_id))
+            pending_resumes[external_id] = resume
+            resume.add_done_callback(lambda _: pending_resumes.pop(external_id, None))
+
+        routes = await asyncio.shield(resume)
+
+    return routes
+
+
 async def proxy_request(
     external_id: str, anvil_id: str, request_id: Optional[str], body: Any
 ) -> Optional[Any]:
-    user_data = database.get_instance_by_external_id(external_id)
-    if user_data is None:
+    try:
+        routes = await get_routes(external_id)
+    except Exception as e:
+        logging.error("failed to resume instance %s", external_id, exc_info=e)
+        return jsonrpc_fail(request_id, -32602, "failed to resume instance")
+
+    if routes is None:
         return jsonrpc_fail(request_id, -32602, "invalid rpc url, instance not found")
 
-    anvil_instance = user_data.get("anvil_instances", {}).get(anvil_id, None)
+    anvil_instance = routes.get(anvil_id, None)
     if anvil_instance is None:
         return jsonrpc_fail(request_id, -32602, "invalid rpc url, chain not found")
 
@@ -138,9 +207,11 @@ async def rpc(external_id: str, anvil_id: str, request: Request):
 
     return await proxy_request(external_id, anvil_id, body["id"], body)
 
-async def forward_message(client_to_remote: bool, client_ws: WebSocket, remote_ws: websockets):
+async def forward_message(client_to_remote: bool, client_ws: WebSocket, remote_ws: websockets, external_id: str):
     if client_to_remote:
         async for message in client_ws.iter_text():
+            await record_activity(external_id)
+
             try:
                 json_msg = json.loads(message)
             except json.JSONDecodeError:
@@ -153,16 +224,22 @@ async def forward_message(client_to_remote: bool, client_ws: WebSocket, remote_w
                 await remote_ws.send(message)
     else:
         async for message in remote_ws:
+            await record_activity(external_id)
             await client_ws.send_text(message)
 
 @app.websocket("/{external_id}/{anvil_id}/ws")
 async def ws_rpc(external_id: str, anvil_id: str, client_ws: WebSocket):
-    user_data = database.get_instance_by_external_id(external_id)
-    if user_data is None:
+    try:
+        routes = await get_routes(external_id)
+    except Exception as e:
+        logging.error("failed to resume instance %s", external_id, exc_info=e)
+        return
+
+    if routes is None:
         client_ws.send_json(jsonrpc_fail(None, -32602, "invalid rpc url, instance not found"))
         return
 
-    anvil_instance = user_data.get("anvil_instances", {}).get(anvil_id, None)
+    anvil_instance = routes.get(anvil_id, None)
     if anvil_instance is None:
         client_ws.send_json(jsonrpc_fail(None, -32602, "invalid rpc url, chain not found"))
         return
@@ -171,8 +248,8 @@ async def ws_rpc(external_id: str, anvil_id: str, client_ws: WebSocket):
 
     async with websockets.connect(instance_host) as remote_ws:
         await client_ws.accept()
-        task_a = asyncio.create_task(forward_message(True, client_ws, remote_ws))
-        task_b = asyncio.create_task(forward_message(False, client_ws, remote_ws))
+        task_a = asyncio.create_task(forward_message(True, client_ws, remote_ws, external_id))
+        task_b = asyncio.create_task(forward_message(False, client_ws, remote_ws, external_id))
 
         try:
             await asyncio.wait([task_a, task_b], return_when=asyncio.FIRST_COMPLETED)
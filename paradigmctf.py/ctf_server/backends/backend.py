@@ -1,27 +1,62 @@
 import abc
+import asyncio
+import json
 import logging
+import os
 import random
 import string
 import time
-from threading import Thread
-import requests
-import json
+import uuid
+from typing import Dict, Optional
 
 from ctf_server.databases.database import Database
+from ctf_server.metrics import metrics
+from ctf_server.providers import get_provider_registry
 from ctf_server.types import (
     DEFAULT_ACCOUNTS,
     DEFAULT_BALANCE,
     DEFAULT_DERIVATION_PATH,
     DEFAULT_MNEMONIC,
+    DEFAULT_STATE_PERSISTENCE,
     CreateInstanceRequest,
+    InstanceInfo,
     LaunchAnvilInstanceArgs,
     UserData,
 )
 from eth_account import Account
 from eth_account.hdaccount import key_from_seed, seed_from_mnemonic
-from foundry.anvil import anvil_setBalance
-from starknet.anvil import starknet_getVersion
-from web3 import Web3
+from foundry.anvil import (
+    async_anvil_dumpState,
+    async_anvil_loadState,
+    async_anvil_setBalance,
+    async_evm_revert,
+    async_evm_snapshot,
+)
+from starknet.anvil import async_starknet_getVersion
+from web3 import AsyncWeb3
+
+
+PRUNER_CONCURRENCY = int(os.getenv("PRUNER_CONCURRENCY", "16"))
+PRUNER_MAX_SLEEP = float(os.getenv("PRUNER_MAX_SLEEP", "30"))
+PRUNER_LEASE = float(os.getenv("PRUNER_LEASE", "120"))
+PRUNER_MIN_SLEEP = 0.1
+
+LAUNCH_RESERVATION_TTL = float(os.getenv("LAUNCH_RESERVATION_TTL", "300"))
+LAUNCH_POLL_INTERVAL = 0.5
+
+
+def get_state_key(instance_id: str, anvil_id: str) -> str:
+    return f"state/{instance_id}/{anvil_id}"
+
+
+def get_snapshot_metadata_key(key: str) -> str:
+    # kept apart from the state, which can be many megabytes
+    return f"snapshot-metadata/{key}"
+
+
+def get_state_persistence(instance: UserData, anvil_id: str) -> str:
+    state_persistence = json.loads(instance["metadata"].get("state_persistence", "{}"))
+    return state_persistence.get(anvil_id, DEFAULT_STATE_PERSISTENCE)
 
 
 class InstanceExists(Exception):
@@ -32,46 +67,415 @@ class Backend(abc.ABC):
     def __init__(self, database: Database):
         self._database = database
 
-        Thread(
-            target=self.__instance_pruner_thread,
+        self.__pruner: Optional[asyncio.Task] = None
+        self.__expiries_changed = asyncio.Event()
+        self.__teardown_slots = asyncio.Semaphore(PRUNER_CONCURRENCY)
+        self.__pending_teardowns: Dict[str, asyncio.Task] = {}
+        self.__pending_launches: Dict[str, asyncio.Future] = {}
+        self.__pending_resumes: Dict[str, asyncio.Future] = {}
+
+    async def start(self):
+        self.__pruner = asyncio.create_task(
+            self.__instance_pruner(),
             name=f"{self.__class__.__name__} Anvil Pruner",
-            daemon=True,
-        ).start()
+        )
 
-    def __instance_pruner_thread(self):
+    async def stop(self):
+        if self.__pruner is not None:
+            self.__pruner.cancel()
+            self.__pruner = None
+
+    async def __instance_pruner(self):
         while True:
+            # cleared before reading so that a registration racing with this
+            # pass still wakes up the next sleep
+            self.__expiries_changed.clear()
+
+            next_expiry = None
             try:
-                for instance in self._database.get_expired_instances():
-                    logging.info(
-                        "pruning expired instance: %s", instance["instance_id"]
+                expired = await asyncio.to_thread(
+                    self._database.claim_expired_instances, PRUNER_LEASE
+                )
+                for instance in expired or []:
+                    if instance is None:
+                        continue
+
+                    if instance["instance_id"] in self.__pending_teardowns:
+                        continue
+
+                    self.__pending_teardowns[instance["instance_id"]] = asyncio.create_task(
+                        self.__prune_instance(instance)
                     )
 
-                    self.kill_instance(instance["instance_id"])
+                next_expiry = await asyncio.to_thread(self._database.get_next_expiry)
             except Exception as e:
                 logging.error("failed to prune instances", exc_info=e)
-            time.sleep(1)
 
-    def launch_instance(self, args: CreateInstanceRequest) -> UserData:
-        if self._database.get_instance(args["instance_id"]) is not None:
+            metrics.set("pruner_pending_teardowns", len(self.__pending_teardowns))
+
+            delay = PRUNER_MAX_SLEEP
+            if next_expiry is not None:
+                delay = min(max(next_expiry - time.time(), PRUNER_MIN_SLEEP), delay)
+
+            try:
+                await asyncio.wait_for(self.__expiries_changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __prune_instance(self, instance: UserData):
+        try:
+            async with self.__teardown_slots:
+                logging.info("pruning expired instance: %s", instance["instance_id"])
+
+                start = time.time()
+                await self.kill_instance(instance["instance_id"])
+                end = time.time()
+
+            metrics.inc("pruner_teardowns")
+            metrics.observe("pruner_teardown_duration_seconds", end - start)
+            metrics.observe("pruner_teardown_lag_seconds", end - instance["expires_at"])
+        except Exception as e:
+            metrics.inc("pruner_teardown_failures")
+            logging.error(
+                "failed to prune instance: %s", instance["instance_id"], exc_info=e
+            )
+        finally:
+            self.__pending_teardowns.pop(instance["instance_id"], None)
+
+    async def launch_instance(self, args: CreateInstanceRequest) -> UserData:
+        instance_id = args["instance_id"]
+
+        # duplicate requests attach to the launch already in flight instead of
+        # racing it, and are shielded so one caller going away doesn't cancel
+        # the launch for everyone else
+        launch = self.__pending_launches.get(instance_id)
+        if launch is not None:
+            metrics.inc("launches_coalesced")
+            return await asyncio.shield(launch)
+
+        launch = asyncio.ensure_future(self.__launch_instance(args))
+        self.__pending_launches[instance_id] = launch
+        launch.add_done_callback(
+            lambda _: self.__pending_launches.pop(instance_id, None)
+        )
+
+        return await asyncio.shield(launch)
+
+    async def __launch_instance(self, args: CreateInstanceRequest) -> UserData:
+        instance_id = args["instance_id"]
+
+        if await asyncio.to_thread(self._database.get_instance, instance_id) is not None:
             raise InstanceExists()
 
+        token = uuid.uuid4().hex
+        if not await asyncio.to_thread(
+            self._database.reserve_instance,
+            instance_id, token, LAUNCH_RESERVATION_TTL
+        ):
+            metrics.inc("launches_coalesced")
+            return await self.__await_launch(instance_id)
+
         try:
-            user_data = self._launch_instance_impl(args)
-            self._database.register_instance(args["instance_id"], user_data)
-            return user_data
+            # the instance may have been registered by another replica between
+            # the first check and the reservation
+            existing = await asyncio.to_thread(self._database.get_instance, instance_id)
+            if existing is not None:
+                raise InstanceExists()
+
+            try:
+                user_data = await self._launch_instance_impl(args)
+                if args["type"] == "ethereum":
+                    user_data["metadata"]["state_persistence"] = json.dumps(
+                        {
+                            anvil_id: anvil_args.get("state_persistence")
+                            or DEFAULT_STATE_PERSISTENCE
+                            for anvil_id, anvil_args in args.get("anvil_instances", {}).items()
+                        }
+                    )
+
+                await asyncio.to_thread(
+                    self._database.register_instance, instance_id, user_data
+                )
+
+                self.__expiries_changed.set()
+                return user_data
+
+            except:
+                await self._cleanup_instance(args)
+                get_provider_registry().evict(instance_id)
+                raise
+        finally:
+            await asyncio.to_thread(self._database.release_instance, instance_id, token)
+
+    async def __await_launch(self, instance_id: str) -> UserData:
+        deadline = time.time() + LAUNCH_RESERVATION_TTL
+        while time.time() < deadline:
+            # the reservation is released after registering, so it has to be
+            # checked before the instance to tell a failed launch apart
+            reserved = await asyncio.to_thread(self._database.is_reserved, instance_id)
 
-        except:
-            self._cleanup_instance(args)
-            raise
+            instance = await asyncio.to_thread(self._database.get_instance, instance_id)
+            if instance is not None:
+                return instance
 
-    def _launch_instance_impl(self, args: CreateInstanceRequest) -> UserData:
+            if not reserved:
+                raise Exception("concurrent launch failed", instance_id)
+
+            await asyncio.sleep(LAUNCH_POLL_INTERVAL)
+
+        raise Exception("timed out waiting for concurrent launch", instance_id)
+
+    async def _launch_instance_impl(self, args: CreateInstanceRequest) -> UserData:
         pass
 
-    def _cleanup_instance(self, args: CreateInstanceRequest):
+    async def _cleanup_instance(self, args: CreateInstanceRequest):
         pass
 
+    async def kill_instance(self, instance_id: str) -> Optional[UserData]:
+        instance = await asyncio.to_thread(self._database.get_instance, instance_id)
+        if instance is None:
+            return None
+
+        # a hibernation, resume or reset in progress would write the instance
+        # back after it's gone, so wait for it to finish first
+        token = uuid.uuid4().hex
+        await self.__wait_for_reservation(instance_id, token)
+
+        try:
+            instance = await asyncio.to_thread(self._database.get_instance, instance_id)
+            if instance is None:
+                return None
+
+            # the instance is only unregistered once its resources are gone, so
+            # a replica dying mid-teardown leaves it claimable by the others
+            await self._kill_instance_impl(instance)
+
+            await asyncio.to_thread(self._database.unregister_instance, instance_id)
+
+            for anvil_id in instance["anvil_instances"]:
+                await asyncio.to_thread(
+                    self._database.delete_snapshot, get_state_key(instance_id, anvil_id)
+                )
+
+            return instance
+        finally:
+            await asyncio.to_thread(self._database.release_instance, instance_id, token)
+
+    async def checkpoint_instance(self, instance: UserData):
+        # evm snapshots of every chain, stored with the instance so that any
+        # replica can revert to them
+        checkpoints = {}
+        for anvil_id, anvil_instance in instance["anvil_instances"].items():
+            checkpoints[anvil_id] = await async_evm_snapshot(
+                self._get_web3(
+                    instance["instance_id"],
+                    f"http://{anvil_instance['ip']}:{anvil_instance['port']}",
+                )
+            )
+
+        await asyncio.to_thread(
+            self._database.update_metadata,
+            instance["instance_id"], {"checkpoints": json.dumps(checkpoints)}
+        )
+
+    async def reset_instance(self, instance: UserData):
+        if "checkpoints" not in instance["metadata"]:
+            raise Exception("instance has no checkpoint", instance["instance_id"])
+
+        # a checkpoint can only be reverted to once, so resets take the same
+        # database reservation as hibernating and resuming, which keeps other
+        # replicas out as well
+        instance_id = instance["instance_id"]
+        token = uuid.uuid4().hex
+        await self.__wait_for_reservation(instance_id, token)
+
+        try:
+            # re-read under the reservation, a reset that just finished
+            # replaced the checkpoints
+            instance = await asyncio.to_thread(self._database.get_instance, instance_id)
+            if instance is None:
+                raise Exception("instance does not exist")
+            if instance.get("hibernated", False):
+                raise Exception("instance is hibernated", instance_id)
+
+            start = time.time()
+
+            checkpoints = json.loads(instance["metadata"]["checkpoints"])
+            for anvil_id, checkpoint in checkpoints.items():
+                anvil_instance = instance["anvil_instances"][anvil_id]
+                web3 = self._get_web3(
+                    instance["instance_id"],
+                    f"http://{anvil_instance['ip']}:{anvil_instance['port']}",
+                )
+
+                if not await async_evm_revert(web3, checkpoint):
+                    raise Exception("failed to revert", anvil_id, checkpoint)
+
+            # anvil drops a snapshot once it was reverted to, so the next reset
+            # needs a fresh one
+            await self.checkpoint_instance(instance)
+
+            metrics.inc("instance_resets")
+            metrics.observe("instance_reset_duration_seconds", time.time() - start)
+        finally:
+            await asyncio.to_thread(self._database.release_instance, instance_id, token)
+
+    async def persist_instance(self, instance: UserData) -> Dict[str, int]:
+        # anvil hands out its whole state over rpc, which lands in the blob
+        # store where a resume picks it up again
+        sizes = {}
+        for anvil_id, anvil_instance in instance["anvil_instances"].items():
+            if get_state_persistence(instance, anvil_id) == "off":
+                continue
+
+            start = time.time()
+
+            state = await async_anvil_dumpState(
+                self._get_web3(
+                    instance["instance_id"],
+                    f"http://{anvil_instance['ip']}:{anvil_instance['port']}",
+                )
+            )
+            await asyncio.to_thread(
+                self._database.put_snapshot,
+                get_state_key(instance["instance_id"], anvil_id), state.encode("utf8")
+            )
+
+            sizes[anvil_id] = len(state)
+
+            metrics.inc("state_dumps")
+            metrics.observe("state_dump_duration_seconds", time.time() - start)
+            metrics.observe("state_size_bytes", len(state))
+
+        return sizes
+
+    def supports_hibernation(self) -> bool:
+        return False
+
+    async def hibernate_instance(self, instance_id: str) -> bool:
+        # the launch reservation doubles as a lock, so neither a resume nor a
+        # hibernation on another replica can interleave with this one
+        token = uuid.uuid4().hex
+        if not await asyncio.to_thread(
+            self._database.reserve_instance,
+            instance_id, token, LAUNCH_RESERVATION_TTL
+        ):
+            return False
+
+        try:
+            instance = await asyncio.to_thread(self._database.get_instance, instance_id)
+            if instance is None or instance.get("hibernated", False):
+                return False
+
+            start = time.time()
+
+            # routes go away first, requests arriving from now on wait for the
+            # resume instead of changing a chain that's being dumped
+            instance["hibernated"] = True
+            await asyncio.to_thread(
+                self._database.update_instance, instance_id, instance
+            )
+
+            try:
+                await self.persist_instance(instance)
+                await self._hibernate_instance_impl(instance)
+            except:
+                instance["hibernated"] = False
+                await asyncio.to_thread(
+                    self._database.update_instance, instance_id, instance
+                )
+                raise
+
+            get_provider_registry().evict(instance_id)
+
+            metrics.inc("hibernations")
+            metrics.observe("hibernate_duration_seconds", time.time() - start)
+            return True
+        finally:
+            await asyncio.to_thread(self._database.release_instance, instance_id, token)
+
+    async def resume_instance(self, instance_id: str) -> Optional[UserData]:
+        # every request held by the proxies waits on the same resume
+        resume = self.__pending_resumes.get(instance_id)
+        if resume is not None:
+            return await asyncio.shield(resume)
+
+        resume = asyncio.ensure_future(self.__resume_instance(instance_id))
+        self.__pending_resumes[instance_id] = resume
+        resume.add_done_callback(
+            lambda _: self.__pending_resumes.pop(instance_id, None)
+        )
+
+        return await asyncio.shield(resume)
+
+    async def __resume_instance(self, instance_id: str) -> Optional[UserData]:
+        token = uuid.uuid4().hex
+        await self.__wait_for_reservation(instance_id, token)
+
+        try:
+            instance = await asyncio.to_thread(self._database.get_instance, instance_id)
+            if instance is None or not instance.get("hibernated", False):
+                return instance
+
+            start = time.time()
+
+            instance["anvil_instances"] = await self._resume_instance_impl(instance)
+
+            for anvil_id, anvil_instance in instance["anvil_instances"].items():
+                web3 = self._get_web3(
+                    instance_id,
+                    f"http://{anvil_instance['ip']}:{anvil_instance['port']}",
+                )
+                while not await web3.is_connected():
+                    await asyncio.sleep(0.1)
+
+                state = await asyncio.to_thread(
+                    self._database.get_snapshot, get_state_key(instance_id, anvil_id)
+                )
+                if state is not None:
+                    await async_anvil_loadState(web3, state.decode("utf8"))
+
+            # evm snapshots only live in anvil's memory and went down with it,
+            # so a reset goes back to where the instance was hibernated from
+            # now on
+            if "checkpoints" in instance["metadata"]:
+                await self.checkpoint_instance(instance)
+
+            instance["hibernated"] = False
+            await asyncio.to_thread(
+                self._database.update_instance, instance_id, instance
+            )
+            await asyncio.to_thread(
+                self._database.record_activity, instance["external_id"]
+            )
+
+            metrics.inc("resumes")
+            metrics.observe("resume_duration_seconds", time.time() - start)
+            return instance
+        finally:
+            await asyncio.to_thread(self._database.release_instance, instance_id, token)
+
+    async def __wait_for_reservation(self, instance_id: str, token: str):
+        deadline = time.time() + LAUNCH_RESERVATION_TTL
+        while not await asyncio.to_thread(
+            self._database.reserve_instance,
+            instance_id, token, LAUNCH_RESERVATION_TTL
+        ):
+            # hibernating, resuming or resetting on another replica
+            if time.time() > deadline:
+                raise Exception("timed out waiting for instance", instance_id)
+
+            await asyncio.sleep(LAUNCH_POLL_INTERVAL)
+
+    async def _hibernate_instance_impl(self, instance: UserData):
+        raise Exception("hibernation not supported")
+
+    # returns the new location of every chain
+    async def _resume_instance_impl(self, instance: UserData) -> Dict[str, InstanceInfo]:
+        raise Exception("hibernation not supported")
+
     @abc.abstractmethod
-    def kill_instance(self, id: str) -> UserData:
+    async def _kill_instance_impl(self, instance: UserData):
         pass
 
     def _generate_rpc_id(self, N: int = 24) -> str:
@@ -79,19 +483,36 @@ class Backend(abc.ABC):
             random.SystemRandom().choice(string.ascii_letters) for _ in range(N)
         )
 
+    def _get_web3(self, instance_id: str, url: str) -> AsyncWeb3:
+        # pooled and shared with everything else talking to the instance,
+        # dropped once it's unregistered
+        return get_provider_registry().get_async_web3(url, instance_id)
+
     def __derive_account(self, derivation_path: str, mnemonic: str, index: int) -> str:
         seed = seed_from_mnemonic(mnemonic, "")
         private_key = key_from_seed(seed, f"{derivation_path}{index}")
 
         return Account.from_key(private_key)
 
-    def _prepare_node(self, args: LaunchAnvilInstanceArgs, web3: Web3):
-        while not web3.is_connected():
-            time.sleep(0.1)
+    async def _prepare_node(self, args: LaunchAnvilInstanceArgs, web3: AsyncWeb3):
+        while not await web3.is_connected():
+            await asyncio.sleep(0.1)
             continue
 
+        if args.get("snapshot") is not None:
+            snapshot = await asyncio.to_thread(
+                self._database.get_snapshot, args["snapshot"]
+            )
+            if snapshot is None:
+                raise Exception("snapshot does not exist", args["snapshot"])
+
+            await async_anvil_loadState(web3, snapshot.decode("utf8"))
+
+        # funded after the state is loaded, so the instance's own accounts are
+        # the ones the player gets even though the snapshot was deployed with
+        # another mnemonic
         for i in range(args.get("accounts", DEFAULT_ACCOUNTS)):
-            anvil_setBalance(
+            await async_anvil_setBalance(
                 web3,
                 self.__derive_account(
                     args.get("derivation_path", DEFAULT_DERIVATION_PATH),
@@ -101,17 +522,17 @@ class Backend(abc.ABC):
                 hex(int(args.get("balance", DEFAULT_BALANCE) * 10**18)),
             )
 
-    def _prepare_node_starknet(self, args: LaunchAnvilInstanceArgs, web3: Web3):
+    async def _prepare_node_starknet(self, args: LaunchAnvilInstanceArgs, web3: AsyncWeb3):
         while True:
             try:
-                starknet_getVersion(web3)
+                await async_starknet_getVersion(web3)
                 break
             except:
-                time.sleep(0.1)
+                await asyncio.sleep(0.1)
 
-    def _prepare_node_nitro(self, args: LaunchAnvilInstanceArgs, web3: Web3):
-        while not web3.is_connected():
-            time.sleep(0.1)
+    async def _prepare_node_nitro(self, args: LaunchAnvilInstanceArgs, web3: AsyncWeb3):
+        while not await web3.is_connected():
+            await asyncio.sleep(0.1)
             continue
 
         pk = "0xb6b15c8cb491557369f3c7d2c287b053eb229daa9c22138887752191c9520659"
@@ -126,12 +547,12 @@ class Backend(abc.ABC):
                     i,
                 ).address,
                 'value': 250 * 10 ** 18,
-                'nonce': web3.eth.get_transaction_count(acc.address),
+                'nonce': await web3.eth.get_transaction_count(acc.address),
                 'gas': 1000000,
-                'chainId': web3.eth.chain_id,
-                'gasPrice': web3.eth.gas_price
+                'chainId': await web3.eth.chain_id,
+                'gasPrice': await web3.eth.gas_price
             }
 
             signed = web3.eth.account.sign_transaction(transaction, pk)
 
-            web3.eth.send_raw_transaction(signed.rawTransaction)
+            await web3.eth.send_raw_transaction(signed.rawTransaction)
@@ -2,26 +2,24 @@ import http.client
 import logging
 import shlex
 import time
-from typing import Dict, List
-import requests
+from typing import Any, Dict, List
 
-import docker
+import aiodocker
+from aiodocker.containers import DockerContainer
+from aiodocker.exceptions import DockerError
 from ctf_server.databases.database import Database
 from ctf_server.types import (
     DEFAULT_IMAGE,
     CreateInstanceRequest,
     InstanceInfo,
+    LaunchAnvilInstanceArgs,
     UserData,
     format_anvil_args,
     format_starknet_args,
-    format_nitro_args
+    format_nitro_args,
+    get_data_medium,
+    get_data_size_limit,
 )
-from docker.errors import APIError, NotFound
-from docker.models.containers import Container
-from docker.models.volumes import Volume
-from docker.types import Mount, RestartPolicy
-from docker.types.services import RestartConditionTypesEnum
-from web3 import Web3
 
 from .backend import Backend
 
@@ -30,88 +28,99 @@ class DockerBackend(Backend):
     def __init__(self, database: Database):
         super().__init__(database)
 
-        self.__client = docker.from_env()
+        self.__client: aiodocker.Docker = None
 
-    def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
+    async def start(self):
+        self.__client = aiodocker.Docker()
+
+        await super().start()
+
+    async def stop(self):
+        await super().stop()
+
+        await self.__client.close()
+
+    async def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
         instance_id = request["instance_id"]
 
-        volume: Volume = self.__client.volumes.create(name=instance_id)
+        # chains on tmpfs don't need the volume, which saves creating and
+        # removing it with every instance
+        if any(
+            get_data_medium(anvil_args) == "disk"
+            for anvil_args in request["anvil_instances"].values()
+        ):
+            await self.__client.volumes.create({"Name": instance_id})
 
-        anvil_containers: Dict[str, Container] = {}
+        anvil_containers: Dict[str, DockerContainer] = {}
         for anvil_id, anvil_args in request["anvil_instances"].items():
             if request["type"] == "starknet":
-                anvil_containers[anvil_id] = self.__client.containers.run(
+                anvil_containers[anvil_id] = await self.__run_container(
                     name=f"{instance_id}-{anvil_id}",
-                    image=anvil_args.get(
-                        "image", "shardlabs/starknet-devnet-rs"),
-                    network="paradigmctf",
-                    entrypoint=["tini", "--", "starknet-devnet"] + [
-                        shlex.quote(str(v))
-                        for v in format_starknet_args(anvil_args, anvil_id)
-                    ],
-                    restart_policy={"Name": "always"},
-                    detach=True,
-                    mounts=[
-                        Mount(target="/data", source=volume.id),
-                    ],
+                    config={
+                        "Image": anvil_args.get(
+                            "image", "shardlabs/starknet-devnet-rs"),
+                        "Entrypoint": ["tini", "--", "starknet-devnet"] + [
+                            shlex.quote(str(v))
+                            for v in format_starknet_args(anvil_args, anvil_id)
+                        ],
+                        "HostConfig": {
+                            "Mounts": self.__get_mounts(instance_id, anvil_args),
+                        },
+                    },
                 )
             elif request["type"] == "nitro":
-                anvil_containers[anvil_id] = self.__client.containers.run(
+                anvil_containers[anvil_id] = await self.__run_container(
                     name=f"{instance_id}-{anvil_id}",
-                    image=anvil_args.get(
-                        "image", "offchainlabs/stylus-node:v0.1.0-f47fec1-dev"),
-                    network="paradigmctf",
-                    command=format_nitro_args(anvil_args, anvil_id),
-                    restart_policy={"Name": "always"},
-                    detach=True,
-                    mounts=[
-                        Mount(target="/data", source=volume.id),
-                    ],
+                    config={
+                        "Image": anvil_args.get(
+                            "image", "offchainlabs/stylus-node:v0.1.0-f47fec1-dev"),
+                        "Cmd": format_nitro_args(anvil_args, anvil_id),
+                        "HostConfig": {
+                            "Mounts": self.__get_mounts(instance_id, anvil_args),
+                        },
+                    },
                 )
             else:
-                anvil_containers[anvil_id] = self.__client.containers.run(
+                anvil_containers[anvil_id] = await self.__run_container(
                     name=f"{instance_id}-{anvil_id}",
-                    image=anvil_args.get("image", DEFAULT_IMAGE),
-                    network="paradigmctf",
-                    entrypoint=["sh", "-c"],
-                    command=[
-                        "while true; do anvil "
-                        + " ".join(
-                            [
-                                shlex.quote(str(v))
-                                for v in format_anvil_args(anvil_args, anvil_id)
-                            ]
-                        )
-                        + "; sleep 1; done;"
-                    ],
-                    restart_policy={"Name": "always"},
-                    detach=True,
-                    mounts=[
-                        Mount(target="/data", source=volume.id),
-                    ],
+                    config={
+                        "Image": anvil_args.get("image", DEFAULT_IMAGE),
+                        "Entrypoint": ["sh", "-c"],
+                        "Cmd": [
+                            "while true; do anvil "
+                            + " ".join(
+                                [
+                                    shlex.quote(str(v))
+                                    for v in format_anvil_args(anvil_args, anvil_id)
+                                ]
+                            )
+                            + "; sleep 1; done;"
+                        ],
+                        "HostConfig": {
+                            "Mounts": self.__get_mounts(instance_id, anvil_args),
+                        },
+                    },
                 )
 
-        daemon_containers: Dict[str, Container] = {}
+        daemon_containers: Dict[str, DockerContainer] = {}
         for daemon_id, daemon_args in request.get("daemon_instances", {}).items():
-            daemon_containers[daemon_id] = self.__client.containers.run(
+            daemon_containers[daemon_id] = await self.__run_container(
                 name=f"{instance_id}-{daemon_id}",
-                image=daemon_args["image"],
-                network="paradigmctf",
-                restart_policy={"Name": "always"},
-                detach=True,
-                environment={
-                    "INSTANCE_ID": instance_id,
+                config={
+                    "Image": daemon_args["image"],
+                    "Env": [
+                        f"INSTANCE_ID={instance_id}",
+                    ],
                 },
             )
 
         anvil_instances: Dict[str, InstanceInfo] = {}
         for anvil_id, anvil_container in anvil_containers.items():
-            container: Container = self.__client.containers.get(
-                anvil_container.id)
+            container = await anvil_container.show()
 
             anvil_instances[anvil_id] = {
                 "id": anvil_id,
-                "ip": container.attrs["NetworkSettings"]["Networks"]["paradigmctf"][
+                "ip": container["NetworkSettings"]["Networks"]["paradigmctf"][
                     "IPAddress"
                 ],
                 "port": 8545,
@@ -120,25 +129,19 @@ class DockerBackend(Backend):
             url = f"http://{anvil_instances[anvil_id]['ip']}:{anvil_instances[anvil_id]['port']}"
 
             if request["type"] == "starknet":
-                self._prepare_node_starknet(
+                await self._prepare_node_starknet(
                     request["anvil_instances"][anvil_id],
-                    Web3(
-                        Web3.HTTPProvider(url)
-                    ),
+                    self._get_web3(instance_id, url),
                 )
             elif request["type"] == "nitro":
-                self._prepare_node_nitro(
+                await self._prepare_node_nitro(
                     request["anvil_instances"][anvil_id],
-                    Web3(
-                        Web3.HTTPProvider(url)
-                    ),
+                    self._get_web3(instance_id, url),
                 )
             else:
-                self._prepare_node(
+                await self._prepare_node(
                     request["anvil_instances"][anvil_id],
-                    Web3(
-                        Web3.HTTPProvider(url)
-                    ),
+                    self._get_web3(instance_id, url),
                 )
 
         daemon_instances = {}
@@ -158,77 +161,129 @@ class DockerBackend(Backend):
             metadata={},
         )
 
-    def _cleanup_instance(self, args: CreateInstanceRequest):
+    async def _cleanup_instance(self, args: CreateInstanceRequest):
         instance_id = args["instance_id"]
 
-        self.__try_delete(
+        await self.__try_delete(
             instance_id,
             args.get("anvil_instances", {}).keys(),
             args.get("daemon_instances", {}).keys(),
         )
 
-    def kill_instance(self, instance_id: str) -> UserData:
-        instance = self._database.unregister_instance(instance_id)
-        if instance is None:
-            return None
-
-        self.__try_delete(
-            instance_id,
+    async def _kill_instance_impl(self, instance: UserData):
+        await self.__try_delete(
+            instance["instance_id"],
             instance.get("anvil_instances", {}).keys(),
             instance.get("daemon_instances", {}).keys(),
         )
 
-        return instance
+    def supports_hibernation(self) -> bool:
+        return True
+
+    async def _hibernate_instance_impl(self, instance: UserData):
+        # the containers and the volume stay around, only the chains stop
+        for anvil_id in instance["anvil_instances"]:
+            container = await self.__client.containers.get(
+                f"{instance['instance_id']}-{anvil_id}"
+            )
+            await container.stop(t=1)
+
+    async def _resume_instance_impl(self, instance: UserData) -> Dict[str, InstanceInfo]:
+        anvil_instances: Dict[str, InstanceInfo] = {}
+        for anvil_id, anvil_instance in instance["anvil_instances"].items():
+            container = await self.__client.containers.get(
+                f"{instance['instance_id']}-{anvil_id}"
+            )
+            await container.start()
+
+            # the network hands out a new address on every start
+            container = await container.show()
+            anvil_instances[anvil_id] = {
+                "id": anvil_id,
+                "ip": container["NetworkSettings"]["Networks"]["paradigmctf"][
+                    "IPAddress"
+                ],
+                "port": anvil_instance["port"],
+            }
+
+        return anvil_instances
+
+    def __get_mounts(self, instance_id: str, anvil_args: LaunchAnvilInstanceArgs) -> List[Any]:
+        if get_data_medium(anvil_args) == "memory":
+            # tmpfs pages are charged to the memory cgroup of the container
+            # writing them, so the chain pays for its own state
+            return [
+                {
+                    "Type": "tmpfs",
+                    "Target": "/data",
+                    "TmpfsOptions": {
+                        "SizeBytes": get_data_size_limit(anvil_args) * 1024 * 1024,
+                    },
+                },
+            ]
+
+        return [
+            {"Type": "volume", "Source": instance_id, "Target": "/data"},
+        ]
+
+    async def __run_container(self, name: str, config: Dict[str, Any]) -> DockerContainer:
+        host_config = config.setdefault("HostConfig", {})
+        host_config["NetworkMode"] = "paradigmctf"
+        host_config["RestartPolicy"] = {"Name": "always"}
+
+        return await self.__client.containers.run(config=config, name=name)
 
-    def __try_delete(
+    async def __try_delete(
         self, instance_id: str, anvil_ids: List[str], daemon_ids: List[str]
     ):
         for anvil_id in anvil_ids:
-            self.__try_delete_container(f"{instance_id}-{anvil_id}")
+            await self.__try_delete_container(f"{instance_id}-{anvil_id}")
 
         for daemon_id in daemon_ids:
-            self.__try_delete_container(f"{instance_id}-{daemon_id}")
+            await self.__try_delete_container(f"{instance_id}-{daemon_id}")
 
-        self.__try_delete_volume(instance_id)
+        await self.__try_delete_volume(instance_id)
 
-    def __try_delete_container(self, container_name: str):
+    async def __try_delete_container(self, container_name: str):
         try:
             try:
-                container: Container = self.__client.containers.get(
-                    container_name)
-            except NotFound:
-                return
+                container = await self.__client.containers.get(container_name)
+            except DockerError as e:
+                if e.status == http.client.NOT_FOUND:
+                    return
+                raise
 
             logging.info("deleting container %s (%s)",
-                         container.id, container.name)
+                         container.id, container_name)
 
             try:
-                container.kill()
-            except APIError as api_error:
+                await container.kill()
+            except DockerError as api_error:
                 # http conflict = container not running, which is fine
-                if api_error.status_code != http.client.CONFLICT:
+                if api_error.status != http.client.CONFLICT:
                     raise
 
-            container.remove()
+            await container.delete()
         except Exception as e:
             logging.error(
-                "failed to delete container %s (%s)",
-                container.id,
-                container.name,
+                "failed to delete container %s",
+                container_name,
                 exc_info=e,
             )
 
-    def __try_delete_volume(self, volume_name: str):
+    async def __try_delete_volume(self, volume_name: str):
         try:
             try:
-                volume: Volume = self.__client.volumes.get(volume_name)
-            except NotFound:
-                return
+                volume = await self.__client.volumes.get(volume_name)
+            except DockerError as e:
+                if e.status == http.client.NOT_FOUND:
+                    return
+                raise
 
-            logging.info("deleting volume %s (%s)", volume.id, volume.name)
+            logging.info("deleting volume %s", volume.name)
 
-            volume.remove()
+            await volume.delete()
         except Exception as e:
             logging.error(
-                "failed to delete volume %s (%s)", volume.id, volume.name, exc_info=e
+                "failed to delete volume %s", volume_name, exc_info=e
             )
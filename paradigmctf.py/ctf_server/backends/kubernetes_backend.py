@@ -1,22 +1,26 @@
+import asyncio
 import http.client
 import shlex
 import time
-from typing import Any, List
+from typing import Any, Dict, List
 
-from web3 import Web3
 
 from ctf_server.databases.database import Database
 from ctf_server.types import (
     DEFAULT_IMAGE,
     CreateInstanceRequest,
+    LaunchAnvilInstanceArgs,
     UserData,
     format_anvil_args,
+    get_data_medium,
+    get_data_size_limit,
 )
-from kubernetes.client.api import core_v1_api
-from kubernetes.client.exceptions import ApiException
-from kubernetes.client.models import V1Pod
+from kubernetes_asyncio.client import ApiClient
+from kubernetes_asyncio.client.api import core_v1_api
+from kubernetes_asyncio.client.exceptions import ApiException
+from kubernetes_asyncio.client.models import V1Pod
 
-from kubernetes import config
+from kubernetes_asyncio import config
 
 from .backend import Backend
 
@@ -25,14 +29,27 @@ class KubernetesBackend(Backend):
     def __init__(self, database: Database, kubeconfig: str) -> None:
         super().__init__(database)
 
-        if kubeconfig == "incluster":
+        self.__kubeconfig = kubeconfig
+        self.__api_client: ApiClient = None
+        self.__core_v1: core_v1_api.CoreV1Api = None
+
+    async def start(self):
+        if self.__kubeconfig == "incluster":
             config.load_incluster_config()
         else:
-            config.load_kube_config(kubeconfig)
+            await config.load_kube_config(self.__kubeconfig)
+
+        self.__api_client = ApiClient()
+        self.__core_v1 = core_v1_api.CoreV1Api(self.__api_client)
+
+        await super().start()
+
+    async def stop(self):
+        await super().stop()
 
-        self.__core_v1 = core_v1_api.CoreV1Api()
+        await self.__api_client.close()
 
-    def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
+    async def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
         instance_id = request["instance_id"]
 
         pod_manifest = {
@@ -40,23 +57,23 @@ class KubernetesBackend(Backend):
             "kind": "Pod",
             "metadata": {"name": instance_id},
             "spec": {
-                "volumes": [{"name": "workdir", "emptyDir": {}}],
+                "volumes": self.__get_volumes(request),
                 "containers": self.__get_anvil_containers(request)
                 + self.__get_daemon_containers(request),
             },
         }
 
-        api_response: V1Pod = self.__core_v1.create_namespaced_pod(
+        api_response: V1Pod = await self.__core_v1.create_namespaced_pod(
             namespace="default", body=pod_manifest
         )
 
         while True:
-            api_response = self.__core_v1.read_namespaced_pod(
+            api_response = await self.__core_v1.read_namespaced_pod(
                 name=pod_manifest["metadata"]["name"], namespace="default"
             )
             if api_response.status.phase != "Pending":
                 break
-            time.sleep(1)
+            await asyncio.sleep(1)
 
         anvil_instances = {}
         for offset, anvil_id in enumerate(request.get("anvil_instances", []).keys()):
@@ -66,12 +83,11 @@ class KubernetesBackend(Backend):
                 "port": 8545 + offset,
             }
 
-            self._prepare_node(
+            await self._prepare_node(
                 request["anvil_instances"][anvil_id],
-                Web3(
-                    Web3.HTTPProvider(
-                        f"http://{anvil_instances[anvil_id]['ip']}:{anvil_instances[anvil_id]['port']}"
-                    )
+                self._get_web3(
+                    instance_id,
+                    f"http://{anvil_instances[anvil_id]['ip']}:{anvil_instances[anvil_id]['port']}",
                 ),
             )
 
@@ -90,6 +106,39 @@ class KubernetesBackend(Backend):
             metadata={},
         )
 
+    def __get_volumes(self, args: CreateInstanceRequest) -> List[Any]:
+        volumes = []
+        for anvil_id, anvil_args in args.get("anvil_instances", {}).items():
+            if get_data_medium(anvil_args) == "memory":
+                # one per chain, so the pages are charged to the container
+                # writing them and not shared between chains
+                volumes.append(
+                    {
+                        "name": self.__get_volume_name(anvil_id, anvil_args),
+                        "emptyDir": {
+                            "medium": "Memory",
+                            "sizeLimit": f"{get_data_size_limit(anvil_args)}Mi",
+                        },
+                    }
+                )
+            elif not any(volume["name"] == "workdir" for volume in volumes):
+                volumes.append({"name": "workdir", "emptyDir": {}})
+
+        return volumes
+
+    def __get_volume_name(self, anvil_id: str, anvil_args: LaunchAnvilInstanceArgs) -> str:
+        if get_data_medium(anvil_args) == "memory":
+            return f"data-{anvil_id}"
+
+        return "workdir"
+
+    def __get_resources(self, anvil_args: LaunchAnvilInstanceArgs) -> Dict[str, Any]:
+        # the scheduler has to know that the tmpfs lives in memory
+        if get_data_medium(anvil_args) == "memory":
+            return {"requests": {"memory": f"{get_data_size_limit(anvil_args)}Mi"}}
+
+        return {}
+
     def __get_anvil_containers(self, args: CreateInstanceRequest) -> List[Any]:
         return [
             {
@@ -111,9 +160,10 @@ class KubernetesBackend(Backend):
                 "volumeMounts": [
                     {
                         "mountPath": "/data",
-                        "name": "workdir",
+                        "name": self.__get_volume_name(anvil_id, anvil_args),
                     }
                 ],
+                "resources": self.__get_resources(anvil_args),
             }
             for offset, (anvil_id, anvil_args) in enumerate(
                 args.get("anvil_instances", []).items()
@@ -135,16 +185,19 @@ class KubernetesBackend(Backend):
             for (daemon_id, daemon_args) in args.get("daemon_instances", []).items()
         ]
 
-    def kill_instance(self, instance_id: str) -> UserData:
-        instance = self._database.unregister_instance(instance_id)
-        if instance is None:
-            return None
+    async def _kill_instance_impl(self, instance: UserData):
+        instance_id = instance["instance_id"]
 
-        self.__core_v1.delete_namespaced_pod(namespace="default", name=instance_id, grace_period_seconds=0)
+        try:
+            await self.__core_v1.delete_namespaced_pod(namespace="default", name=instance_id, grace_period_seconds=0)
+        except ApiException as e:
+            # another replica already got to it
+            if e.status != http.client.NOT_FOUND:
+                raise
 
         while True:
             try:
-                self.__core_v1.read_namespaced_pod(
+                await self.__core_v1.read_namespaced_pod(
                     namespace="default",
                     name=instance_id,
                 )
@@ -152,6 +205,4 @@ class KubernetesBackend(Backend):
                 if e.status == http.client.NOT_FOUND:
                     break
 
-            time.sleep(0.5)
-
-        return instance
+            await asyncio.sleep(0.5)
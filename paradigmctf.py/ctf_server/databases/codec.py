@@ -0,0 +1,111 @@
+import abc
+import json
+import socket
+import struct
+from typing import Dict
+
+from ctf_server.types import InstanceInfo, UserData
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec(abc.ABC):
+    @abc.abstractmethod
+    def encode(self, instance: UserData) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def decode(self, data: bytes) -> UserData:
+        pass
+
+
+class JsonCodec(Codec):
+    def encode(self, instance: UserData) -> bytes:
+        return json.dumps(instance, separators=(",", ":")).encode("utf8")
+
+    def decode(self, data: bytes) -> UserData:
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    def __init__(self):
+        if msgpack is None:
+            raise Exception("msgpack codec requires the msgpack package")
+
+    def encode(self, instance: UserData) -> bytes:
+        return msgpack.packb(instance)
+
+    def decode(self, data: bytes) -> UserData:
+        return msgpack.unpackb(data)
+
+
+def load_codec(name: str) -> Codec:
+    if name == "json":
+        return JsonCodec()
+    elif name == "msgpack":
+        return MsgpackCodec()
+
+    raise Exception("invalid codec", name)
+
+
+def pack_ip(ip: str) -> bytes:
+    family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+    return socket.inet_pton(family, ip)
+
+
+def unpack_ip(packed_ip: bytes) -> str:
+    family = socket.AF_INET6 if len(packed_ip) == 16 else socket.AF_INET
+    return socket.inet_ntop(family, packed_ip)
+
+
+# the proxy only ever needs to know where each chain lives, so the routes are
+# kept next to the document as a list of fixed-layout records:
+#   u8 id length | id | u8 ip length | packed ip | u16 port
+def encode_routes(anvil_instances: Dict[str, InstanceInfo]) -> bytes:
+    routes = bytearray()
+    for anvil_id, anvil_instance in anvil_instances.items():
+        encoded_id = anvil_id.encode("utf8")
+        packed_ip = pack_ip(anvil_instance["ip"])
+
+        routes += struct.pack("!B", len(encoded_id)) + encoded_id
+        routes += struct.pack("!B", len(packed_ip)) + packed_ip
+        routes += struct.pack("!H", anvil_instance["port"])
+
+    return bytes(routes)
+
+
+def decode_routes(data: bytes) -> Dict[str, InstanceInfo]:
+    routes: Dict[str, InstanceInfo] = {}
+
+    offset = 0
+    while offset < len(data):
+        id_length = data[offset]
+        anvil_id = data[offset + 1 : offset + 1 + id_length].decode("utf8")
+        offset += 1 + id_length
+
+        ip_length = data[offset]
+        ip = unpack_ip(data[offset + 1 : offset + 1 + ip_length])
+        offset += 1 + ip_length
+
+        (port,) = struct.unpack_from("!H", data, offset)
+        offset += 2
+
+        routes[anvil_id] = {
+            "id": anvil_id,
+            "ip": ip,
+            "port": port,
+        }
+
+    return routes
+
+
+def encode_instance_routes(instance: UserData) -> bytes:
+    # a hibernated instance has nowhere to route to, which is how the proxy
+    # tells it apart from a running one
+    if instance.get("hibernated", False):
+        return b""
+
+    return encode_routes(instance["anvil_instances"])
@@ -1,6 +1,7 @@
 import abc
-from typing import Dict, List, Optional
-from ctf_server.types import UserData
+import time
+from typing import Dict, List, Optional, Tuple
+from ctf_server.types import InstanceEvent, InstanceInfo, UserData
 
 class Database(abc.ABC):
     def __init__(self) -> None:
@@ -14,19 +15,75 @@ class Database(abc.ABC):
     def unregister_instance(self, instance_id: str) -> UserData:
         pass
 
+    def update_instance(self, instance_id: str, instance: UserData):
+        raise Exception("not supported")
+
     @abc.abstractmethod
     def get_instance(self, instance_id: str) -> Optional[UserData]:
         pass
     
+    def get_instances(self, instance_ids: List[str]) -> List[Optional[UserData]]:
+        return [self.get_instance(instance_id) for instance_id in instance_ids]
+
     @abc.abstractmethod
     def get_instance_by_external_id(self, external_id: str) -> Optional[UserData]:
         pass
 
+    def get_routes(self, external_id: str) -> Optional[Dict[str, InstanceInfo]]:
+        instance = self.get_instance_by_external_id(external_id)
+        if instance is None:
+            return None
+
+        return instance["anvil_instances"]
+
+    # launches are only reserved within this process unless the database can
+    # coordinate them between replicas
+    def reserve_instance(self, instance_id: str, token: str, ttl: float) -> bool:
+        return True
+
+    def release_instance(self, instance_id: str, token: str):
+        pass
+
+    def is_reserved(self, instance_id: str) -> bool:
+        return False
+
+    def get_all_instances(self) -> List[UserData]:
+        return []
+
     def get_expired_instances(self) -> List[UserData]:
         pass
 
+    def claim_expired_instances(self, lease: float) -> List[UserData]:
+        return self.get_expired_instances()
+
+    def get_next_expiry(self) -> Optional[float]:
+        return None
+
     def get_metadata(self, instance_id: str) -> Optional[Dict[str, str]]:
         pass
 
     def update_metadata(self, instance_id: str, metadata: Dict[str, str]):
         pass
+
+    def get_snapshot(self, key: str) -> Optional[bytes]:
+        pass
+
+    def put_snapshot(self, key: str, snapshot: bytes):
+        pass
+
+    def delete_snapshot(self, key: str):
+        pass
+
+    # the proxy reports traffic at most every few seconds per instance, so
+    # this is only as precise as the hibernation needs it to be
+    def record_activity(self, external_id: str):
+        pass
+
+    def get_idle_instances(self, idle_since: float) -> List[UserData]:
+        return []
+
+    def read_events(
+        self, cursor: Optional[str], timeout: float
+    ) -> Tuple[Optional[str], List[InstanceEvent]]:
+        time.sleep(timeout)
+        return cursor, []
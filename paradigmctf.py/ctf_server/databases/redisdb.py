@@ -1,102 +1,404 @@
-import json
 import time
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import redis
-from ctf_server.types import UserData
+from ctf_server.types import InstanceEvent, InstanceInfo, UserData
 
+from .codec import Codec, JsonCodec, decode_routes, encode_instance_routes
 from .database import Database
 
+# moves every due instance from the expiries set into the claims set, scored
+# by the lease deadline, and re-claims leases left behind by dead replicas
+CLAIM_EXPIRED_SCRIPT = """
+local claimed = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, instance_id in ipairs(claimed) do
+    redis.call('ZREM', KEYS[1], instance_id)
+end
+
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, instance_id in ipairs(stale) do
+    table.insert(claimed, instance_id)
+end
+
+for _, instance_id in ipairs(claimed) do
+    redis.call('ZADD', KEYS[2], ARGV[2], instance_id)
+end
+
+return claimed
+"""
+
+# only drops a launch reservation if it's still held by the same launch, so a
+# launch which outlived its reservation can't release someone else's
+RELEASE_RESERVATION_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+
+return 0
+"""
+
+# the proxy only knows the external id of the instance it's talking to
+RECORD_ACTIVITY_SCRIPT = """
+local instance_id = redis.call('HGET', KEYS[1], ARGV[1])
+if instance_id then
+    redis.call('ZADD', KEYS[2], ARGV[2], instance_id)
+end
+"""
+
+# resolves the external id and reads the instance in one round trip, the
+# instance can be unregistered while its external id is still around
+GET_INSTANCE_BY_EXTERNAL_ID_SCRIPT = """
+local instance_id = redis.call('HGET', KEYS[1], ARGV[1])
+if not instance_id then
+    return false
+end
+
+local data = redis.call('GET', 'instance/' .. instance_id)
+if not data then
+    return false
+end
+
+return {data, redis.call('HGETALL', 'metadata/' .. instance_id)}
+"""
+
+# only rewrites an instance that's still registered, a late update from a
+# hibernation or resume racing a kill mustn't bring it back without an expiry
+UPDATE_INSTANCE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('ZADD', KEYS[3], 'XX', ARGV[4], ARGV[5])
+redis.call('XADD', KEYS[4], 'MAXLEN', '~', ARGV[6], '*', 'instance_id', ARGV[5], 'type', 'updated')
+return 1
+"""
+
+SCAN_BATCH_SIZE = 500
+EVENTS_MAX_LENGTH = 10000
+# bumped whenever stored instances have to be rewritten on startup
+SCHEMA_VERSION = 2
+
 
 class RedisDatabase(Database):
-    def __init__(self, url: str, redis_kwargs: Dict[str, Any] = {}) -> None:
+    def __init__(
+        self, url: str, redis_kwargs: Dict[str, Any] = {}, codec: Codec = JsonCodec()
+    ) -> None:
         super().__init__()
 
+        self.__codec = codec
         self.__client: redis.Redis = redis.Redis.from_url(
             url,
             decode_responses=True,
             **redis_kwargs,
         )
+        # encoded documents and routes aren't necessarily valid utf8
+        self.__blob_client: redis.Redis = redis.Redis.from_url(
+            url,
+            decode_responses=False,
+            **redis_kwargs,
+        )
+
+        self.__claim_expired = self.__client.register_script(CLAIM_EXPIRED_SCRIPT)
+        self.__release_reservation = self.__client.register_script(
+            RELEASE_RESERVATION_SCRIPT
+        )
+        self.__record_activity = self.__client.register_script(
+            RECORD_ACTIVITY_SCRIPT
+        )
+        self.__update_instance = self.__blob_client.register_script(
+            UPDATE_INSTANCE_SCRIPT
+        )
+        self.__get_instance_by_external_id = self.__blob_client.register_script(
+            GET_INSTANCE_BY_EXTERNAL_ID_SCRIPT
+        )
+
+        self.__migrate()
+
+    def __migrate(self):
+        version = self.__client.get("schema_version")
+        if version is not None and int(version) >= SCHEMA_VERSION:
+            return
+
+        for key in self.__client.scan_iter(match="instance/*", count=SCAN_BATCH_SIZE):
+            self.__migrate_json_document(key)
+
+        self.__client.set("schema_version", SCHEMA_VERSION)
+
+    def __migrate_json_document(self, key: str):
+        # instances used to be RedisJSON documents, which a plain GET refuses,
+        # and had neither routes nor an activity timestamp. replicas starting
+        # at the same time race on this, so the key is watched and whoever
+        # loses leaves it to the winner
+        with self.__blob_client.pipeline() as pipeline:
+            try:
+                pipeline.watch(key)
+                try:
+                    pipeline.get(key)
+                    return
+                except redis.ResponseError as e:
+                    if not str(e).startswith("WRONGTYPE"):
+                        raise
+
+                instance = self.__client.json().get(key)
+                if instance is None:
+                    return
+
+                pipeline.multi()
+                pipeline.delete(key)
+                pipeline.set(key, self.__codec.encode(instance))
+                pipeline.hset(
+                    "routes",
+                    instance["external_id"],
+                    encode_instance_routes(instance),
+                )
+                pipeline.zadd("activity", {instance["instance_id"]: time.time()}, nx=True)
+                pipeline.execute()
+            except redis.WatchError:
+                pass
 
     def register_instance(self, instance_id: str, instance: UserData):
-        pipeline = self.__client.pipeline()
+        pipeline = self.__blob_client.pipeline()
 
         try:
-            pipeline.json().set(f"instance/{instance['instance_id']}", "$", instance)
+            pipeline.set(
+                f"instance/{instance['instance_id']}", self.__codec.encode(instance)
+            )
             pipeline.hset(
                 "external_ids", instance["external_id"], instance["instance_id"]
             )
+            pipeline.hset(
+                "routes",
+                instance["external_id"],
+                encode_instance_routes(instance),
+            )
             pipeline.zadd(
                 "expiries",
                 {
                     instance["instance_id"]: int(instance["expires_at"]),
                 },
             )
+            pipeline.zadd("activity", {instance["instance_id"]: time.time()})
+            if len(instance.get("metadata", {})) > 0:
+                pipeline.hset(
+                    f"metadata/{instance['instance_id']}", mapping=instance["metadata"]
+                )
+            self.__publish_event(pipeline, instance["instance_id"], "registered")
         finally:
             pipeline.execute()
 
+    def reserve_instance(self, instance_id: str, token: str, ttl: float) -> bool:
+        return bool(
+            self.__client.set(
+                f"reservation/{instance_id}", token, nx=True, px=int(ttl * 1000)
+            )
+        )
+
+    def release_instance(self, instance_id: str, token: str):
+        self.__release_reservation(keys=[f"reservation/{instance_id}"], args=[token])
+
+    def is_reserved(self, instance_id: str) -> bool:
+        return self.__client.exists(f"reservation/{instance_id}") > 0
+
     def update_instance(self, instance_id: str, instance: UserData):
-        raise Exception("not supported")
+        # the external id never changes, so only the routes behind it need
+        # rewriting, metadata lives in its own hash and is left alone
+        self.__update_instance(
+            keys=[f"instance/{instance_id}", "routes", "expiries", "events"],
+            args=[
+                self.__codec.encode(instance),
+                instance["external_id"],
+                encode_instance_routes(instance),
+                int(instance["expires_at"]),
+                instance_id,
+                EVENTS_MAX_LENGTH,
+            ],
+        )
 
     def unregister_instance(self, instance_id: str) -> UserData:
-        instance = self.__client.json().get(f"instance/{instance_id}")
-        if instance is None:
+        data = self.__blob_client.get(f"instance/{instance_id}")
+        if data is None:
             return None
 
+        instance = self.__codec.decode(data)
+
         pipeline = self.__client.pipeline()
         try:
-            pipeline.json().delete(f"instance/{instance_id}")
+            pipeline.delete(f"instance/{instance_id}")
             pipeline.hdel("external_ids", instance["external_id"])
+            pipeline.hdel("routes", instance["external_id"])
             pipeline.zrem("expiries", instance_id)
+            pipeline.zrem("claims", instance_id)
+            pipeline.zrem("activity", instance_id)
             pipeline.delete(f"metadata/{instance_id}")
+            self.__publish_event(pipeline, instance_id, "unregistered")
             return instance
         finally:
             pipeline.execute()
 
     def get_instance(self, instance_id: str) -> Optional[UserData]:
-        instance: Optional[UserData] = self.__client.json().get(f"instance/{instance_id}")
-        if instance is None:
-            return None
-        
-        instance['metadata'] = {}
-        metadata = self.__client.hgetall(f"metadata/{instance_id}")
-        if metadata is not None:
-            instance['metadata'] = metadata
+        return self.get_instances([instance_id])[0]
 
-        return instance
+    def get_instances(self, instance_ids: List[str]) -> List[Optional[UserData]]:
+        if len(instance_ids) == 0:
+            return []
 
+        pipeline = self.__blob_client.pipeline(transaction=False)
+        for instance_id in instance_ids:
+            pipeline.get(f"instance/{instance_id}")
+            pipeline.hgetall(f"metadata/{instance_id}")
+        results = pipeline.execute()
+
+        return [
+            self.__load_instance(data, metadata)
+            for data, metadata in zip(results[::2], results[1::2])
+        ]
 
     def get_instance_by_external_id(self, rpc_id: str) -> Optional[UserData]:
-        instance_id = self.__client.hget("external_ids", rpc_id)
-        if instance_id is None:
+        result = self.__get_instance_by_external_id(
+            keys=["external_ids"], args=[rpc_id]
+        )
+        if result is None:
             return None
 
-        return self.get_instance(instance_id)
+        data, metadata = result
+        return self.__load_instance(
+            data, dict(zip(metadata[::2], metadata[1::2]))
+        )
 
-    def get_all_instances(self) -> List[UserData]:
-        keys = self.__client.keys("instance/*")
+    def get_routes(self, external_id: str) -> Optional[Dict[str, InstanceInfo]]:
+        data = self.__blob_client.hget("routes", external_id)
+        if data is None:
+            return None
 
+        return decode_routes(data)
+
+    def get_all_instances(self) -> List[UserData]:
         result = []
-        for key in keys:
-            result.append(self.get_instance(key.split("/")[1]))
 
-        return result
+        batch = []
+        for key in self.__client.scan_iter(match="instance/*", count=SCAN_BATCH_SIZE):
+            batch.append(key.split("/", 1)[1])
+            if len(batch) == SCAN_BATCH_SIZE:
+                result += self.get_instances(batch)
+                batch = []
+        result += self.get_instances(batch)
+
+        return [instance for instance in result if instance is not None]
 
     def get_expired_instances(self) -> List[UserData]:
         instance_ids = self.__client.zrange(
             "expiries", 0, int(time.time()), byscore=True
         )
 
+        return [
+            instance
+            for instance in self.get_instances(instance_ids)
+            if instance is not None
+        ]
+
+    def claim_expired_instances(self, lease: float) -> List[UserData]:
+        now = time.time()
+        instance_ids = self.__claim_expired(
+            keys=["expiries", "claims"],
+            args=[int(now), int(now + lease)],
+        )
+
         instances = []
-        for instance_id in instance_ids:
-            instances.append(self.get_instance(instance_id))
+        for instance_id, instance in zip(instance_ids, self.get_instances(instance_ids)):
+            if instance is None:
+                # nothing left to tear down, stop re-claiming it
+                self.__client.zrem("claims", instance_id)
+                continue
+
+            instances.append(instance)
 
         return instances
 
+    def get_next_expiry(self) -> Optional[float]:
+        pipeline = self.__client.pipeline()
+        pipeline.zrange("expiries", 0, 0, withscores=True)
+        pipeline.zrange("claims", 0, 0, withscores=True)
+
+        heads = [head[0][1] for head in pipeline.execute() if len(head) > 0]
+        if len(heads) == 0:
+            return None
+
+        return min(heads)
+
+    def __load_instance(
+        self, data: Optional[bytes], metadata: Optional[Dict[bytes, bytes]]
+    ) -> Optional[UserData]:
+        if data is None:
+            return None
+
+        instance = self.__codec.decode(data)
+        instance["metadata"] = {}
+        if metadata is not None:
+            instance["metadata"] = {
+                k.decode("utf8"): v.decode("utf8") for k, v in metadata.items()
+            }
+
+        return instance
+
     def update_metadata(self, instance_id: str, metadata: Dict[str, str]):
         pipeline = self.__client.pipeline()
         try:
             for k, v in metadata.items():
                 pipeline.hset(f"metadata/{instance_id}", k, v)
+            self.__publish_event(pipeline, instance_id, "metadata")
         finally:
             pipeline.execute()
+
+    def get_snapshot(self, key: str) -> Optional[bytes]:
+        return self.__blob_client.get(f"snapshot/{key}")
+
+    def put_snapshot(self, key: str, snapshot: bytes):
+        self.__blob_client.set(f"snapshot/{key}", snapshot)
+
+    def delete_snapshot(self, key: str):
+        self.__client.delete(f"snapshot/{key}")
+
+    def record_activity(self, external_id: str):
+        self.__record_activity(keys=["external_ids", "activity"], args=[external_id, time.time()])
+
+    def get_idle_instances(self, idle_since: float) -> List[UserData]:
+        instance_ids = self.__client.zrange("activity", "-inf", idle_since, byscore=True)
+
+        return [
+            instance
+            for instance in self.get_instances(instance_ids)
+            if instance is not None
+        ]
+
+    def read_events(
+        self, cursor: Optional[str], timeout: float
+    ) -> Tuple[Optional[str], List[InstanceEvent]]:
+        if cursor is None:
+            # start from the newest entry rather than "$", so nothing published
+            # between two reads is skipped
+            newest = self.__client.xrevrange("events", count=1)
+            cursor = newest[0][0] if len(newest) > 0 else "0-0"
+
+        streams = self.__client.xread(
+            {"events": cursor}, block=int(timeout * 1000)
+        )
+
+        events: List[InstanceEvent] = []
+        for _, entries in streams or []:
+            for entry_id, fields in entries:
+                cursor = entry_id
+                events.append(
+                    InstanceEvent(instance_id=fields["instance_id"], type=fields["type"])
+                )
+
+        return cursor, events
+
+    def __publish_event(self, pipeline: redis.client.Pipeline, instance_id: str, type: str):
+        pipeline.xadd(
+            "events",
+            {"instance_id": instance_id, "type": type},
+            maxlen=EVENTS_MAX_LENGTH,
+            approximate=True,
+        )
@@ -1,109 +1,388 @@
 import json
 import sqlite3
-from typing import List, Optional
+import time
+from collections import deque
+from threading import Condition, Lock, local
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
 from ctf_server.databases import Database
-from ctf_server.types import InstanceInfo
-from threading import Lock
+from ctf_server.types import InstanceEvent, InstanceInfo, UserData
 
+from .codec import Codec, JsonCodec, decode_routes, encode_instance_routes
 
-class SQLiteDatabase(Database):
-    def __init__(self, db_path: str):
-        super().__init__()
 
-        self.__conn_lock = Lock()
-        self.__conn = sqlite3.connect(database=db_path, check_same_thread=False)
-        self.__conn.execute(
-            """
-CREATE TABLE IF NOT EXISTS anvil_instances
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances
+(
+    instance_id VARCHAR PRIMARY KEY,
+    external_id VARCHAR NOT NULL UNIQUE,
+    expires_at REAL NOT NULL,
+    claimed_until REAL NOT NULL DEFAULT 0,
+    instance_data BLOB NOT NULL,
+    routes BLOB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS instances_expires_at ON instances (expires_at);
+
+CREATE TABLE IF NOT EXISTS metadata
+(
+    instance_id VARCHAR NOT NULL REFERENCES instances (instance_id) ON DELETE CASCADE,
+    key VARCHAR NOT NULL,
+    value VARCHAR NOT NULL,
+    PRIMARY KEY (instance_id, key)
+);
+
+CREATE TABLE IF NOT EXISTS snapshots
+(
+    key VARCHAR PRIMARY KEY,
+    data BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS activity
+(
+    instance_id VARCHAR PRIMARY KEY REFERENCES instances (instance_id) ON DELETE CASCADE,
+    last_active_at REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS activity_last_active_at ON activity (last_active_at);
+
+CREATE TABLE IF NOT EXISTS reservations
 (
     instance_id VARCHAR PRIMARY KEY,
-    rpc_id VARCHAR,
-    instance_data JSON
-);"""
+    token VARCHAR NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+EVENTS_MAX_LENGTH = 10000
+# sqlite builds before 3.32 refuse statements with more than 999 parameters,
+# so IN lists are split into chunks of this size
+MAX_QUERY_PARAMS = 500
+
+
+def chunks(items: List[str]) -> Iterator[List[str]]:
+    for i in range(0, len(items), MAX_QUERY_PARAMS):
+        yield items[i : i + MAX_QUERY_PARAMS]
+
+
+class SQLiteDatabase(Database):
+    def __init__(self, db_path: str, codec: Codec = JsonCodec()):
+        super().__init__()
+
+        self.__codec = codec
+        self.__db_path = db_path
+        self.__db_uri = False
+        if db_path == ":memory:":
+            # a private in-memory database can't be shared between the writer
+            # and the per-thread readers, so use a named shared-cache one
+            self.__db_path = f"file:paradigmctf-{id(self)}?mode=memory&cache=shared"
+            self.__db_uri = True
+
+        self.__write_lock = Lock()
+        self.__write_conn = self.__connect()
+        self.__write_conn.execute("PRAGMA journal_mode = WAL")
+        self.__write_conn.execute("PRAGMA synchronous = NORMAL")
+        self.__write_conn.executescript(SCHEMA)
+        self.__migrate()
+
+        # the orchestrator runs database calls on asyncio.to_thread workers,
+        # each of which reads through its own connection
+        self.__readers = local()
+
+        # sqlite has no way to notify other connections, so change events are
+        # only visible to this process
+        self.__events: Deque[Tuple[int, InstanceEvent]] = deque(maxlen=EVENTS_MAX_LENGTH)
+        self.__events_seq = 0
+        self.__events_cond = Condition()
+
+    def __connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            database=self.__db_path,
+            uri=self.__db_uri,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def __reader(self) -> sqlite3.Connection:
+        conn = getattr(self.__readers, "conn", None)
+        if conn is None:
+            conn = self.__connect()
+            if self.__db_uri:
+                # shared-cache readers would otherwise block on the writer's
+                # table locks, WAL gives file-backed readers the same behavior
+                conn.execute("PRAGMA read_uncommitted = 1")
+            self.__readers.conn = conn
+
+        return conn
+
+    def __migrate(self):
+        self.__migrate_anvil_instances()
+
+    def __migrate_anvil_instances(self):
+        # instances used to live in a single anvil_instances table which never
+        # recorded the external id or the expiry
+        exists = self.__write_conn.execute(
+            """SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'anvil_instances'"""
+        ).fetchone()
+        if exists is None:
+            return
+
+        rows = self.__write_conn.execute(
+            """SELECT instance_id, instance_data FROM anvil_instances"""
+        ).fetchall()
+
+        with self.__write_lock:
+            self.__write_conn.execute("BEGIN IMMEDIATE")
+            try:
+                for instance_id, instance_data in rows:
+                    instance = json.loads(instance_data)
+                    self.__insert_instance(instance_id, instance)
+                self.__write_conn.execute("DROP TABLE anvil_instances")
+                self.__write_conn.execute("COMMIT")
+            except:
+                self.__write_conn.execute("ROLLBACK")
+                raise
+
+    def __insert_instance(self, instance_id: str, instance: UserData):
+        self.__write_conn.execute(
+            """INSERT INTO instances(instance_id, external_id, expires_at, instance_data, routes) VALUES (?, ?, ?, ?, ?)""",
+            (
+                instance_id,
+                instance["external_id"],
+                instance["expires_at"],
+                self.__codec.encode(instance),
+                encode_instance_routes(instance),
+            ),
         )
 
-    def register_instance(self, instance_id: str, instance: InstanceInfo):
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                """INSERT INTO anvil_instances(instance_id, instance_data) VALUES (?, ?)""",
-                (instance_id, json.dumps(instance)),
+    def register_instance(self, instance_id: str, instance: UserData):
+        with self.__write_lock:
+            self.__insert_instance(instance_id, instance)
+            self.__write_conn.execute(
+                """INSERT INTO activity(instance_id, last_active_at) VALUES (?, ?)""",
+                (instance_id, time.time()),
             )
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
-
-    def update_instance(self, instance_id: str, instance: InstanceInfo):
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                """UPDATE anvil_instances SET instance_data = ? WHERE instance_id = ?""",
-                (json.dumps(instance), instance_id),
+            self.__write_conn.executemany(
+                """INSERT INTO metadata(instance_id, key, value) VALUES (?, ?, ?)""",
+                [(instance_id, k, v) for k, v in instance.get("metadata", {}).items()],
             )
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
-
-    def unregister_instance(self, instance_id: str) -> InstanceInfo:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                """DELETE FROM anvil_instances WHERE instance_id = ? RETURNING instance_data""", (instance_id,)
+
+        self.__publish_event(instance_id, "registered")
+
+    def reserve_instance(self, instance_id: str, token: str, ttl: float) -> bool:
+        now = time.time()
+
+        with self.__write_lock:
+            self.__write_conn.execute(
+                """DELETE FROM reservations WHERE instance_id = ? AND expires_at <= ?""",
+                (instance_id, now),
             )
-            row = cursor.fetchone()
-            if row is None:
-                return None
-            
-            return json.loads(row[0])
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
-
-    def get_all_instances(self) -> List[InstanceInfo]:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                """SELECT instance_data FROM anvil_instances"""
+            cursor = self.__write_conn.execute(
+                """INSERT INTO reservations(instance_id, token, expires_at) VALUES (?, ?, ?) ON CONFLICT (instance_id) DO NOTHING""",
+                (instance_id, token, now + ttl),
             )
-            result = []
-            while True:
-                row = cursor.fetchone()
-                if row is None:
-                    break
-
-                result.append(json.loads(row[0]))
-            return result
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
-    
-    def get_instance_by_external_id(self, rpc_id: str) -> InstanceInfo | None:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                """SELECT instance_data FROM anvil_instances WHERE rpc_id = ?""", (rpc_id,)
+
+        return cursor.rowcount == 1
+
+    def release_instance(self, instance_id: str, token: str):
+        with self.__write_lock:
+            self.__write_conn.execute(
+                """DELETE FROM reservations WHERE instance_id = ? AND token = ?""",
+                (instance_id, token),
             )
-            row = cursor.fetchone()
-            if row is None:
-                return None
-            
-            return json.loads(row[0])
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
-
-    def get_instance(self, instance_id: str) -> InstanceInfo | None:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                """SELECT instance_data FROM anvil_instances WHERE instance_id = ?""", (instance_id,)
+
+    def is_reserved(self, instance_id: str) -> bool:
+        row = self.__reader().execute(
+            """SELECT 1 FROM reservations WHERE instance_id = ? AND expires_at > ?""",
+            (instance_id, time.time()),
+        ).fetchone()
+
+        return row is not None
+
+    def update_instance(self, instance_id: str, instance: UserData):
+        with self.__write_lock:
+            self.__write_conn.execute(
+                """UPDATE instances SET external_id = ?, expires_at = ?, instance_data = ?, routes = ? WHERE instance_id = ?""",
+                (
+                    instance["external_id"],
+                    instance["expires_at"],
+                    self.__codec.encode(instance),
+                    encode_instance_routes(instance),
+                    instance_id,
+                ),
             )
-            row = cursor.fetchone()
+
+        self.__publish_event(instance_id, "updated")
+
+    def unregister_instance(self, instance_id: str) -> Optional[UserData]:
+        with self.__write_lock:
+            row = self.__write_conn.execute(
+                """DELETE FROM instances WHERE instance_id = ? RETURNING instance_data""",
+                (instance_id,),
+            ).fetchone()
             if row is None:
                 return None
-            
-            return json.loads(row[0])
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
-        
+
+        self.__publish_event(instance_id, "unregistered")
+
+        return self.__codec.decode(row[0])
+
+    def get_instance(self, instance_id: str) -> Optional[UserData]:
+        return self.get_instances([instance_id])[0]
+
+    def get_instances(self, instance_ids: List[str]) -> List[Optional[UserData]]:
+        rows = []
+        for chunk in chunks(instance_ids):
+            placeholders = ", ".join("?" * len(chunk))
+            rows += self.__reader().execute(
+                f"""SELECT instance_data FROM instances WHERE instance_id IN ({placeholders})""",
+                chunk,
+            ).fetchall()
+
+        instances = self.__load_instances(rows)
+        return [instances.get(instance_id) for instance_id in instance_ids]
+
+    def get_instance_by_external_id(self, external_id: str) -> Optional[UserData]:
+        rows = self.__reader().execute(
+            """SELECT instance_data FROM instances WHERE external_id = ?""",
+            (external_id,),
+        ).fetchall()
+
+        instances = self.__load_instances(rows)
+        if len(instances) == 0:
+            return None
+
+        return next(iter(instances.values()))
+
+    def get_routes(self, external_id: str) -> Optional[Dict[str, InstanceInfo]]:
+        row = self.__reader().execute(
+            """SELECT routes FROM instances WHERE external_id = ?""",
+            (external_id,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        return decode_routes(row[0])
+
+    def get_all_instances(self) -> List[UserData]:
+        rows = self.__reader().execute(
+            """SELECT instance_data FROM instances"""
+        ).fetchall()
+
+        return list(self.__load_instances(rows).values())
+
+    def get_expired_instances(self) -> List[UserData]:
+        rows = self.__reader().execute(
+            """SELECT instance_data FROM instances WHERE expires_at <= ?""",
+            (time.time(),),
+        ).fetchall()
+
+        return list(self.__load_instances(rows).values())
+
+    def claim_expired_instances(self, lease: float) -> List[UserData]:
+        now = time.time()
+
+        with self.__write_lock:
+            rows = self.__write_conn.execute(
+                """UPDATE instances SET claimed_until = ? WHERE expires_at <= ? AND claimed_until <= ? RETURNING instance_data""",
+                (now + lease, now, now),
+            ).fetchall()
+
+        return list(self.__load_instances(rows).values())
+
+    def get_next_expiry(self) -> Optional[float]:
+        row = self.__reader().execute(
+            """SELECT MIN(MAX(expires_at, claimed_until)) FROM instances"""
+        ).fetchone()
+
+        return row[0]
+
+    def get_metadata(self, instance_id: str) -> Optional[Dict[str, str]]:
+        instance = self.get_instance(instance_id)
+        if instance is None:
+            return None
+
+        return instance["metadata"]
+
+    def update_metadata(self, instance_id: str, metadata: Dict[str, str]):
+        with self.__write_lock:
+            self.__write_conn.executemany(
+                """INSERT INTO metadata(instance_id, key, value) VALUES (?, ?, ?) ON CONFLICT (instance_id, key) DO UPDATE SET value = excluded.value""",
+                [(instance_id, k, v) for k, v in metadata.items()],
+            )
+
+        self.__publish_event(instance_id, "metadata")
+
+    def get_snapshot(self, key: str) -> Optional[bytes]:
+        row = self.__reader().execute(
+            """SELECT data FROM snapshots WHERE key = ?""",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        return row[0]
+
+    def put_snapshot(self, key: str, snapshot: bytes):
+        with self.__write_lock:
+            self.__write_conn.execute(
+                """INSERT INTO snapshots(key, data) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET data = excluded.data""",
+                (key, snapshot),
+            )
+
+    def delete_snapshot(self, key: str):
+        with self.__write_lock:
+            self.__write_conn.execute("""DELETE FROM snapshots WHERE key = ?""", (key,))
+
+    def record_activity(self, external_id: str):
+        with self.__write_lock:
+            self.__write_conn.execute(
+                """INSERT INTO activity(instance_id, last_active_at) SELECT instance_id, ? FROM instances WHERE external_id = ? ON CONFLICT (instance_id) DO UPDATE SET last_active_at = excluded.last_active_at""",
+                (time.time(), external_id),
+            )
+
+    def get_idle_instances(self, idle_since: float) -> List[UserData]:
+        # instances registered before activity was tracked count as idle
+        rows = self.__reader().execute(
+            """SELECT instance_data FROM instances LEFT JOIN activity USING (instance_id) WHERE COALESCE(last_active_at, 0) <= ?""",
+            (idle_since,),
+        ).fetchall()
+
+        return list(self.__load_instances(rows).values())
+
+    def read_events(
+        self, cursor: Optional[str], timeout: float
+    ) -> Tuple[Optional[str], List[InstanceEvent]]:
+        with self.__events_cond:
+            seq = self.__events_seq if cursor is None else int(cursor)
+
+            self.__events_cond.wait_for(lambda: self.__events_seq > seq, timeout)
+
+            events = [event for event_seq, event in self.__events if event_seq > seq]
+            return str(self.__events_seq), events
+
+    def __publish_event(self, instance_id: str, type: str):
+        with self.__events_cond:
+            self.__events_seq += 1
+            self.__events.append(
+                (self.__events_seq, InstanceEvent(instance_id=instance_id, type=type))
+            )
+            self.__events_cond.notify_all()
+
+    def __load_instances(self, rows: List[tuple]) -> Dict[str, UserData]:
+        instances: Dict[str, UserData] = {}
+        for (instance_data,) in rows:
+            instance = self.__codec.decode(instance_data)
+            instance["metadata"] = {}
+            instances[instance["instance_id"]] = instance
+
+        for chunk in chunks(list(instances.keys())):
+            placeholders = ", ".join("?" * len(chunk))
+            for instance_id, key, value in self.__reader().execute(
+                f"""SELECT instance_id, key, value FROM metadata WHERE instance_id IN ({placeholders})""",
+                chunk,
+            ):
+                instances[instance_id]["metadata"][key] = value
+
+        return instances
@@ -0,0 +1,224 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+
+import aiohttp
+
+from ctf_server.metrics import metrics
+from ctf_server.types import Call, Evaluation, UserData
+
+EVALUATOR_CONCURRENCY = int(os.getenv("EVALUATOR_CONCURRENCY", "64"))
+EVALUATOR_TIMEOUT = float(os.getenv("EVALUATOR_TIMEOUT", "10"))
+# a chain's head is trusted for this long, so checks spammed in between don't
+# cost a single rpc
+EVALUATOR_HEAD_TTL = float(os.getenv("EVALUATOR_HEAD_TTL", "1"))
+
+
+@dataclass
+class Head:
+    number: int
+    hash: str
+
+
+@dataclass
+class CachedHead:
+    expires_at: float
+    head: asyncio.Future
+
+
+@dataclass
+class CachedEvaluation:
+    block_hash: str
+    evaluation: asyncio.Future
+
+
+def is_starknet_instance(instance: UserData) -> bool:
+    return instance["metadata"].get("type") == "starknet"
+
+
+# runs read-only calls against instance chains, batching every call for a chain
+# into a single json-rpc request and caching the results until a new block
+class ChainEvaluator:
+    def __init__(self):
+        self.__session: aiohttp.ClientSession = None
+
+        # instance id -> anvil id -> last head seen
+        self.__heads: Dict[str, Dict[str, CachedHead]] = {}
+        # instance id -> (anvil id, calls) -> last evaluation
+        self.__cache: Dict[str, Dict[Tuple, CachedEvaluation]] = {}
+
+    async def start(self):
+        self.__session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=EVALUATOR_CONCURRENCY),
+            timeout=aiohttp.ClientTimeout(total=EVALUATOR_TIMEOUT),
+        )
+
+    async def stop(self):
+        await self.__session.close()
+
+    def evict(self, instance_id: str):
+        self.__heads.pop(instance_id, None)
+        self.__cache.pop(instance_id, None)
+
+    async def evaluate(
+        self, instance: UserData, calls: List[Call], anvil_id: str = "main"
+    ) -> Evaluation:
+        anvil_instance = instance["anvil_instances"][anvil_id]
+        url = f"http://{anvil_instance['ip']}:{anvil_instance['port']}"
+
+        starknet = is_starknet_instance(instance)
+        if starknet:
+            url += "/rpc"
+
+        head = await self.__get_head(instance["instance_id"], anvil_id, url, starknet)
+
+        key = (
+            anvil_id,
+            tuple(
+                (call["to"], call["data"], tuple(call.get("calldata", [])))
+                for call in calls
+            ),
+        )
+        cache = self.__cache.setdefault(instance["instance_id"], {})
+
+        cached = cache.get(key)
+        if cached is not None and cached.block_hash == head.hash:
+            metrics.inc("evaluator_cache_hits")
+            return await asyncio.shield(cached.evaluation)
+
+        metrics.inc("evaluator_cache_misses")
+
+        # checks of the same block arriving while this one is in flight wait
+        # for its result instead of sending their own
+        cached = CachedEvaluation(
+            block_hash=head.hash,
+            evaluation=asyncio.ensure_future(
+                self.__call(url, starknet, calls, head.number)
+            ),
+        )
+        cache[key] = cached
+
+        try:
+            return await asyncio.shield(cached.evaluation)
+        except Exception:
+            if cache.get(key) is cached:
+                del cache[key]
+            raise
+
+    async def __call(
+        self, url: str, starknet: bool, calls: List[Call], block_number: int
+    ) -> Evaluation:
+        # pinned to the block we just saw, so the result is exactly the one
+        # belonging to the cached block hash
+        if starknet:
+            results = await self.__rpc(
+                url,
+                [
+                    (
+                        "starknet_call",
+                        [
+                            {
+                                "contract_address": call["to"],
+                                "entry_point_selector": call["data"],
+                                "calldata": call.get("calldata", []),
+                            },
+                            {"block_number": block_number},
+                        ],
+                    )
+                    for call in calls
+                ],
+                batch=False,
+            )
+        else:
+            results = await self.__rpc(
+                url,
+                [
+                    ("eth_call", [{"to": call["to"], "data": call["data"]}, hex(block_number)])
+                    for call in calls
+                ],
+            )
+
+        return Evaluation(
+            block_number=block_number,
+            results=results,
+            evaluated_at=time.time(),
+        )
+
+    async def __get_head(
+        self, instance_id: str, anvil_id: str, url: str, starknet: bool
+    ) -> Head:
+        heads = self.__heads.setdefault(instance_id, {})
+
+        cached = heads.get(anvil_id)
+        if cached is not None and cached.expires_at > time.time():
+            metrics.inc("evaluator_head_hits")
+            return await asyncio.shield(cached.head)
+
+        # concurrent checks of the same chain share a single lookup
+        cached = CachedHead(
+            expires_at=time.time() + EVALUATOR_HEAD_TTL,
+            head=asyncio.ensure_future(self.__fetch_head(url, starknet)),
+        )
+        heads[anvil_id] = cached
+
+        try:
+            return await asyncio.shield(cached.head)
+        except Exception:
+            if heads.get(anvil_id) is cached:
+                del heads[anvil_id]
+            raise
+
+    async def __fetch_head(self, url: str, starknet: bool) -> Head:
+        if starknet:
+            (head,) = await self.__rpc(url, [("starknet_blockHashAndNumber", [])], batch=False)
+            return Head(number=head["block_number"], hash=head["block_hash"])
+
+        (head,) = await self.__rpc(url, [("eth_getBlockByNumber", ["latest", False])])
+        return Head(number=int(head["number"], 16), hash=head["hash"])
+
+    async def __rpc(
+        self, url: str, requests: List[Tuple[str, List[Any]]], batch: bool = True
+    ) -> List[Any]:
+        payloads = [
+            {"jsonrpc": "2.0", "id": id, "method": method, "params": params}
+            for id, (method, params) in enumerate(requests)
+        ]
+
+        if batch:
+            responses = await self.__post(url, payloads)
+        else:
+            # starknet devnets don't take batches, so the requests go out side by
+            # side instead
+            responses = await asyncio.gather(
+                *[self.__post(url, payload) for payload in payloads]
+            )
+
+        # batch responses may come back in any order
+        results = [None] * len(requests)
+        for response in responses:
+            if "error" in response:
+                raise Exception("rpc exception", response["error"])
+
+            results[response["id"]] = response["result"]
+
+        return results
+
+    async def __post(self, url: str, payload: Any) -> Any:
+        start = time.time()
+
+        async with self.__session.post(url, json=payload) as resp:
+            body = await resp.json(content_type=None)
+
+        metrics.observe("evaluator_rpc_duration_seconds", time.time() - start)
+        return body
+
+
+async def evaluate_all(
+    evaluator: ChainEvaluator, instances: List[Tuple[UserData, List[Call]]]
+) -> List[Any]:
+    return await asyncio.gather(
+        *[evaluator.evaluate(instance, calls) for instance, calls in instances],
+        return_exceptions=True,
+    )
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from ctf_server.backends.backend import Backend, get_state_persistence
+from ctf_server.databases.database import Database
+from ctf_server.metrics import metrics
+from ctf_server.types import UserData
+
+# seconds without a proxied request before an instance is hibernated, 0 turns
+# hibernation off
+HIBERNATE_AFTER = float(os.getenv("HIBERNATE_AFTER", "0"))
+HIBERNATE_INTERVAL = float(os.getenv("HIBERNATE_INTERVAL", "30"))
+HIBERNATE_CONCURRENCY = int(os.getenv("HIBERNATE_CONCURRENCY", "4"))
+
+
+def can_hibernate(instance: UserData) -> bool:
+    # only anvil can dump and load its state
+    return (
+        not instance.get("hibernated", False)
+        and instance["metadata"].get("type", "ethereum") == "ethereum"
+        and len(instance["anvil_instances"]) > 0
+        # daemons talk to the chains directly, so they neither show up as
+        # activity nor follow the chains to their new addresses after a resume
+        and len(instance.get("daemon_instances", {})) == 0
+        # a chain without persistence would come back empty
+        and all(
+            get_state_persistence(instance, anvil_id) != "off"
+            for anvil_id in instance["anvil_instances"]
+        )
+    )
+
+
+# stops the chains of instances nobody talked to in a while, the proxy resumes
+# them on the next request
+class IdleHibernator:
+    def __init__(self, database: Database, backend: Backend):
+        self.__database = database
+        self.__backend = backend
+
+        self.__task: Optional[asyncio.Task] = None
+        self.__slots = asyncio.Semaphore(HIBERNATE_CONCURRENCY)
+
+    async def start(self):
+        if HIBERNATE_AFTER <= 0 or not self.__backend.supports_hibernation():
+            return
+
+        self.__task = asyncio.create_task(
+            self.__hibernate_loop(), name=f"{self.__class__.__name__} Hibernator"
+        )
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    async def __hibernate_loop(self):
+        while True:
+            try:
+                await self.__hibernate_idle()
+            except Exception as e:
+                logging.error("failed to hibernate idle instances", exc_info=e)
+
+            await asyncio.sleep(HIBERNATE_INTERVAL)
+
+    async def __hibernate_idle(self):
+        now = time.time()
+
+        # hibernated instances never see activity, so they're all in here too
+        idle = await asyncio.to_thread(
+            self.__database.get_idle_instances, now - HIBERNATE_AFTER
+        )
+
+        instances = [
+            instance
+            for instance in idle
+            # expiring soon anyway, the pruner gets there first
+            if can_hibernate(instance) and instance["expires_at"] > now + HIBERNATE_INTERVAL
+        ]
+
+        hibernated = await asyncio.gather(
+            *[self.__hibernate(instance) for instance in instances]
+        )
+
+        metrics.set(
+            "hibernated_instances",
+            sum(1 for instance in idle if instance.get("hibernated", False))
+            + sum(1 for result in hibernated if result),
+        )
+
+    async def __hibernate(self, instance: UserData) -> bool:
+        async with self.__slots:
+            try:
+                if not await self.__backend.hibernate_instance(instance["instance_id"]):
+                    return False
+            except Exception as e:
+                metrics.inc("hibernate_failures")
+                logging.error(
+                    "failed to hibernate instance: %s", instance["instance_id"], exc_info=e
+                )
+                return False
+
+        logging.info("hibernated idle instance: %s", instance["instance_id"])
+        return True
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from eth_utils import function_signature_to_4byte_selector
+
+from ctf_server.databases.database import Database
+from ctf_server.evaluator import ChainEvaluator, evaluate_all
+from ctf_server.metrics import metrics
+from ctf_server.types import Call, Evaluation, LeaderboardEntry, UserData
+
+KOTH_SCORE_INTERVAL = float(os.getenv("KOTH_SCORE_INTERVAL", "15"))
+
+GET_SCORE_SELECTOR = "0x" + function_signature_to_4byte_selector("getScore()").hex()
+
+
+def is_koth_instance(instance: UserData) -> bool:
+    # koth launchers tag their instances with the challenge they belong to
+    return "koth" in instance["metadata"] and "challenge_address" in instance["metadata"]
+
+
+# periodically scores every live koth instance and keeps a leaderboard per
+# challenge, so standings and submissions never wait on a chain
+class KothScorer:
+    def __init__(self, database: Database, evaluator: ChainEvaluator):
+        self.__database = database
+        self.__evaluator = evaluator
+
+        self.__task: Optional[asyncio.Task] = None
+        self.__leaderboards: Dict[str, List[LeaderboardEntry]] = {}
+
+    async def start(self):
+        self.__task = asyncio.create_task(
+            self.__score_loop(), name=f"{self.__class__.__name__} Scorer"
+        )
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    def get_leaderboard(self, challenge: str) -> Optional[List[LeaderboardEntry]]:
+        return self.__leaderboards.get(challenge)
+
+    async def score(self, instance: UserData) -> LeaderboardEntry:
+        evaluation = await self.__evaluator.evaluate(instance, self.__get_calls(instance))
+        return self.__to_entry(instance, evaluation)
+
+    async def __score_loop(self):
+        while True:
+            try:
+                await self.__score_all()
+            except Exception as e:
+                logging.error("failed to score koth instances", exc_info=e)
+
+            await asyncio.sleep(KOTH_SCORE_INTERVAL)
+
+    async def __score_all(self):
+        start = time.time()
+
+        instances = [
+            instance
+            for instance in await asyncio.to_thread(self.__database.get_all_instances)
+            if is_koth_instance(instance)
+        ]
+
+        # hibernated chains can't have changed, they keep their last score
+        # rather than being woken up
+        previous = {
+            entry["instance_id"]: entry
+            for entries in self.__leaderboards.values()
+            for entry in entries
+        }
+        hibernated = [instance for instance in instances if instance.get("hibernated", False)]
+        instances = [instance for instance in instances if not instance.get("hibernated", False)]
+
+        evaluations = await evaluate_all(
+            self.__evaluator,
+            [(instance, self.__get_calls(instance)) for instance in instances],
+        )
+
+        leaderboards: Dict[str, List[LeaderboardEntry]] = {}
+        for instance in hibernated:
+            if instance["instance_id"] in previous:
+                leaderboards.setdefault(instance["metadata"]["koth"], []).append(
+                    previous[instance["instance_id"]]
+                )
+
+        for instance, evaluation in zip(instances, evaluations):
+            if isinstance(evaluation, Exception):
+                metrics.inc("koth_score_failures")
+                logging.warning(
+                    "failed to score instance %s: %s", instance["instance_id"], evaluation
+                )
+                continue
+
+            # left off the leaderboard, a broken instance mustn't take it down
+            # for everyone else
+            try:
+                entry = self.__to_entry(instance, evaluation)
+            except (ValueError, IndexError, TypeError) as e:
+                metrics.inc("koth_score_failures")
+                logging.warning(
+                    "failed to decode score of instance %s: %s", instance["instance_id"], e
+                )
+                continue
+
+            leaderboards.setdefault(instance["metadata"]["koth"], []).append(entry)
+
+        for entries in leaderboards.values():
+            entries.sort(key=lambda entry: entry["score"], reverse=True)
+
+        self.__leaderboards = leaderboards
+
+        metrics.set("koth_scored_instances", len(instances) + len(hibernated))
+        metrics.observe("koth_sweep_duration_seconds", time.time() - start)
+
+    def __get_calls(self, instance: UserData) -> List[Call]:
+        return [
+            Call(to=instance["metadata"]["challenge_address"], data=GET_SCORE_SELECTOR),
+        ]
+
+    def __to_entry(self, instance: UserData, evaluation: Evaluation) -> LeaderboardEntry:
+        return LeaderboardEntry(
+            team=instance["metadata"].get("team", instance["instance_id"]),
+            instance_id=instance["instance_id"],
+            score=int(evaluation["results"][0], 16),
+            block_number=evaluation["block_number"],
+            evaluated_at=evaluation["evaluated_at"],
+        )
@@ -0,0 +1,41 @@
+from threading import Lock
+from typing import Any, Dict
+
+
+class Metrics:
+    def __init__(self):
+        self.__lock = Lock()
+        self.__counters: Dict[str, float] = {}
+        self.__gauges: Dict[str, float] = {}
+        self.__summaries: Dict[str, Dict[str, float]] = {}
+
+    def inc(self, name: str, value: float = 1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        with self.__lock:
+            self.__gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        with self.__lock:
+            summary = self.__summaries.setdefault(
+                name, {"count": 0, "sum": 0.0, "max": value, "last": value}
+            )
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+            summary["last"] = value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.__lock:
+            return {
+                "counters": dict(self.__counters),
+                "gauges": dict(self.__gauges),
+                "summaries": {
+                    name: dict(summary) for name, summary in self.__summaries.items()
+                },
+            }
+
+
+metrics = Metrics()
@@ -1,36 +1,121 @@
+import asyncio
+import json
 import logging
+import os
 import sys
+import time
 import traceback
 from contextlib import asynccontextmanager
-from typing import Dict
+from typing import Dict, List, Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Query
 
-from .backends.backend import InstanceExists
-from .types import CreateInstanceRequest
+from .admission import AdmissionController, QueueConflict
+from .backends.backend import InstanceExists, get_snapshot_metadata_key
+from .evaluator import ChainEvaluator
+from .hibernation import IdleHibernator
+from .koth import KothScorer, is_koth_instance
+from .metrics import metrics
+from .providers import get_provider_registry
+from .solves import SolveChecker
+from .types import (
+    CheckSolvesRequest,
+    CreateInstanceRequest,
+    InstanceEvent,
+    Snapshot,
+    UserData,
+)
 from .utils import load_backend, load_database
+from .watcher import InstanceWatcher
+
+WATCH_MAX_TIMEOUT = float(os.getenv("WATCH_MAX_TIMEOUT", "60"))
+# how long a launch waits for capacity before the launcher is told its position
+ADMISSION_WAIT = float(os.getenv("ADMISSION_WAIT", "10"))
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global database, backend
+    global database, backend, watcher, admission, evaluator, koth_scorer, solve_checker, hibernator
     database = load_database()
     backend = load_backend(database)
+    watcher = InstanceWatcher(database)
+    admission = AdmissionController()
+    evaluator = ChainEvaluator()
+    koth_scorer = KothScorer(database, evaluator)
+    solve_checker = SolveChecker(evaluator)
+    hibernator = IdleHibernator(database, backend)
+
+    # slots, cached results and pooled connections are dropped when an instance
+    # goes away, however it was killed, and cached results whenever its chains
+    # are hibernated or resumed
+    def on_changed(event: InstanceEvent):
+        if event["type"] == "unregistered":
+            admission.release(event["instance_id"])
+            get_provider_registry().evict(event["instance_id"])
+
+        if event["type"] in ("unregistered", "updated"):
+            evaluator.evict(event["instance_id"])
+
+    admission.seed(await asyncio.to_thread(database.get_all_instances))
+    watcher.add_listener(on_changed)
 
     logging.root.setLevel(logging.INFO)
 
+    await backend.start()
+    await watcher.start()
+    await evaluator.start()
+    await koth_scorer.start()
+    await hibernator.start()
+
     yield
 
+    await hibernator.stop()
+    await koth_scorer.stop()
+    await evaluator.stop()
+    await watcher.stop()
+    await backend.stop()
+
 
 app = FastAPI(lifespan=lifespan)
 
 
+# anything about to talk to an instance's chains has to wake it up first
+async def get_awake_instance(instance_id: str) -> Optional[UserData]:
+    user_data = await asyncio.to_thread(database.get_instance, instance_id)
+    if user_data is None or not user_data.get("hibernated", False):
+        return user_data
+
+    logging.info("resuming instance: %s", instance_id)
+    return await backend.resume_instance(instance_id)
+
+
 @app.post("/instances")
-def create_instance(args: CreateInstanceRequest):
+async def create_instance(args: CreateInstanceRequest):
+    try:
+        position = await admission.acquire(
+            args["instance_id"],
+            args.get("team", args["instance_id"]),
+            args.get("challenge"),
+            ADMISSION_WAIT,
+        )
+    except QueueConflict:
+        return {
+            "ok": False,
+            "message": "another launch is already queued for this team",
+        }
+
+    if position is not None:
+        return {
+            "ok": False,
+            "queued": True,
+            "message": "launch queued",
+            "data": position,
+        }
+
     logging.info("launching new instance: %s", args["instance_id"])
 
     try:
-        user_data = backend.launch_instance(args)
+        user_data = await backend.launch_instance(args)
     except InstanceExists:
         logging.warning("instance already exists: %s", args["instance_id"])
 
@@ -42,6 +127,7 @@ def create_instance(args: CreateInstanceRequest):
         logging.error(
             "failed to launch instance: %s", args["instance_id"], exc_info=e
         )
+        admission.release(args["instance_id"])
         return {
             'ok': False,
             'message': 'an internal error occurred',
@@ -55,8 +141,16 @@ def create_instance(args: CreateInstanceRequest):
     }
 
 @app.get("/instances/{instance_id}")
-def get_instance(instance_id: str):
-    user_data = database.get_instance(instance_id)
+async def get_instance(instance_id: str):
+    try:
+        user_data = await get_awake_instance(instance_id)
+    except Exception as e:
+        logging.error("failed to resume instance: %s", instance_id, exc_info=e)
+        return {
+            'ok': False,
+            'message': 'failed to resume instance',
+        }
+
     if user_data is None:
         return {
             'ok': False,
@@ -69,10 +163,54 @@ def get_instance(instance_id: str):
         'data': user_data
     }
 
+@app.get("/instances/{instance_id}/watch")
+async def watch_instance(
+    instance_id: str, wait_for: List[str] = Query([]), timeout: float = 30
+):
+    deadline = time.time() + min(timeout, WATCH_MAX_TIMEOUT)
+
+    with watcher.subscribe(instance_id) as changed:
+        while True:
+            # subscribed before reading, so a change landing in between still
+            # wakes us up
+            changed.clear()
+
+            # only waits while the instance or one of the keys is missing
+            user_data = await asyncio.to_thread(database.get_instance, instance_id)
+            if user_data is not None and all(
+                [k in user_data["metadata"] for k in wait_for]
+            ):
+                return {
+                    'ok': True,
+                    'message': 'fetched metadata',
+                    'data': user_data,
+                }
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    if user_data is None:
+        return {
+            'ok': False,
+            'message': 'instance does not exist',
+        }
+
+    return {
+        'ok': True,
+        'message': 'watch timed out',
+        'data': user_data,
+    }
+
 @app.post("/instances/{instance_id}/metadata")
-def update_metadata(instance_id: str, metadata: Dict[str, str]):
+async def update_metadata(instance_id: str, metadata: Dict[str, str]):
     try:
-        database.update_metadata(instance_id, metadata)
+        await asyncio.to_thread(database.update_metadata, instance_id, metadata)
     except:
         return {
             'ok': False,
@@ -86,10 +224,10 @@ def update_metadata(instance_id: str, metadata: Dict[str, str]):
         
 
 @app.delete("/instances/{instance_id}")
-def delete_instance(instance_id: str):
+async def delete_instance(instance_id: str):
     logging.info("killing instance: %s", instance_id)
 
-    instance = backend.kill_instance(instance_id)
+    instance = await backend.kill_instance(instance_id)
     if instance is None:
         return {
             "ok": False,
@@ -100,3 +238,268 @@ def delete_instance(instance_id: str):
         "ok": True,
         "message": "instance deleted",
     }
+
+
+@app.post("/instances/{instance_id}/checkpoint")
+async def checkpoint_instance(instance_id: str):
+    user_data = await get_awake_instance(instance_id)
+    if user_data is None:
+        return {
+            "ok": False,
+            "message": "instance does not exist",
+        }
+
+    try:
+        await backend.checkpoint_instance(user_data)
+    except Exception as e:
+        logging.error("failed to checkpoint instance: %s", instance_id, exc_info=e)
+        return {
+            "ok": False,
+            "message": "failed to checkpoint instance",
+        }
+
+    return {
+        "ok": True,
+        "message": "instance checkpointed",
+    }
+
+
+@app.post("/instances/{instance_id}/persist")
+async def persist_instance(instance_id: str):
+    user_data = await asyncio.to_thread(database.get_instance, instance_id)
+    if user_data is None:
+        return {
+            "ok": False,
+            "message": "instance does not exist",
+        }
+
+    if user_data["metadata"].get("type", "ethereum") != "ethereum":
+        return {
+            "ok": False,
+            "message": "instance can't be persisted",
+        }
+
+    # the state was written out when the instance went to sleep
+    if user_data.get("hibernated", False):
+        return {
+            "ok": True,
+            "message": "instance already persisted",
+        }
+
+    try:
+        sizes = await backend.persist_instance(user_data)
+    except Exception as e:
+        logging.error("failed to persist instance: %s", instance_id, exc_info=e)
+        return {
+            "ok": False,
+            "message": "failed to persist instance",
+        }
+
+    return {
+        "ok": True,
+        "message": "instance persisted",
+        "data": sizes,
+    }
+
+
+@app.post("/instances/{instance_id}/reset")
+async def reset_instance(instance_id: str):
+    user_data = await get_awake_instance(instance_id)
+    if user_data is None:
+        return {
+            "ok": False,
+            "message": "instance does not exist",
+        }
+
+    if "checkpoints" not in user_data["metadata"]:
+        return {
+            "ok": False,
+            "message": "instance can't be reset",
+        }
+
+    logging.info("resetting instance: %s", instance_id)
+
+    try:
+        await backend.reset_instance(user_data)
+    except Exception as e:
+        logging.error("failed to reset instance: %s", instance_id, exc_info=e)
+        return {
+            "ok": False,
+            "message": "failed to reset instance",
+        }
+    finally:
+        # the chain went back to an earlier block
+        evaluator.evict(instance_id)
+
+    return {
+        "ok": True,
+        "message": "instance reset",
+    }
+
+
+@app.get("/instances/{instance_id}/score")
+async def get_score(instance_id: str):
+    user_data = await get_awake_instance(instance_id)
+    if user_data is None:
+        return {
+            "ok": False,
+            "message": "instance does not exist",
+        }
+
+    if not is_koth_instance(user_data):
+        return {
+            "ok": False,
+            "message": "instance is not scored",
+        }
+
+    try:
+        entry = await koth_scorer.score(user_data)
+    except Exception as e:
+        logging.error("failed to score instance: %s", instance_id, exc_info=e)
+        return {
+            "ok": False,
+            "message": "failed to score instance",
+        }
+
+    return {
+        "ok": True,
+        "message": "fetched score",
+        "data": entry,
+    }
+
+
+@app.get("/leaderboard/{challenge}")
+async def get_leaderboard(challenge: str):
+    leaderboard = koth_scorer.get_leaderboard(challenge)
+    if leaderboard is None:
+        return {
+            "ok": False,
+            "message": "no scores for challenge",
+        }
+
+    return {
+        "ok": True,
+        "message": "fetched leaderboard",
+        "data": leaderboard,
+    }
+
+
+@app.post("/solves")
+async def check_solves(args: CheckSolvesRequest):
+    instances = await asyncio.gather(
+        *[get_awake_instance(instance_id) for instance_id in args["instance_ids"]],
+        return_exceptions=True,
+    )
+
+    # instances which don't exist or couldn't be checked are left out
+    return {
+        "ok": True,
+        "message": "checked solves",
+        "data": await solve_checker.check(
+            [instance for instance in instances if isinstance(instance, dict)]
+        ),
+    }
+
+
+@app.get("/solves")
+async def sweep_solves(challenge: Optional[str] = None):
+    # hibernated instances are left asleep, nothing could have solved them
+    instances = [
+        instance
+        for instance in await asyncio.to_thread(database.get_all_instances)
+        if not instance.get("hibernated", False)
+    ]
+    if challenge is not None:
+        instances = [
+            instance
+            for instance in instances
+            if instance["metadata"].get("challenge") == challenge
+        ]
+
+    return {
+        "ok": True,
+        "message": "checked solves",
+        "data": await solve_checker.check(instances),
+    }
+
+
+@app.post("/routes/{external_id}/resume")
+async def resume_routes(external_id: str):
+    user_data = await asyncio.to_thread(
+        database.get_instance_by_external_id, external_id
+    )
+    if user_data is None:
+        return {
+            "ok": False,
+            "message": "instance does not exist",
+        }
+
+    try:
+        user_data = await get_awake_instance(user_data["instance_id"])
+    except Exception as e:
+        logging.error("failed to resume instance: %s", user_data["instance_id"], exc_info=e)
+        return {
+            "ok": False,
+            "message": "failed to resume instance",
+        }
+
+    if user_data is None:
+        return {
+            "ok": False,
+            "message": "instance does not exist",
+        }
+
+    return {
+        "ok": True,
+        "message": "instance resumed",
+        "data": user_data["anvil_instances"],
+    }
+
+
+@app.get("/snapshots/{key}")
+async def get_snapshot(key: str):
+    # the state itself is only ever loaded by the backend, so only the small
+    # metadata blob is read here
+    metadata = await asyncio.to_thread(
+        database.get_snapshot, get_snapshot_metadata_key(key)
+    )
+    if metadata is None:
+        return {
+            "ok": False,
+            "message": "snapshot does not exist",
+        }
+
+    return {
+        "ok": True,
+        "message": "fetched snapshot",
+        "data": {
+            "metadata": json.loads(metadata),
+        },
+    }
+
+
+@app.put("/snapshots/{key}")
+async def put_snapshot(key: str, snapshot: Snapshot):
+    # metadata last, a snapshot only counts as stored once it's there
+    await asyncio.to_thread(
+        database.put_snapshot, key, snapshot["state"].encode("utf8")
+    )
+    await asyncio.to_thread(
+        database.put_snapshot,
+        get_snapshot_metadata_key(key),
+        json.dumps(snapshot["metadata"]).encode("utf8"),
+    )
+
+    return {
+        "ok": True,
+        "message": "snapshot stored",
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return {
+        "ok": True,
+        "message": "fetched metrics",
+        "data": metrics.snapshot(),
+    }
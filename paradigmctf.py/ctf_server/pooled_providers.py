@@ -0,0 +1,43 @@
+from typing import Any
+
+import aiohttp
+import requests
+from web3 import AsyncHTTPProvider, HTTPProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+
+# web3 keeps its own session cache keyed by thread and url, these send every
+# request through the session they were given instead
+class PooledHTTPProvider(HTTPProvider):
+    def __init__(self, endpoint_uri: str, session: requests.Session, **kwargs):
+        super().__init__(endpoint_uri, **kwargs)
+
+        self.__session = session
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        resp = self.__session.post(
+            self.endpoint_uri,
+            data=self.encode_rpc_request(method, params),
+            **dict(self.get_request_kwargs()),
+        )
+        resp.raise_for_status()
+
+        return self.decode_rpc_response(resp.content)
+
+
+class PooledAsyncHTTPProvider(AsyncHTTPProvider):
+    def __init__(self, endpoint_uri: str, session: aiohttp.ClientSession, **kwargs):
+        super().__init__(endpoint_uri, **kwargs)
+
+        self.__session = session
+
+    async def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        async with self.__session.post(
+            self.endpoint_uri,
+            data=self.encode_rpc_request(method, params),
+            **dict(self.get_request_kwargs()),
+        ) as resp:
+            resp.raise_for_status()
+            body = await resp.read()
+
+        return self.decode_rpc_response(body)
@@ -0,0 +1,158 @@
+import asyncio
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import TYPE_CHECKING, Any, Dict, Optional, Set, Tuple
+
+from ctf_server.metrics import metrics
+
+# web3, requests and aiohttp are only imported once a provider is needed, the
+# launchers import this module through ctf_server.types
+if TYPE_CHECKING:
+    from web3 import AsyncWeb3, Web3
+
+# connections kept open to each chain
+WEB3_POOL_SIZE = int(os.getenv("WEB3_POOL_SIZE", "4"))
+# least recently used providers are closed beyond this many
+WEB3_MAX_PROVIDERS = int(os.getenv("WEB3_MAX_PROVIDERS", "1024"))
+WEB3_TIMEOUT = float(os.getenv("WEB3_TIMEOUT", "10"))
+
+
+@dataclass
+class RegisteredProvider:
+    owner: Optional[str]
+    web3: Any
+    session: Any
+
+
+# hands out one web3 per rpc url, each backed by its own small connection pool,
+# so readiness probes, funding calls and solve checks stop paying for a new
+# session and tcp handshake every time
+class ProviderRegistry:
+    def __init__(self, max_providers: int = WEB3_MAX_PROVIDERS):
+        self.__lock = Lock()
+        self.__max_providers = max_providers
+
+        # (url, async) -> provider, in least recently used order
+        self.__providers: "OrderedDict[Tuple[str, bool], RegisteredProvider]" = OrderedDict()
+        # instance id -> keys of the providers talking to it
+        self.__owners: Dict[str, Set[Tuple[str, bool]]] = {}
+
+    def get_web3(self, url: str, owner: Optional[str] = None) -> "Web3":
+        return self.__get((url, False), owner, self.__create_web3)
+
+    def get_async_web3(self, url: str, owner: Optional[str] = None) -> "AsyncWeb3":
+        return self.__get((url, True), owner, self.__create_async_web3)
+
+    def evict(self, owner: str):
+        with self.__lock:
+            keys = self.__owners.pop(owner, set())
+            evicted = [self.__providers.pop(key) for key in keys if key in self.__providers]
+
+        for provider in evicted:
+            self.__close(provider)
+            metrics.inc("web3_providers_evicted")
+
+    def __get(self, key: Tuple[str, bool], owner: Optional[str], create) -> Any:
+        with self.__lock:
+            provider = self.__providers.get(key)
+            if provider is not None:
+                self.__providers.move_to_end(key)
+                return provider.web3
+
+        web3, session = create(key[0])
+
+        with self.__lock:
+            # another thread may have registered the same url in the meantime
+            existing = self.__providers.get(key)
+            if existing is not None:
+                self.__providers.move_to_end(key)
+                duplicate = RegisteredProvider(owner=owner, web3=web3, session=session)
+                web3 = existing.web3
+            else:
+                duplicate = None
+                self.__providers[key] = RegisteredProvider(
+                    owner=owner, web3=web3, session=session
+                )
+                if owner is not None:
+                    self.__owners.setdefault(owner, set()).add(key)
+
+            overflow = []
+            while len(self.__providers) > self.__max_providers:
+                old_key, old = self.__providers.popitem(last=False)
+                if old.owner is not None:
+                    self.__owners.get(old.owner, set()).discard(old_key)
+                overflow.append(old)
+
+        if duplicate is not None:
+            self.__close(duplicate)
+        else:
+            metrics.inc("web3_providers_created")
+
+        for provider in overflow:
+            self.__close(provider)
+
+        return web3
+
+    def __create_web3(self, url: str) -> Tuple["Web3", Any]:
+        import requests
+        from web3 import Web3
+
+        from ctf_server.pooled_providers import PooledHTTPProvider
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=WEB3_POOL_SIZE
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return (
+            Web3(
+                PooledHTTPProvider(
+                    url, session, request_kwargs={"timeout": WEB3_TIMEOUT}
+                )
+            ),
+            session,
+        )
+
+    def __create_async_web3(self, url: str) -> Tuple["AsyncWeb3", Any]:
+        import aiohttp
+        from web3 import AsyncWeb3
+
+        from ctf_server.pooled_providers import PooledAsyncHTTPProvider
+
+        # only ever called from a coroutine, the session belongs to its loop
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=WEB3_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(total=WEB3_TIMEOUT),
+        )
+
+        return AsyncWeb3(PooledAsyncHTTPProvider(url, session)), session
+
+    def __close(self, provider: RegisteredProvider):
+        result = provider.session.close()
+        if not asyncio.iscoroutine(result):
+            return
+
+        try:
+            asyncio.get_running_loop().create_task(result)
+        except RuntimeError:
+            # the loop the session belonged to is gone, and its connections
+            # with it
+            result.close()
+
+
+_provider_registry = None
+_provider_registry_lock = Lock()
+
+
+def get_provider_registry() -> ProviderRegistry:
+    global _provider_registry
+
+    with _provider_registry_lock:
+        if _provider_registry is None:
+            _provider_registry = ProviderRegistry()
+
+        return _provider_registry
@@ -0,0 +1,90 @@
+import logging
+import time
+from typing import Dict, List
+
+from eth_utils import function_signature_to_4byte_selector
+
+from ctf_server.evaluator import ChainEvaluator, evaluate_all, is_starknet_instance
+from ctf_server.koth import is_koth_instance
+from ctf_server.metrics import metrics
+from ctf_server.types import Call, Evaluation, SolveStatus, UserData
+
+IS_SOLVED_SELECTOR = "0x" + function_signature_to_4byte_selector("isSolved()").hex()
+# sn_keccak("isSolved")
+STARKNET_IS_SOLVED_SELECTOR = "0x1f8ddd388f265b0bcab25a3e457e789fe182bdf8ede59d9ef42b3158a533c8"
+
+
+def is_pwn_instance(instance: UserData) -> bool:
+    return "challenge_address" in instance["metadata"] and not is_koth_instance(instance)
+
+
+# checks whether instances were solved, results are cached per block by the
+# evaluator so players asking for the flag over and over don't reach the chain
+class SolveChecker:
+    def __init__(self, evaluator: ChainEvaluator):
+        self.__evaluator = evaluator
+
+    async def check(self, instances: List[UserData]) -> Dict[str, SolveStatus]:
+        start = time.time()
+
+        instances = [instance for instance in instances if is_pwn_instance(instance)]
+
+        evaluations = await evaluate_all(
+            self.__evaluator,
+            [(instance, self.__get_calls(instance)) for instance in instances],
+        )
+
+        statuses: Dict[str, SolveStatus] = {}
+        for instance, evaluation in zip(instances, evaluations):
+            if isinstance(evaluation, Exception):
+                metrics.inc("solve_check_failures")
+                logging.warning(
+                    "failed to check instance %s: %s", instance["instance_id"], evaluation
+                )
+                continue
+
+            # a challenge without code answers with an empty result
+            try:
+                statuses[instance["instance_id"]] = self.__to_status(instance, evaluation)
+            except (ValueError, IndexError, TypeError) as e:
+                metrics.inc("solve_check_failures")
+                logging.warning(
+                    "failed to decode solve status of instance %s: %s",
+                    instance["instance_id"],
+                    e,
+                )
+
+        metrics.inc("solve_checks", len(instances))
+        metrics.observe("solve_check_duration_seconds", time.time() - start)
+
+        return statuses
+
+    def __get_calls(self, instance: UserData) -> List[Call]:
+        if is_starknet_instance(instance):
+            return [
+                Call(
+                    to=instance["metadata"]["challenge_address"],
+                    data=STARKNET_IS_SOLVED_SELECTOR,
+                    calldata=[],
+                ),
+            ]
+
+        return [
+            Call(to=instance["metadata"]["challenge_address"], data=IS_SOLVED_SELECTOR),
+        ]
+
+    def __to_status(self, instance: UserData, evaluation: Evaluation) -> SolveStatus:
+        (result,) = evaluation["results"]
+
+        # matches what the starknet launcher has always treated as solved
+        if is_starknet_instance(instance):
+            solved = result[0] == "0x0"
+        else:
+            solved = int(result, 16) != 0
+
+        return SolveStatus(
+            instance_id=instance["instance_id"],
+            solved=solved,
+            block_number=evaluation["block_number"],
+            evaluated_at=evaluation["evaluated_at"],
+        )
@@ -1,22 +1,31 @@
 import os
 import subprocess
 from dataclasses import dataclass
-from typing import Dict, List, NotRequired, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, NotRequired, Optional
 
-from eth_account import Account
-from eth_account.account import LocalAccount
-from eth_account.hdaccount import key_from_seed, seed_from_mnemonic
 from typing_extensions import TypedDict
-from web3 import Web3
+
+# eth_account and web3 take a while to import and launchers only need them once
+# an action actually talks to a chain
+if TYPE_CHECKING:
+    from eth_account.account import LocalAccount
+    from web3 import Web3
 
 DEFAULT_IMAGE = "ghcr.io/foundry-rs/foundry:latest"
 DEFAULT_DERIVATION_PATH = "m/44'/60'/0'/0/"
 DEFAULT_ACCOUNTS = 10
 DEFAULT_BALANCE = 1000
 DEFAULT_MNEMONIC = "test test test test test test test test test test test junk"
+DEFAULT_STATE_PERSISTENCE = "interval"
+DEFAULT_STATE_INTERVAL = 5
 
 PUBLIC_HOST = os.getenv("PUBLIC_HOST", "http://127.0.0.1:8545")
 
+# where /data lives unless a chain asks otherwise, "disk" for a volume or
+# "memory" for a tmpfs of at most DATA_SIZE_LIMIT MiB
+DATA_MEDIUM = os.getenv("DATA_MEDIUM", "disk")
+DATA_SIZE_LIMIT = int(os.getenv("DATA_SIZE_LIMIT", "256"))
+
 
 class LaunchAnvilInstanceArgs(TypedDict):
     image: NotRequired[Optional[str]]
@@ -31,6 +40,69 @@ class LaunchAnvilInstanceArgs(TypedDict):
     chain_id: NotRequired[Optional[int]]
     code_size_limit: NotRequired[Optional[int]]
     block_time: NotRequired[Optional[int]]
+    # key of a state snapshot stored in the orchestrator, loaded before the
+    # accounts are funded
+    snapshot: NotRequired[Optional[str]]
+    # "interval" writes the whole state to the data volume every
+    # state_interval seconds, "on-demand" only when the orchestrator persists
+    # or hibernates the instance, "off" never
+    state_persistence: NotRequired[Optional[str]]
+    state_interval: NotRequired[Optional[int]]
+    # "memory" gives the chain its own tmpfs, counted towards its memory, in
+    # place of the volume shared by the instance
+    data_medium: NotRequired[Optional[str]]
+    # MiB, only for "memory"
+    data_size_limit: NotRequired[Optional[int]]
+    # one of ANVIL_PROFILES, the options below take precedence over it
+    profile: NotRequired[Optional[str]]
+    # historical states kept in memory, older blocks can't be queried
+    prune_history: NotRequired[Optional[int]]
+    # blocks whose transactions are kept in memory
+    transaction_block_keeper: NotRequired[Optional[int]]
+    no_storage_caching: NotRequired[Optional[bool]]
+    # bytes of evm memory a single execution may use
+    memory_limit: NotRequired[Optional[int]]
+    compute_units_per_second: NotRequired[Optional[int]]
+
+
+# what a chain remembers against what it costs to keep running, most
+# challenges only ever look at the latest block
+ANVIL_PROFILES: Dict[str, LaunchAnvilInstanceArgs] = {
+    "default": {},
+    "lean": {
+        "prune_history": 16,
+        "transaction_block_keeper": 64,
+        "memory_limit": 32 * 1024 * 1024,
+    },
+    # forked state is fetched on demand, so don't keep a second copy of it on
+    # disk and go easy on the upstream rpc
+    "fork-heavy": {
+        "prune_history": 16,
+        "transaction_block_keeper": 64,
+        "no_storage_caching": True,
+        "compute_units_per_second": 330,
+    },
+}
+
+
+def get_profile_args(args: LaunchAnvilInstanceArgs) -> LaunchAnvilInstanceArgs:
+    profile = args.get("profile") or "default"
+    if profile not in ANVIL_PROFILES:
+        raise Exception("invalid anvil profile", profile)
+
+    return ANVIL_PROFILES[profile] | {k: v for k, v in args.items() if v is not None}
+
+
+def get_data_medium(args: LaunchAnvilInstanceArgs) -> str:
+    data_medium = args.get("data_medium") or DATA_MEDIUM
+    if data_medium not in ["disk", "memory"]:
+        raise Exception("invalid data medium", data_medium)
+
+    return data_medium
+
+
+def get_data_size_limit(args: LaunchAnvilInstanceArgs) -> int:
+    return args.get("data_size_limit") or DATA_SIZE_LIMIT
 
 
 def format_anvil_args(args: LaunchAnvilInstanceArgs, anvil_id: str, port: int = 8545) -> List[str]:
@@ -38,8 +110,15 @@ def format_anvil_args(args: LaunchAnvilInstanceArgs, anvil_id: str, port: int =
     cmd_args += ["--host", "0.0.0.0"]
     cmd_args += ["--port", str(port)]
     cmd_args += ["--accounts", "0"]
-    cmd_args += ["--state", f"/data/{anvil_id}-state.json"]
-    cmd_args += ["--state-interval", "5"]
+
+    args = get_profile_args(args)
+
+    state_persistence = args.get("state_persistence") or DEFAULT_STATE_PERSISTENCE
+    if state_persistence == "interval":
+        cmd_args += ["--state", f"/data/{anvil_id}-state.json"]
+        cmd_args += ["--state-interval", str(args.get("state_interval") or DEFAULT_STATE_INTERVAL)]
+    elif state_persistence not in ["on-demand", "off"]:
+        raise Exception("invalid state persistence", state_persistence)
 
     if args.get("fork_url") is not None:
         cmd_args += ["--fork-url", args["fork_url"]]
@@ -62,6 +141,21 @@ def format_anvil_args(args: LaunchAnvilInstanceArgs, anvil_id: str, port: int =
     if args.get("block_time") is not None:
         cmd_args += ["--block-time", str(args["block_time"])]
 
+    if args.get("prune_history") is not None:
+        cmd_args += ["--prune-history", str(args["prune_history"])]
+
+    if args.get("transaction_block_keeper") is not None:
+        cmd_args += ["--transaction-block-keeper", str(args["transaction_block_keeper"])]
+
+    if args.get("no_storage_caching") == True:
+        cmd_args += ["--no-storage-caching"]
+
+    if args.get("memory_limit") is not None:
+        cmd_args += ["--memory-limit", str(args["memory_limit"])]
+
+    if args.get("compute_units_per_second") is not None:
+        cmd_args += ["--compute-units-per-second", str(args["compute_units_per_second"])]
+
     return cmd_args
 
 
@@ -104,6 +198,9 @@ class CreateInstanceRequest(TypedDict):
     timeout: int
     anvil_instances: NotRequired[Dict[str, LaunchAnvilInstanceArgs]]
     daemon_instances: NotRequired[Dict[str, DaemonInstanceArgs]]
+    # used to queue launches fairly when the orchestrator is at capacity
+    team: NotRequired[str]
+    challenge: NotRequired[str]
 
 
 class InstanceInfo(TypedDict):
@@ -130,38 +227,98 @@ class UserData(TypedDict):
     anvil_instances: Dict[str, InstanceInfo]
     daemon_instances: Dict[str, InstanceInfo]
     metadata: Dict
+    # the chains were stopped after going idle, their state is kept in the
+    # database until the next request resumes them
+    hibernated: NotRequired[bool]
+
+
+class Snapshot(TypedDict):
+    # the hex encoded blob returned by anvil_dumpState
+    state: str
+    metadata: Dict[str, str]
+
+
+class Call(TypedDict):
+    to: str
+    # the calldata on ethereum, the entry point selector on starknet
+    data: str
+    calldata: NotRequired[List[str]]
+
+
+class Evaluation(TypedDict):
+    block_number: int
+    # the raw result of each call, in order
+    results: List[Any]
+    evaluated_at: float
+
 
+class LeaderboardEntry(TypedDict):
+    team: str
+    instance_id: str
+    score: int
+    block_number: int
+    evaluated_at: float
+
+
+class SolveStatus(TypedDict):
+    instance_id: str
+    solved: bool
+    block_number: int
+    evaluated_at: float
+
+
+class CheckSolvesRequest(TypedDict):
+    instance_ids: List[str]
+
+
+class InstanceEvent(TypedDict):
+    instance_id: str
+    # one of "registered", "updated", "metadata" or "unregistered"
+    type: str
+
+
+class QueuePosition(TypedDict):
+    position: int
+    depth: int
+    estimated_wait: Optional[float]
+
+
+def get_account(mnemonic: str, offset: int) -> "LocalAccount":
+    from eth_account import Account
+    from eth_account.hdaccount import key_from_seed, seed_from_mnemonic
 
-def get_account(mnemonic: str, offset: int) -> LocalAccount:
     seed = seed_from_mnemonic(mnemonic, "")
     private_key = key_from_seed(seed, f"{DEFAULT_DERIVATION_PATH}{offset}")
 
     return Account.from_key(private_key)
 
 
-def get_player_account(mnemonic: str) -> LocalAccount:
+def get_player_account(mnemonic: str) -> "LocalAccount":
     return get_account(mnemonic, 0)
 
 
-def get_system_account(mnemonic: str) -> LocalAccount:
+def get_system_account(mnemonic: str) -> "LocalAccount":
     return get_account(mnemonic, 1)
 
 
-def get_additional_account(mnemonic: str, offset: int) -> LocalAccount:
+def get_additional_account(mnemonic: str, offset: int) -> "LocalAccount":
     return get_account(mnemonic, offset + 2)
 
 
-def get_privileged_web3(user_data: UserData, anvil_id: str) -> Web3:
+def get_privileged_web3(user_data: UserData, anvil_id: str) -> "Web3":
+    from ctf_server.providers import get_provider_registry
+
     anvil_instance = user_data["anvil_instances"][anvil_id]
-    return Web3(
-        Web3.HTTPProvider(
-            f"http://{anvil_instance['ip']}:{anvil_instance['port']}")
+    return get_provider_registry().get_web3(
+        f"http://{anvil_instance['ip']}:{anvil_instance['port']}",
+        user_data["instance_id"],
     )
 
 
-def get_unprivileged_web3(user_data: UserData, anvil_id: str) -> Web3:
-    return Web3(
-        Web3.HTTPProvider(
-            f"http://anvil-proxy:8545/{user_data['external_id']}/{anvil_id}"
-        )
+def get_unprivileged_web3(user_data: UserData, anvil_id: str) -> "Web3":
+    from ctf_server.providers import get_provider_registry
+
+    return get_provider_registry().get_web3(
+        f"http://anvil-proxy:8545/{user_data['external_id']}/{anvil_id}",
+        user_data["instance_id"],
     )
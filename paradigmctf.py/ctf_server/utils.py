@@ -2,16 +2,18 @@ import os
 
 from .backends import Backend, KubernetesBackend, DockerBackend
 from .databases import Database, RedisDatabase, SQLiteDatabase
+from .databases.codec import load_codec
 
 
 def load_database() -> Database:
     dbtype = os.getenv("DATABASE", "sqlite")
+    codec = load_codec(os.getenv("DATABASE_CODEC", "msgpack"))
     if dbtype == "sqlite":
         dbpath = os.getenv("SQLITE_PATH", ":memory:")
-        return SQLiteDatabase(dbpath)
+        return SQLiteDatabase(dbpath, codec=codec)
     elif dbtype == "redis":
         url = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
-        return RedisDatabase(url)
+        return RedisDatabase(url, codec=codec)
 
     raise Exception("invalid database type", dbtype)
 
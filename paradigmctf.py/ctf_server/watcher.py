@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from threading import Thread
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+from ctf_server.databases.database import Database
+from ctf_server.types import InstanceEvent
+
+READ_TIMEOUT = 5
+
+
+# follows the database's change events on a single background thread and wakes
+# up every coroutine subscribed to the affected instance
+class InstanceWatcher:
+    def __init__(self, database: Database):
+        self.__database = database
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__subscribers: Dict[str, Set[asyncio.Event]] = {}
+        self.__listeners: List[Callable[[InstanceEvent], None]] = []
+        self.__running = False
+
+    async def start(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__running = True
+
+        Thread(
+            target=self.__reader_thread,
+            name=f"{self.__class__.__name__} Event Reader",
+            daemon=True,
+        ).start()
+
+    async def stop(self):
+        self.__running = False
+
+    # listeners are called on the event loop with every event, of every instance
+    def add_listener(self, listener: Callable[[InstanceEvent], None]):
+        self.__listeners.append(listener)
+
+    @contextmanager
+    def subscribe(self, instance_id: str) -> Iterator[asyncio.Event]:
+        changed = asyncio.Event()
+        self.__subscribers.setdefault(instance_id, set()).add(changed)
+        try:
+            yield changed
+        finally:
+            subscribers = self.__subscribers[instance_id]
+            subscribers.discard(changed)
+            if len(subscribers) == 0:
+                del self.__subscribers[instance_id]
+
+    def __reader_thread(self):
+        cursor = None
+        while self.__running:
+            try:
+                cursor, events = self.__database.read_events(cursor, READ_TIMEOUT)
+            except Exception as e:
+                logging.error("failed to read instance events", exc_info=e)
+                time.sleep(1)
+                continue
+
+            for event in events:
+                self.__loop.call_soon_threadsafe(self.__notify, event)
+
+    def __notify(self, event: InstanceEvent):
+        for changed in self.__subscribers.get(event["instance_id"], ()):
+            changed.set()
+
+        for listener in self.__listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logging.error("instance event listener failed", exc_info=e)
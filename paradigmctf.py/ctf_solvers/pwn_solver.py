@@ -2,6 +2,7 @@ import abc
 
 from ctf_solvers.solver import TicketedRemote, kill_instance, launch_instance
 from ctf_solvers.utils import solve
+from ctf_server.providers import get_provider_registry
 from web3 import Web3
 
 
@@ -30,5 +31,5 @@ class PwnChallengeSolver(abc.ABC):
         print(f"[+] response: {data}")
 
     def _solve(self, rpcs, player, challenge):
-        web3 = Web3(Web3.HTTPProvider(rpcs[0]))
+        web3 = get_provider_registry().get_web3(rpcs[0])
         solve(web3, "project", player, challenge, "script/Solve.s.sol:Solve")
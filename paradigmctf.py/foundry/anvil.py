@@ -1,5 +1,11 @@
-from web3 import Web3
-from web3.types import RPCResponse
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+# only needed for annotations, launchers shouldn't pay for importing web3 here
+if TYPE_CHECKING:
+    from web3 import AsyncWeb3, Web3
+    from web3.types import RPCResponse
 
 
 def check_error(resp: RPCResponse):
@@ -30,3 +36,39 @@ def anvil_setBalance(
     balance: str,
 ):
     check_error(web3.provider.make_request("anvil_setBalance", [addr, balance]))
+
+
+async def async_anvil_setBalance(
+    web3: AsyncWeb3,
+    addr: str,
+    balance: str,
+):
+    check_error(await web3.provider.make_request("anvil_setBalance", [addr, balance]))
+
+
+def anvil_dumpState(web3: Web3) -> str:
+    resp = web3.provider.make_request("anvil_dumpState", [])
+    check_error(resp)
+    return resp["result"]
+
+
+async def async_anvil_dumpState(web3: AsyncWeb3) -> str:
+    resp = await web3.provider.make_request("anvil_dumpState", [])
+    check_error(resp)
+    return resp["result"]
+
+
+async def async_anvil_loadState(web3: AsyncWeb3, state: str):
+    check_error(await web3.provider.make_request("anvil_loadState", [state]))
+
+
+async def async_evm_snapshot(web3: AsyncWeb3) -> str:
+    resp = await web3.provider.make_request("evm_snapshot", [])
+    check_error(resp)
+    return resp["result"]
+
+
+async def async_evm_revert(web3: AsyncWeb3, snapshot_id: str) -> bool:
+    resp = await web3.provider.make_request("evm_revert", [snapshot_id])
+    check_error(resp)
+    return resp["result"]
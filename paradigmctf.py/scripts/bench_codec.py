@@ -0,0 +1,62 @@
+"""
+Compares the UserData codecs used by the database backends.
+
+    python scripts/bench_codec.py [iterations]
+"""
+
+import sys
+import time
+import timeit
+
+from ctf_server.databases.codec import (
+    JsonCodec,
+    MsgpackCodec,
+    decode_routes,
+    encode_routes,
+)
+from ctf_server.types import UserData
+
+
+def sample_instance() -> UserData:
+    now = time.time()
+    return UserData(
+        instance_id="chal-challenge-0123456789abcdef",
+        external_id="aBcDeFgHiJkLmNoPqRsTuVwX",
+        created_at=now,
+        expires_at=now + 720,
+        anvil_instances={
+            "main": {"id": "main", "ip": "172.18.0.42", "port": 8545},
+            "l2": {"id": "l2", "ip": "172.18.0.43", "port": 8545},
+        },
+        daemon_instances={"daemon": {"id": "daemon"}},
+        metadata={
+            "mnemonic": "test test test test test test test test test test test junk",
+            "challenge_address": "0x5FbDB2315678afecb367f032d93F642f64180aa3",
+        },
+    )
+
+
+def bench(name, encode, decode, value, iterations):
+    data = encode(value)
+    encode_time = timeit.timeit(lambda: encode(value), number=iterations)
+    decode_time = timeit.timeit(lambda: decode(data), number=iterations)
+
+    print(
+        f"{name:<10} {len(data):>6} bytes"
+        f" {encode_time / iterations * 1e6:>8.2f} us/encode"
+        f" {decode_time / iterations * 1e6:>8.2f} us/decode"
+    )
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    instance = sample_instance()
+
+    for name, codec in [("json", JsonCodec()), ("msgpack", MsgpackCodec())]:
+        bench(name, codec.encode, codec.decode, instance, iterations)
+
+    bench("routes", encode_routes, decode_routes, instance["anvil_instances"], iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Checks that importing a launcher stays within its time and memory budget, and
+that none of the heavy dependencies are imported before an action needs them.
+
+    python scripts/check_launcher_import.py [module] [max seconds] [max MiB]
+"""
+
+import resource
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = [
+    "web3",
+    "eth_account",
+    "eth_abi",
+    "cryptography",
+    "requests",
+    "fastapi",
+    "aiohttp",
+]
+
+
+def main():
+    module = sys.argv[1] if len(sys.argv) > 1 else "ctf_launchers.pwn_launcher"
+    max_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    max_mib = float(sys.argv[3]) if len(sys.argv) > 3 else 64
+
+    # a fresh interpreter per run, like every connection to a launcher gets
+    start = time.time()
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))",
+        ],
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.time() - start
+    if proc.returncode != 0:
+        print(proc.stderr)
+        raise Exception("failed to import launcher", module)
+
+    # ru_maxrss is reported in KiB on linux
+    rss_mib = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    imported = [m for m in proc.stdout.strip().split(",") if m != ""]
+
+    print(f"{module}: {elapsed:.3f}s, {rss_mib:.1f} MiB max rss")
+
+    failures = []
+    if elapsed > max_seconds:
+        failures.append(f"import took {elapsed:.3f}s, budget is {max_seconds}s")
+    if rss_mib > max_mib:
+        failures.append(f"max rss was {rss_mib:.1f} MiB, budget is {max_mib} MiB")
+    if len(imported) > 0:
+        failures.append(f"heavy modules imported eagerly: {', '.join(imported)}")
+
+    for failure in failures:
+        print(failure)
+
+    exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Runs the ticket check against a local stand-in for the platform and checks
+that the ticket cache answers repeat lookups, expires them after its TTL and
+falls back to an expired answer when the platform times out.
+
+    python scripts/check_ticket_cache.py
+"""
+
+import base64
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHALLENGE_ID = "challenge"
+VALID_TEAMS = {"team-1", "team-2"}
+
+TTL = 1
+NEGATIVE_TTL = 0.5
+STALE_TTL = 60
+# the platform answers slower than this while it's "down"
+READ_TIMEOUT = 0.2
+
+requests_seen = []
+platform_slow = threading.Event()
+
+
+class PlatformHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        team_id = self.path.rsplit("/", 1)[1]
+        requests_seen.append(team_id)
+
+        if platform_slow.is_set():
+            time.sleep(READ_TIMEOUT * 5)
+
+        valid = team_id in VALID_TEAMS
+        body = json.dumps(
+            {"success": valid, "data": {"team": team_id} if valid else None}
+        ).encode("utf8")
+
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # the launcher gave up waiting
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_ticket(team_id: str) -> str:
+    # the inverse of TicketTeamProvider's decoding
+    encoded = base64.b64encode(f"{CHALLENGE_ID},{team_id}".encode()).decode()
+    return encoded.translate(str.maketrans("0123456789", "0629851743"))
+
+
+def main():
+    port = get_free_port()
+    server = ThreadingHTTPServer(("127.0.0.1", port), PlatformHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # read by the modules at import time
+    os.environ["TICKET_CHECK_URL"] = f"http://127.0.0.1:{port}/check/"
+    os.environ["TICKET_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(), "tickets.db")
+    os.environ["TICKET_CACHE_TTL"] = str(TTL)
+    os.environ["TICKET_CACHE_NEGATIVE_TTL"] = str(NEGATIVE_TTL)
+    os.environ["TICKET_CACHE_STALE_TTL"] = str(STALE_TTL)
+
+    from ctf_launchers import team_provider
+    from ctf_launchers.ticket_cache import get_ticket_cache
+
+    team_provider.TICKET_CHECK_TIMEOUT = (1, READ_TIMEOUT)
+    provider = team_provider.TicketTeamProvider(challenge_id=CHALLENGE_ID)
+
+    def lookup(team_id: str):
+        # get_team reads the ticket from the player
+        team_provider.input = lambda _: make_ticket(team_id)
+        return provider.get_team()
+
+    failures = []
+
+    def check(name: str, ok: bool):
+        print(f"{'ok' if ok else 'FAIL'}: {name}")
+        if not ok:
+            failures.append(name)
+
+    check("valid ticket is checked with the platform", lookup("team-1") == "team-1" and requests_seen == ["team-1"])
+    check("repeat lookup is answered from the cache", lookup("team-1") == "team-1" and len(requests_seen) == 1)
+
+    check("invalid ticket is rejected", lookup("nobody") is None and len(requests_seen) == 2)
+    check("invalid ticket is cached too", lookup("nobody") is None and len(requests_seen) == 2)
+
+    time.sleep(TTL + 0.1)
+    check("expired entry is checked again", lookup("team-1") == "team-1" and len(requests_seen) == 3)
+
+    time.sleep(TTL + 0.1)
+    platform_slow.set()
+
+    start = time.time()
+    check("platform timeout falls back to the expired answer", lookup("team-1") == "team-1")
+    check("fallback doesn't wait on the platform", time.time() - start < READ_TIMEOUT * 4)
+
+    for team_id, name in [
+        ("team-2", "platform timeout without a cached answer fails"),
+        ("nobody", "expired rejections aren't used as a fallback"),
+    ]:
+        try:
+            lookup(team_id)
+            check(name, False)
+        except Exception:
+            check(name, True)
+
+    platform_slow.clear()
+    server.shutdown()
+
+    stats = get_ticket_cache().stats()
+    print(json.dumps(stats))
+    check(
+        "hits, misses and fallbacks are counted",
+        stats.get("hits") == 2 and stats.get("misses") == 6 and stats.get("stale_hits") == 1,
+    )
+
+    exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Launches anvil once per profile, runs a batch of transactions through it and
+reports the resident memory it settles at afterwards.
+
+    python scripts/measure_anvil_rss.py [profiles] [transactions] [samples]
+
+ANVIL points at the binary, every profile forks from ETH_RPC_URL if it's set.
+"""
+
+import json
+import os
+import secrets
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+from ctf_server.types import ANVIL_PROFILES, LaunchAnvilInstanceArgs, format_anvil_args
+
+ANVIL = os.getenv("ANVIL", "anvil")
+ETH_RPC_URL = os.getenv("ETH_RPC_URL")
+
+SENDER = "0x000000000000000000000000000000000000dEaD"
+BATCH_SIZE = 100
+SAMPLE_INTERVAL = 1
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rpc(url: str, body):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode("utf8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=60) as resp:
+        return json.loads(resp.read())
+
+
+def call(url: str, method: str, params):
+    result = rpc(url, {"jsonrpc": "2.0", "id": 1, "method": method, "params": params})
+    if "error" in result:
+        raise Exception("rpc call failed", method, result["error"])
+
+    return result["result"]
+
+
+def wait_for_anvil(url: str, proc: subprocess.Popen):
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise Exception("anvil exited", proc.returncode)
+
+        try:
+            call(url, "eth_blockNumber", [])
+            return
+        except Exception:
+            time.sleep(0.2)
+
+    raise Exception("timed out waiting for anvil")
+
+
+def read_memory(pid: int) -> dict:
+    # VmRSS is what the process holds right now, VmHWM the most it ever held,
+    # both in KiB
+    memory = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ["VmRSS", "VmHWM"]:
+                memory[key] = int(value.split()[0]) / 1024
+
+    return memory
+
+
+def run_workload(url: str, transactions: int):
+    # every transaction is mined into its own block and creates an account, so
+    # both the history and the state keep growing
+    call(url, "anvil_setBalance", [SENDER, hex(10**30)])
+    call(url, "anvil_impersonateAccount", [SENDER])
+
+    for offset in range(0, transactions, BATCH_SIZE):
+        batch = [
+            {
+                "jsonrpc": "2.0",
+                "id": i,
+                "method": "eth_sendTransaction",
+                "params": [{"from": SENDER, "to": "0x" + secrets.token_hex(20), "value": "0x1"}],
+            }
+            for i in range(min(BATCH_SIZE, transactions - offset))
+        ]
+        for result in rpc(url, batch):
+            if "error" in result:
+                raise Exception("transaction failed", result["error"])
+
+
+def measure(profile: str, transactions: int, samples: int) -> dict:
+    args: LaunchAnvilInstanceArgs = {
+        "profile": profile,
+        # only the chain itself is measured, not the state file
+        "state_persistence": "off",
+        "fork_url": ETH_RPC_URL,
+    }
+
+    port = get_free_port()
+    url = f"http://127.0.0.1:{port}"
+
+    proc = subprocess.Popen(
+        [ANVIL] + format_anvil_args(args, profile, port),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_anvil(url, proc)
+
+        start = time.time()
+        run_workload(url, transactions)
+        elapsed = time.time() - start
+
+        rss = []
+        for _ in range(samples):
+            time.sleep(SAMPLE_INTERVAL)
+            rss.append(read_memory(proc.pid)["VmRSS"])
+
+        return {
+            "profile": profile,
+            "blocks": int(call(url, "eth_blockNumber", []), 16),
+            "workload_seconds": elapsed,
+            "steady_rss_mib": statistics.median(rss),
+            "peak_rss_mib": read_memory(proc.pid)["VmHWM"],
+        }
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    profiles = sys.argv[1].split(",") if len(sys.argv) > 1 else list(ANVIL_PROFILES)
+    transactions = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    samples = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    for profile in profiles:
+        if profile not in ANVIL_PROFILES:
+            raise Exception("invalid anvil profile", profile)
+
+    print(f"{'profile':<12} {'blocks':>8} {'workload':>10} {'steady rss':>12} {'peak rss':>12}")
+    for profile in profiles:
+        result = measure(profile, transactions, samples)
+        print(
+            f"{result['profile']:<12} {result['blocks']:>8} "
+            f"{result['workload_seconds']:>9.1f}s "
+            f"{result['steady_rss_mib']:>8.1f} MiB {result['peak_rss_mib']:>8.1f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,11 @@ setup(
     python_requires=">=3.7, <4",
     install_requires=[
         "web3==6.11.3",
-        "kubernetes==28.1.0",
+        "kubernetes_asyncio==28.2.1",
         "redis==5.0.1",
         "fastapi==0.104.1",
-        "docker==6.1.3",
+        "aiodocker==0.21.0",
+        "msgpack==1.0.7",
         "pwntools==4.11.0",
     ],
     py_modules=["foundry", "starknet", "ctf_server", "ctf_launchers", "ctf_solvers"],
@@ -1,5 +1,11 @@
-from web3 import Web3
-from web3.types import RPCResponse
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+# only needed for annotations, launchers shouldn't pay for importing web3 here
+if TYPE_CHECKING:
+    from web3 import AsyncWeb3, Web3
+    from web3.types import RPCResponse
 
 
 def check_error(resp: RPCResponse):
@@ -9,3 +15,7 @@ def check_error(resp: RPCResponse):
 
 def starknet_getVersion(web3: Web3):
     check_error(web3.provider.make_request("starknet_specVersion", []))
+
+
+async def async_starknet_getVersion(web3: AsyncWeb3):
+    check_error(await web3.provider.make_request("starknet_specVersion", []))